@@ -0,0 +1,109 @@
+"""AIエンドポイントの負荷試験
+
+Gemini の代わりに FakeLLMBackend を使い、遅い上流を模した状態でスループットとレイテンシ分布を測る。
+同時に /meals も叩き、AI呼び出しが詰まっても他のエンドポイントが止まらないことを確認する。
+
+    pip install -r requirements-dev.txt
+    python bench_llm.py --requests 500 --concurrency 64 --latency-ms 1500 --error-rate 0.05
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def report(name, latencies, errors, elapsed):
+    print(f"{name}: {len(latencies)} ok / {errors} errors, {len(latencies) / elapsed:.1f} req/s")
+    if latencies:
+        print("  mean {:.1f}ms  p50 {:.1f}ms  p95 {:.1f}ms  p99 {:.1f}ms  max {:.1f}ms".format(
+            statistics.mean(latencies) * 1000,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 95) * 1000,
+            percentile(latencies, 99) * 1000,
+            max(latencies) * 1000,
+        ))
+
+async def run(args):
+    import httpx
+    import main
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        semaphore = asyncio.Semaphore(args.concurrency)
+        results = {"estimate": ([], 0), "advice": ([], 0), "meals": ([], 0)}
+
+        async def send(kind, method, url, **kwargs):
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies, errors = results[kind]
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                results[kind] = (latencies, errors + 1)
+
+        async def request(kind, method, url, **kwargs):
+            # /meals は同時実行数の制限をかけずに送り、AI呼び出しの混雑の影響だけを見る
+            if kind == "meals":
+                return await send(kind, method, url, **kwargs)
+            async with semaphore:
+                await send(kind, method, url, **kwargs)
+
+        # アドバイス用に、日付ごとの食事を用意しておく
+        dates = [f"2024-01-{d:02d}" for d in range(1, 29)]
+        for date in dates:
+            await client.post("/meals", json={
+                "user_id": "bench", "date": date, "meal_type": "昼食", "food_name": f"ベンチ定食{date}",
+                "calories": 650, "protein": 30, "fat": 20, "carbs": 80,
+            })
+
+        tasks = []
+        for i in range(args.requests):
+            # 一部は同じ食品名にして、キャッシュと single-flight の効果も含める
+            text = f"ベンチ料理{i % args.distinct}"
+            tasks.append(request("estimate", "POST", "/api/estimate_nutrition", json={"text": text}))
+            if i % 5 == 0:
+                tasks.append(request("advice", "POST", "/api/daily_advice", json={
+                    "user_id": "bench", "date": dates[i % len(dates)],
+                }))
+            if i % 10 == 0:
+                tasks.append(request("meals", "GET", "/meals", params={"user_id": "bench"}))
+
+        start = time.perf_counter()
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    print(f"backend={main.llm_client.backend.name} latency={args.latency_ms}ms error_rate={args.error_rate} "
+          f"concurrency={args.concurrency} elapsed={elapsed:.2f}s")
+    for name, (latencies, errors) in results.items():
+        report(name, latencies, errors, elapsed)
+    print("llm:", main.llm_client.stats())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--distinct", type=int, default=100, help="食品名の種類数")
+    parser.add_argument("--latency-ms", type=float, default=800)
+    parser.add_argument("--jitter-ms", type=float, default=400)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    # main を読み込む前に設定する（本番の memo.db は使わない）
+    os.environ["LLM_BACKEND"] = "fake"
+    os.environ["LLM_FAKE_LATENCY_MS"] = str(args.latency_ms)
+    os.environ["LLM_FAKE_JITTER_MS"] = str(args.jitter_ms)
+    os.environ["LLM_FAKE_ERROR_RATE"] = str(args.error_rate)
+    workdir = tempfile.mkdtemp(prefix="kinapp-bench-")
+    os.environ["DB_FILE"] = os.path.join(workdir, "bench.db")
+    os.environ["SEMANTIC_CACHE_FILE"] = os.path.join(workdir, "nutrition_vectors.i8")
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
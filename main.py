@@ -1,19 +1,45 @@
-from fastapi import FastAPI, Query, HTTPException
-from pydantic import BaseModel
+from fastapi import FastAPI, Query, HTTPException, UploadFile, File, Request, Body
+from pydantic import BaseModel, ValidationError
 from typing import Optional, List
 import sqlite3
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse, Response
+from fastapi.concurrency import run_in_threadpool
 import hashlib
+import base64
 import os
 import urllib.request
+import urllib.parse
 import json
+import csv
+import gzip
+import io
+import asyncio
+import random
 import google.generativeai as genai
 import re
-
-from datetime import datetime
-app = FastAPI()
+import queue
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict, defaultdict, deque
+import numpy as np
+
+from contextlib import asynccontextmanager
+from datetime import datetime, date as date_type
+
+# 起動・終了時の処理（関数は後の各セクションで定義）
+@asynccontextmanager
+async def lifespan(app):
+    await run_in_threadpool(prune_sync_tombstones)
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    close_db_pool()
+
+app = FastAPI(lifespan=lifespan)
 
 # ★ Gemini API Key (環境変数からのみ取得)
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
@@ -79,15 +105,82 @@ class WeightLog(BaseModel):
 class EstimationRequest(BaseModel):
     text: str
 
+class BatchEstimationRequest(BaseModel):
+    items: List[str]
+
 class AdviceRequest(BaseModel):
-    meals: list
-    targets: dict
+    user_id: str
+    date: str
 
-DB_FILE = "memo.db"
+DB_FILE = os.environ.get("DB_FILE", "memo.db")
+
+# --- DB接続プール ---
+# リクエストごとに connect/close するとファイルオープン・スキーマ解析・キャッシュが毎回やり直しになるため、
+# 接続をプールに貯めておき、get_db() で借りて conn.close() で返す。
+# スレッドには紐付けないので、アイドルで終了したワーカースレッドの接続も次のスレッドがそのまま使う。
+# PRAGMAは接続作成時に一度だけ設定する。
+DB_BUSY_TIMEOUT = 5.0               # 書き込みロック待ち (秒)
+DB_CACHE_SIZE_KB = 16 * 1024        # ページキャッシュ 16MB
+DB_MMAP_SIZE = 128 * 1024 * 1024    # mmap 128MB
+DB_STATEMENT_CACHE = 256            # プリペアドステートメントのキャッシュ数
+DB_POOL_SIZE = 40                   # 返却された接続を保持する上限（AnyIO のスレッドプール既定値と同じ）
+
+class PooledConnection(sqlite3.Connection):
+    """close() で実際には閉じず、未コミットの変更を破棄してプールに返却する接続"""
+
+    in_pool = False
+
+    def close(self):
+        if self.in_pool:
+            return  # 二重の close() で同じ接続を2回プールに入れない
+        if self.in_transaction:
+            self.rollback()
+        self.in_pool = True
+        try:
+            _db_pool.put_nowait(self)
+        except queue.Full:
+            self.dispose()
+
+    def dispose(self):
+        sqlite3.Connection.close(self)
+
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)  # 直前に返された（キャッシュの温まった）接続から使う
+
+def open_db():
+    conn = sqlite3.connect(
+        DB_FILE,
+        timeout=DB_BUSY_TIMEOUT,
+        factory=PooledConnection,
+        cached_statements=DB_STATEMENT_CACHE,
+        check_same_thread=False,  # 返却された接続は別のスレッドが借りる（同時に使うのは常に1スレッド）
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def get_db():
+    """プールから接続を借りる（空なら新しく開く）。使用後は従来どおり conn.close() で返却する。
+    例外で返却されなかった接続は参照がなくなった時点で閉じられる"""
+    try:
+        conn = _db_pool.get_nowait()
+    except queue.Empty:
+        conn = open_db()
+    conn.in_pool = False
+    return conn
+
+def close_db_pool():
+    while True:
+        try:
+            _db_pool.get_nowait().dispose()
+        except queue.Empty:
+            break
 
 # 初期化関数
 def init_db():
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS memos (
@@ -165,14 +258,559 @@ def init_db():
     ''')
 
     conn.commit()
+    run_migrations(conn)
     conn.close()
+
+# --- 日付の正規化 ---
+# 日付は 'YYYY-MM-DD' (ISO-8601) のTEXTで保存する。文字列順＝日付順になるため、
+# (user_id, date) インデックスの範囲スキャンで期間指定の検索ができる。
+DATE_PATTERN = re.compile(r"^\s*(\d{4})[-/.年](\d{1,2})[-/.月](\d{1,2})日?(?:[T\s].*)?$")
+COMPACT_DATE_PATTERN = re.compile(r"^\s*(\d{4})(\d{2})(\d{2})\s*$")
+
+def normalize_date(value):
+    """'2024/1/5', '2024年1月5日', '20240105', '2024-01-05T10:00' などを '2024-01-05' にする。解釈できなければ None"""
+    if not value:
+        return None
+    match = DATE_PATTERN.match(value) or COMPACT_DATE_PATTERN.match(value)
+    if not match:
+        return None
+    try:
+        return date_type(*(int(g) for g in match.groups())).isoformat()
+    except ValueError:
+        return None
+
+def require_date(value):
+    normalized = normalize_date(value)
+    if normalized is None:
+        raise HTTPException(status_code=400, detail=f"日付の形式が不正です: {value}")
+    return normalized
+
+def date_range_conditions(column, date_from, date_to):
+    """from/to (両端含む) をインデックスの範囲条件に変換する"""
+    conditions = []
+    values = []
+    if date_from:
+        conditions.append(f"{column} >= ?")
+        values.append(require_date(date_from))
+    if date_to:
+        conditions.append(f"{column} <= ?")
+        values.append(require_date(date_to))
+    return conditions, values
+
+def normalize_stored_dates(cursor):
+    """既存の memos / meals / weights の日付を ISO-8601 に揃える（解釈できない値はそのまま残す）"""
+    for table in ("memos", "meals", "weights"):
+        cursor.execute(f"SELECT DISTINCT date FROM {table}")
+        for (value,) in cursor.fetchall():
+            normalized = normalize_date(value)
+            if normalized and normalized != value:
+                cursor.execute(f"UPDATE {table} SET date = ? WHERE date = ?", (normalized, value))
+
+# 差分同期 (/sync) の対象テーブル。行バージョンは sync_state.version を1ずつ進めて振る全テーブル共通の連番
+SYNC_TABLES = ("memos", "meals", "weights")
+
+def backfill_row_versions(cursor):
+    """既存の行に重複しない行バージョンを振る（全件同期のページングで同じ値が並ばないように）"""
+    version = 0
+    for table in SYNC_TABLES:
+        cursor.execute(f"UPDATE {table} SET row_version = id + ?", (version,))
+        cursor.execute(f"SELECT COALESCE(MAX(row_version), ?) FROM {table}", (version,))
+        version = cursor.fetchone()[0]
+    cursor.execute("UPDATE sync_state SET version = ? WHERE id = 1", (version,))
+
+def sync_triggers(table):
+    """INSERT/UPDATE で行バージョンを進め、DELETE で削除記録 (tombstone) を残すトリガー"""
+    bump = "UPDATE sync_state SET version = version + 1 WHERE id = 1;"
+    current = "(SELECT version FROM sync_state WHERE id = 1)"
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_sync_ai AFTER INSERT ON {table} BEGIN
+            {bump}
+            UPDATE {table} SET row_version = {current} WHERE id = new.id;
+        END""",
+        # 自身の row_version 更新で再度発火しないよう、row_version を変えない UPDATE だけを拾う
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_sync_au AFTER UPDATE ON {table}
+        WHEN new.row_version = old.row_version BEGIN
+            {bump}
+            UPDATE {table} SET row_version = {current} WHERE id = new.id;
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {table}_sync_ad AFTER DELETE ON {table} BEGIN
+            {bump}
+            INSERT INTO sync_tombstones (row_version, table_name, row_id, user_id, deleted_at)
+            VALUES ({current}, '{table}', old.id, old.user_id, CAST(strftime('%s', 'now') AS INTEGER));
+        END""",
+    ]
+
+def sync_owner_trigger(table):
+    """user_id が変わった行は、前の持ち主から見れば削除なので削除記録を残す"""
+    return f"""CREATE TRIGGER IF NOT EXISTS {table}_sync_owner AFTER UPDATE OF user_id ON {table}
+    WHEN new.user_id IS NOT old.user_id BEGIN
+        UPDATE sync_state SET version = version + 1 WHERE id = 1;
+        INSERT INTO sync_tombstones (row_version, table_name, row_id, user_id, deleted_at)
+        VALUES ((SELECT version FROM sync_state WHERE id = 1), '{table}', old.id, old.user_id,
+                CAST(strftime('%s', 'now') AS INTEGER));
+    END"""
+
+# --- トレーニング分析 ---
+# memos の1行＝1セット (weight × reps)。種目ごとのセッション（同日）集計と、レップ数ごとの自己ベスト(PR)を
+# exercise_sessions / exercise_prs に保持し、add_memo / update_memo / delete_memo で更新する。
+BRZYCKI_MAX_REPS = 36  # Brzycki式は 37 レップ以上で発散する
+
+def summarize_sets(rows):
+    """セットの行 [(id, user_id, exercise, date, weight, reps), ...] を (user_id, exercise, date, id) 順で受け取り、
+    セッション集計とレップ数ごとのPRをまとめて計算する"""
+    if not rows:
+        return [], []
+    ids = np.array([r[0] for r in rows], dtype=np.int64)
+    weights = np.array([r[4] or 0.0 for r in rows], dtype=float)
+    reps = np.array([r[5] or 0 for r in rows], dtype=np.int64)
+
+    # セットごとの指標（推定1RM: Epley / Brzycki）
+    tonnage = weights * reps
+    epley = np.where(reps == 1, weights, weights * (1 + reps / 30.0))
+    epley[reps <= 0] = 0.0
+    brzycki = np.full(len(rows), np.nan)
+    valid = (reps > 0) & (reps <= BRZYCKI_MAX_REPS)
+    brzycki[valid] = weights[valid] * 36.0 / (37 - reps[valid])
+
+    # セッション: (user_id, exercise, date) の連続区間ごとに reduceat
+    keys = [(r[1], r[2], r[3]) for r in rows]
+    starts = [0] + [i for i in range(1, len(rows)) if keys[i] != keys[i - 1]]
+    counts = np.diff(starts + [len(rows)])
+    session_tonnage = np.add.reduceat(tonnage, starts)
+    session_reps = np.add.reduceat(reps, starts)
+    session_top = np.maximum.reduceat(weights, starts)
+    session_epley = np.maximum.reduceat(epley, starts)
+    session_brzycki = np.fmax.reduceat(brzycki, starts)
+    sessions = [
+        (*keys[s], int(counts[k]), int(session_reps[k]), float(session_tonnage[k]), float(session_top[k]),
+         float(session_epley[k]), None if np.isnan(session_brzycki[k]) else float(session_brzycki[k]))
+        for k, s in enumerate(starts)
+    ]
+
+    # PR: (user_id, exercise, reps) ごとの最大重量。同重量なら最初に記録したセット
+    prs = []
+    seen = set()
+    for i in np.lexsort((ids, -weights, reps)):  # reps 昇順 → weight 降順 → id 昇順
+        key = (rows[i][1], rows[i][2], int(reps[i]))
+        if reps[i] <= 0 or key in seen:
+            continue
+        seen.add(key)
+        prs.append((*key, float(weights[i]), rows[i][3], int(ids[i])))
+    return sessions, prs
+
+def save_training_summary(cursor, sessions, prs):
+    cursor.executemany('''
+        INSERT OR REPLACE INTO exercise_sessions
+            (user_id, exercise, date, sets, reps, tonnage, top_weight, e1rm_epley, e1rm_brzycki)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', sessions)
+    cursor.executemany('''
+        INSERT OR REPLACE INTO exercise_prs (user_id, exercise, reps, weight, date, memo_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', prs)
+
+def rebuild_training_analytics(cursor):
+    cursor.execute("DELETE FROM exercise_sessions")
+    cursor.execute("DELETE FROM exercise_prs")
+    cursor.execute("SELECT id, user_id, exercise, date, weight, reps FROM memos ORDER BY user_id, exercise, date, id")
+    sessions, prs = summarize_sets(cursor.fetchall())
+    save_training_summary(cursor, sessions, prs)
+
+def refresh_training_analytics(cursor, user_id, exercise, *dates):
+    """セットの追加・変更・削除で影響を受ける (user_id, exercise, date) の集計を更新する。
+    セッションは指定した日の分だけ、PRは種目の全履歴から再計算する（書き込むのはレップ数の種類分だけ）"""
+    cursor.executemany(
+        "DELETE FROM exercise_sessions WHERE user_id = ? AND exercise = ? AND date = ?",
+        [(user_id, exercise, date) for date in dates]
+    )
+    cursor.execute("DELETE FROM exercise_prs WHERE user_id = ? AND exercise = ?", (user_id, exercise))
+    cursor.execute('''
+        SELECT id, user_id, exercise, date, weight, reps FROM memos
+        WHERE user_id = ? AND exercise = ? ORDER BY date, id
+    ''', (user_id, exercise))
+    rows = cursor.fetchall()
+    sessions, _ = summarize_sets([r for r in rows if r[3] in dates])
+    _, prs = summarize_sets(rows)
+    save_training_summary(cursor, sessions, prs)
+
+def refresh_memo_analytics(cursor, keys):
+    """(user_id, exercise, date) の集合をまとめて更新する。同じ種目の日付は1回の再計算で済ませる"""
+    dates_by_exercise = defaultdict(set)
+    for user_id, exercise, date in keys:
+        dates_by_exercise[(user_id, exercise)].add(date)
+    for (user_id, exercise), dates in dates_by_exercise.items():
+        refresh_training_analytics(cursor, user_id, exercise, *sorted(dates))
+
+def rebuild_exercise_analytics(cursor, user_id, exercise):
+    """(user_id, exercise) の集計を全履歴から作り直す。一括インポートのように多くの日付が一度に変わるとき用"""
+    cursor.execute("DELETE FROM exercise_sessions WHERE user_id = ? AND exercise = ?", (user_id, exercise))
+    cursor.execute("DELETE FROM exercise_prs WHERE user_id = ? AND exercise = ?", (user_id, exercise))
+    cursor.execute('''
+        SELECT id, user_id, exercise, date, weight, reps FROM memos
+        WHERE user_id = ? AND exercise = ? ORDER BY date, id
+    ''', (user_id, exercise))
+    sessions, prs = summarize_sets(cursor.fetchall())
+    save_training_summary(cursor, sessions, prs)
+
+# --- スキーママイグレーション ---
+# init_db() の CREATE TABLE IF NOT EXISTS をベースラインとし、それ以降のスキーマ変更は
+# 番号付きマイグレーションとして追加する。適用済みバージョンは schema_version に記録され、
+# 各マイグレーションは一度だけ実行される。
+MIGRATIONS = [
+    (1, "ホットクエリ用の複合インデックス", [
+        # /memo_v2 (target_user, mine), /memo?user_id=
+        "CREATE INDEX IF NOT EXISTS idx_memos_user_date ON memos(user_id, date)",
+        # /meals?user_id=&date=
+        "CREATE INDEX IF NOT EXISTS idx_meals_user_date ON meals(user_id, date)",
+        # /weights (weightまで含めてテーブル本体を読まずに済むカバリングインデックス)
+        "CREATE INDEX IF NOT EXISTS idx_weights_user_date ON weights(user_id, date, weight)",
+        # /friends のフォロワー側 (フォロー側は UNIQUE(user_id, friend_id) の自動インデックスで足りる)
+        "CREATE INDEX IF NOT EXISTS idx_friends_friend ON friends(friend_id, user_id)",
+        # /notifications (ORDER BY created_at DESC もインデックス順で返せる)
+        "CREATE INDEX IF NOT EXISTS idx_notifications_user_created ON notifications(user_id, created_at)",
+    ]),
+    (2, "全体フィードのキーセットページネーション用インデックス", [
+        # /memo_v2?filter_mode=all は (date, id) 降順にインデックスを辿って LIMIT 件で止める
+        "CREATE INDEX IF NOT EXISTS idx_memos_date ON memos(date)",
+    ]),
+    (3, "全文検索 (FTS5 trigram): memos.exercise/note, meals.food_name", [
+        # trigram トークナイザは分かち書き不要で日本語の部分一致に使える（3文字以上のクエリ）
+        "CREATE VIRTUAL TABLE IF NOT EXISTS memos_fts USING fts5(exercise, note, content='memos', content_rowid='id', tokenize='trigram')",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS meals_fts USING fts5(food_name, content='meals', content_rowid='id', tokenize='trigram')",
+        # 外部コンテンツテーブルの同期トリガー
+        """CREATE TRIGGER IF NOT EXISTS memos_fts_ai AFTER INSERT ON memos BEGIN
+            INSERT INTO memos_fts(rowid, exercise, note) VALUES (new.id, new.exercise, new.note);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS memos_fts_ad AFTER DELETE ON memos BEGIN
+            INSERT INTO memos_fts(memos_fts, rowid, exercise, note) VALUES ('delete', old.id, old.exercise, old.note);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS memos_fts_au AFTER UPDATE OF exercise, note ON memos BEGIN
+            INSERT INTO memos_fts(memos_fts, rowid, exercise, note) VALUES ('delete', old.id, old.exercise, old.note);
+            INSERT INTO memos_fts(rowid, exercise, note) VALUES (new.id, new.exercise, new.note);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS meals_fts_ai AFTER INSERT ON meals BEGIN
+            INSERT INTO meals_fts(rowid, food_name) VALUES (new.id, new.food_name);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS meals_fts_ad AFTER DELETE ON meals BEGIN
+            INSERT INTO meals_fts(meals_fts, rowid, food_name) VALUES ('delete', old.id, old.food_name);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS meals_fts_au AFTER UPDATE OF food_name ON meals BEGIN
+            INSERT INTO meals_fts(meals_fts, rowid, food_name) VALUES ('delete', old.id, old.food_name);
+            INSERT INTO meals_fts(rowid, food_name) VALUES (new.id, new.food_name);
+        END""",
+        # 既存データの取り込み
+        "INSERT INTO memos_fts(memos_fts) VALUES ('rebuild')",
+        "INSERT INTO meals_fts(meals_fts) VALUES ('rebuild')",
+    ]),
+    (4, "日付を ISO-8601 (YYYY-MM-DD) に正規化", [
+        normalize_stored_dates,
+    ]),
+    (5, "日別栄養集計テーブル daily_nutrition", [
+        """CREATE TABLE IF NOT EXISTS daily_nutrition (
+            user_id TEXT,
+            date TEXT,
+            calories INTEGER DEFAULT 0,
+            protein REAL DEFAULT 0,
+            fat REAL DEFAULT 0,
+            carbs REAL DEFAULT 0,
+            meal_count INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, date)
+        ) WITHOUT ROWID""",
+        """INSERT OR REPLACE INTO daily_nutrition (user_id, date, calories, protein, fat, carbs, meal_count)
+            SELECT user_id, date, IFNULL(SUM(calories), 0), IFNULL(SUM(protein), 0), IFNULL(SUM(fat), 0), IFNULL(SUM(carbs), 0), COUNT(*)
+            FROM meals GROUP BY user_id, date""",
+    ]),
+    (6, "トレーニング分析の集計テーブル", [
+        "CREATE INDEX IF NOT EXISTS idx_memos_user_exercise_date ON memos(user_id, exercise, date)",
+        """CREATE TABLE IF NOT EXISTS exercise_sessions (
+            user_id TEXT,
+            exercise TEXT,
+            date TEXT,
+            sets INTEGER,
+            reps INTEGER,
+            tonnage REAL,
+            top_weight REAL,
+            e1rm_epley REAL,
+            e1rm_brzycki REAL,
+            PRIMARY KEY (user_id, exercise, date)
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS exercise_prs (
+            user_id TEXT,
+            exercise TEXT,
+            reps INTEGER,
+            weight REAL,
+            date TEXT,
+            memo_id INTEGER,
+            PRIMARY KEY (user_id, exercise, reps)
+        ) WITHOUT ROWID""",
+        rebuild_training_analytics,
+    ]),
+    (7, "栄養推定結果のキャッシュ", [
+        """CREATE TABLE IF NOT EXISTS nutrition_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT,
+            created_at REAL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_nutrition_cache_created ON nutrition_cache(created_at)",
+    ]),
+    (8, "食事アドバイスのキャッシュ", [
+        """CREATE TABLE IF NOT EXISTS advice_cache (
+            user_id TEXT,
+            date TEXT,
+            content_hash TEXT,
+            advice TEXT,
+            created_at REAL,
+            PRIMARY KEY (user_id, date)
+        ) WITHOUT ROWID""",
+    ]),
+    (9, "LLMジョブキュー", [
+        """CREATE TABLE IF NOT EXISTS llm_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            payload TEXT,
+            dedup_key TEXT,
+            status TEXT,
+            attempts INTEGER DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            created_at REAL,
+            updated_at REAL,
+            run_after REAL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_llm_jobs_status_run_after ON llm_jobs(status, run_after)",
+        "CREATE INDEX IF NOT EXISTS idx_llm_jobs_dedup ON llm_jobs(dedup_key, status)",
+    ]),
+    (10, "類似入力キャッシュ（ベクトルは memmap ファイル側）", [
+        """CREATE TABLE IF NOT EXISTS semantic_cache (
+            slot INTEGER PRIMARY KEY,
+            input TEXT,
+            response TEXT,
+            quantity TEXT,
+            created_at REAL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_semantic_cache_created ON semantic_cache(created_at)",
+    ]),
+    (11, "差分同期: 行バージョンと削除記録", [
+        """CREATE TABLE IF NOT EXISTS sync_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            pruned_version INTEGER NOT NULL DEFAULT 0
+        )""",
+        "INSERT OR IGNORE INTO sync_state (id, version) VALUES (1, 0)",
+        """CREATE TABLE IF NOT EXISTS sync_tombstones (
+            row_version INTEGER PRIMARY KEY,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            user_id TEXT,
+            deleted_at INTEGER
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_sync_tombstones_user ON sync_tombstones(user_id, row_version)",
+        *[f"ALTER TABLE {table} ADD COLUMN row_version INTEGER NOT NULL DEFAULT 0" for table in SYNC_TABLES],
+        backfill_row_versions,
+        # /sync?user_id=&since= は (user_id, row_version) の範囲をインデックス順に読む
+        *[f"CREATE INDEX IF NOT EXISTS idx_{table}_user_version ON {table}(user_id, row_version)" for table in SYNC_TABLES],
+        *[statement for table in SYNC_TABLES for statement in sync_triggers(table)],
+    ]),
+    (12, "冪等キー (Idempotency-Key) と保存したレスポンス", [
+        """CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key_hash BLOB PRIMARY KEY,
+            request_hash BLOB NOT NULL,
+            status INTEGER,
+            headers TEXT,
+            body BLOB,
+            expires_at INTEGER NOT NULL
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys(expires_at)",
+    ]),
+    (13, "類似入力キャッシュを検索時 IDF の保存形式で作り直す", [
+        # 以前のベクトルは登録時の IDF をかけて保存していた。行を消すと次の起動で memmap も作り直される
+        "DELETE FROM semantic_cache",
+    ]),
+    (14, "差分同期: 持ち主が変わった行の削除記録", [
+        sync_owner_trigger(table) for table in SYNC_TABLES
+    ]),
+]
+
+def run_migrations(conn):
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    for version, description, statements in MIGRATIONS:
+        # 複数プロセスが同時に起動しても二重適用しないよう、書き込みロックを取ってから再確認する
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,))
+        if cursor.fetchone():
+            conn.rollback()
+            continue
+        for statement in statements:
+            if callable(statement):
+                statement(cursor)
+            else:
+                cursor.execute(statement)
+        cursor.execute("INSERT INTO schema_version (version, description) VALUES (?, ?)", (version, description))
+        conn.commit()
+        print(f"Migration {version} applied: {description}")
+
+# EXPLAIN QUERY PLAN で検証するホットクエリ (python main.py --check-plans)
+HOT_QUERIES = {
+    "meals by user/date": (
+        "SELECT id, date, meal_type, food_name, calories, protein, fat, carbs FROM meals WHERE user_id = ? AND date = ?",
+        ("u", "2024-01-01"),
+    ),
+    "memos by user": (
+        "SELECT id, user_id, date, exercise, weight, reps, note FROM memos WHERE user_id = ?",
+        ("u",),
+    ),
+    "memo page by user": (
+        "SELECT id, user_id, date FROM memos m WHERE m.user_id = ? AND (m.date, m.id) < (?, ?) ORDER BY m.date DESC, m.id DESC LIMIT 51",
+        ("u", "2024-01-01", 100),
+    ),
+    "memo page (all)": (
+        "SELECT id, user_id, date FROM memos m WHERE (m.date, m.id) < (?, ?) ORDER BY m.date DESC, m.id DESC LIMIT 51",
+        ("2024-01-01", 100),
+    ),
+    "meals by user/date range": (
+        "SELECT id, date, meal_type, food_name, calories, protein, fat, carbs FROM meals WHERE user_id = ? AND date >= ? AND date <= ? ORDER BY date, id",
+        ("u", "2024-01-01", "2024-01-31"),
+    ),
+    "weights by user/date range": (
+        "SELECT id, date, weight FROM weights WHERE user_id = ? AND date >= ? AND date <= ? ORDER BY date ASC",
+        ("u", "2024-01-01", "2024-12-31"),
+    ),
+    "daily nutrition range": (
+        "SELECT date, calories, protein, fat, carbs, meal_count FROM daily_nutrition WHERE user_id = ? AND date >= ? AND date <= ? ORDER BY date",
+        ("u", "2024-01-01", "2024-01-31"),
+    ),
+    "weights by user": (
+        "SELECT id, date, weight FROM weights WHERE user_id = ? ORDER BY date ASC",
+        ("u",),
+    ),
+    "following": (
+        "SELECT friend_id FROM friends WHERE user_id = ?",
+        ("u",),
+    ),
+    "followers": (
+        "SELECT user_id FROM friends WHERE friend_id = ?",
+        ("u",),
+    ),
+    "notifications": (
+        "SELECT id, from_user, type, is_read, created_at FROM notifications WHERE user_id = ? ORDER BY created_at DESC LIMIT 20",
+        ("u",),
+    ),
+}
+
+def check_query_plans(conn):
+    """各ホットクエリがインデックスを使い、全件スキャンや一時ソートをしていないか検証する"""
+    results = []
+    for name, (sql, params) in HOT_QUERIES.items():
+        details = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        ok = all(
+            # WITHOUT ROWID テーブルの主キー検索は "USING PRIMARY KEY" と出る
+            any(u in d for u in ("USING INDEX", "USING COVERING INDEX", "USING INTEGER PRIMARY KEY", "USING PRIMARY KEY"))
+            and "TEMP B-TREE" not in d
+            for d in details
+        )
+        results.append((name, ok, details))
+    return results
+
 init_db()
 
+# --- ソーシャルグラフ ---
+class SocialGraph:
+    """friends テーブルのフォロー関係をメモリ上の隣接集合として保持する
+
+    初回アクセス時に users / friends を一括ロードし、以降は register / add_friend / remove_friend の
+    書き込み経路（コミット後）で更新する。公開範囲のフレンド判定はSQLiteを参照せずにここで行う。
+    ※ 単一プロセス前提（Procfile の uvicorn は1プロセス）。複数ワーカーにする場合は別途同期が必要。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._users = set()
+        self._following = defaultdict(set)  # user -> フォローしている人
+        self._followers = defaultdict(set)  # user -> フォロワー
+        self._mutuals = defaultdict(set)    # user -> 相互フォロー（事前計算）
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            # 呼び出し元が借りている接続のトランザクションに干渉しないよう、専用の接続で読む
+            conn = open_db()
+            cursor = conn.cursor()
+            cursor.execute("SELECT username FROM users")
+            for (username,) in cursor.fetchall():
+                self._users.add(username)
+            cursor.execute("SELECT user_id, friend_id FROM friends")
+            for user_id, friend_id in cursor.fetchall():
+                self._add_edge(user_id, friend_id)
+            conn.dispose()
+            self._loaded = True
+
+    def _add_edge(self, a, b):
+        self._following[a].add(b)
+        self._followers[b].add(a)
+        if a in self._following.get(b, ()):
+            self._mutuals[a].add(b)
+            self._mutuals[b].add(a)
+
+    def add_user(self, username):
+        self._ensure_loaded()
+        with self._lock:
+            self._users.add(username)
+
+    def user_exists(self, username):
+        self._ensure_loaded()
+        return username in self._users
+
+    def follow(self, a, b):
+        self._ensure_loaded()
+        with self._lock:
+            self._add_edge(a, b)
+
+    def unfollow(self, a, b):
+        self._ensure_loaded()
+        with self._lock:
+            self._following[a].discard(b)
+            self._followers[b].discard(a)
+            self._mutuals[a].discard(b)
+            self._mutuals[b].discard(a)
+
+    def following(self, user):
+        self._ensure_loaded()
+        with self._lock:
+            return set(self._following.get(user, ()))
+
+    def followers(self, user):
+        self._ensure_loaded()
+        with self._lock:
+            return set(self._followers.get(user, ()))
+
+    def mutuals(self, user):
+        self._ensure_loaded()
+        with self._lock:
+            return set(self._mutuals.get(user, ()))
+
+    def is_mutual(self, a, b):
+        self._ensure_loaded()
+        return b in self._mutuals.get(a, ())
+
+social_graph = SocialGraph()
+
 # ユーザー登録
 @app.post("/register")
 def register_user(user: UserCreate):
     hashed_pw = hashlib.sha256(user.password.encode()).hexdigest()
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     try:
         cursor.execute("INSERT INTO users (username, password) VALUES (?, ?)", (user.username, hashed_pw))
@@ -181,32 +819,190 @@ def register_user(user: UserCreate):
         raise HTTPException(status_code=400, detail="このユーザー名は既に存在します")
     finally:
         conn.close()
+    social_graph.add_user(user.username)
     return {"message": "ユーザー登録成功"}
 
 # メモ登録
 @app.post("/memo")
 def add_memo(memo: Memo):
-    conn = sqlite3.connect(DB_FILE)
+    memo.date = require_date(memo.date)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         INSERT INTO memos (user_id, date, exercise, weight, reps, note)
         VALUES (?, ?, ?, ?, ?, ?)
     ''', (memo.user_id, memo.date, memo.exercise, memo.weight, memo.reps, memo.note))
     memo_id = cursor.lastrowid
+    refresh_training_analytics(cursor, memo.user_id, memo.exercise, memo.date)
     conn.commit()
     conn.close()
     return {"message": "DBにメモを保存しました", "id": memo_id, "memo": memo}
 
+# --- メモの一括登録・更新・削除 ---
+# 1回のトレーニング分のセットをまとめて1トランザクションで書き込み、集計の更新も種目ごとに1回で済ませる。
+# /memo/{memo_id} より先に登録しないと "batch" が memo_id として解釈される。
+MEMO_BATCH_MAX = 500
+
+class MemoUpdate(Memo):
+    id: int
+
+def check_memo_batch(items):
+    if not items:
+        raise HTTPException(status_code=400, detail="メモが空です")
+    if len(items) > MEMO_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"一度に扱えるメモは{MEMO_BATCH_MAX}件までです")
+
+def fetch_memo_keys(cursor, ids):
+    """id -> (user_id, exercise, date)"""
+    cursor.execute(
+        f"SELECT id, user_id, exercise, date FROM memos WHERE id IN ({', '.join('?' * len(ids))})", list(ids)
+    )
+    return {r[0]: r[1:] for r in cursor.fetchall()}
+
+@app.post("/memo/batch")
+def add_memos(memos: List[Memo]):
+    check_memo_batch(memos)
+    for memo in memos:
+        memo.date = require_date(memo.date)
+    conn = get_db()
+    cursor = conn.cursor()
+    ids = []
+    for memo in memos:
+        cursor.execute('''
+            INSERT INTO memos (user_id, date, exercise, weight, reps, note)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (memo.user_id, memo.date, memo.exercise, memo.weight, memo.reps, memo.note))
+        ids.append(cursor.lastrowid)
+    refresh_memo_analytics(cursor, {(m.user_id, m.exercise, m.date) for m in memos})
+    conn.commit()
+    conn.close()
+    return {"message": f"{len(ids)}件のメモを保存しました", "ids": ids}
+
+@app.put("/memo/batch")
+def update_memos(memos: List[MemoUpdate]):
+    check_memo_batch(memos)
+    for memo in memos:
+        memo.date = require_date(memo.date)
+    conn = get_db()
+    cursor = conn.cursor()
+    old = fetch_memo_keys(cursor, {m.id for m in memos})
+    found = [m for m in memos if m.id in old]
+    cursor.executemany('''
+        UPDATE memos
+        SET user_id = ?, date = ?, exercise = ?, weight = ?, reps = ?, note = ?
+        WHERE id = ?
+    ''', [(m.user_id, m.date, m.exercise, m.weight, m.reps, m.note, m.id) for m in found])
+    refresh_memo_analytics(cursor, set(old.values()) | {(m.user_id, m.exercise, m.date) for m in found})
+    conn.commit()
+    conn.close()
+    return {
+        "message": f"{len(found)}件のメモを更新しました",
+        "ids": [m.id for m in found],
+        "not_found": [m.id for m in memos if m.id not in old],
+    }
+
+@app.delete("/memo/batch")
+def delete_memos(ids: List[int] = Body(...)):
+    check_memo_batch(ids)
+    conn = get_db()
+    cursor = conn.cursor()
+    old = fetch_memo_keys(cursor, set(ids))
+    cursor.executemany("DELETE FROM memos WHERE id = ?", [(memo_id,) for memo_id in old])
+    refresh_memo_analytics(cursor, set(old.values()))
+    conn.commit()
+    conn.close()
+    return {
+        "message": f"{len(old)}件のメモを削除しました",
+        "ids": list(old),
+        "not_found": [memo_id for memo_id in ids if memo_id not in old],
+    }
+
+# --- ページネーション ---
+# メモ一覧は (date, id) の降順でキーセットページネーションする。
+# OFFSETと違い、どれだけ深くスクロールしてもインデックス上の位置から page size 分だけ読む。
+MEMO_PAGE_SIZE = 50
+MEMO_PAGE_SIZE_MAX = 200
+
+def encode_cursor(date, row_id):
+    raw = json.dumps([date, row_id], ensure_ascii=False).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        date, row_id = json.loads(raw)
+        return date, int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="不正なカーソルです")
+
+def paginate_memos(db_cursor, query, conditions, values, limit, cursor):
+    """(date, id) 降順で1ページ分の行と、次ページ用の next_cursor を返す"""
+    conditions = list(conditions)
+    values = list(values)
+    if cursor:
+        after_date, after_id = decode_cursor(cursor)
+        conditions.append("(m.date, m.id) < (?, ?)")
+        values.extend([after_date, after_id])
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY m.date DESC, m.id DESC LIMIT ?"
+    values.append(limit + 1)
+
+    db_cursor.execute(query, values)
+    rows = db_cursor.fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][2], rows[-1][0])
+    return rows, next_cursor
+
+# --- 全文検索 ---
+# trigram トークナイザは3文字未満の語をインデックスで引けないため、短いクエリは LIKE にフォールバックする
+FTS_MIN_QUERY_LEN = 3
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_SIZE_MAX = 100
+
+def fts_phrase(text, column=None):
+    """入力をFTS5のフレーズとしてエスケープする（column 指定時はその列に限定）"""
+    phrase = '"' + text.replace('"', '""') + '"'
+    return f"{column} : {phrase}" if column else phrase
+
+def exercise_condition(exercise):
+    """種目名の部分一致条件 (memos m 用)"""
+    if len(exercise) >= FTS_MIN_QUERY_LEN:
+        return "m.id IN (SELECT rowid FROM memos_fts WHERE memos_fts MATCH ?)", fts_phrase(exercise, "exercise")
+    return "m.exercise LIKE ?", f"%{exercise}%"
+
+def memo_visibility_condition(viewer_id):
+    """閲覧者から見えるメモの条件 (memos m JOIN users u 用)
+
+    - 自分自身の投稿は無条件OK
+    - visibility='private' の他人の投稿は見えない
+    - visibility='friends' は「相互フォロー」の場合のみ閲覧可（相互フォローはソーシャルグラフから取得）
+    - それ以外 (public) は誰でも閲覧可
+
+    相互フォローの一覧は JSON 配列1つのパラメータで渡す。閲覧者ごとに SQL の形が変わらないので
+    ステートメントキャッシュが効き、人数が多くてもパラメータ数の上限に当たらない
+    """
+    condition = """(
+        m.user_id = ?
+        OR IFNULL(u.visibility, '') NOT IN ('private', 'friends')
+        OR (u.visibility = 'friends' AND m.user_id IN (SELECT value FROM json_each(?)))
+    )"""
+    return condition, [viewer_id, json.dumps(sorted(social_graph.mutuals(viewer_id)))]
+
 # メモ取得（検索にも対応）
 @app.get("/memo")
 def get_memos(
     id: Optional[int] = Query(None),
     user_id: Optional[str] = Query(None),
     date: Optional[str] = Query(None),
-    exercise: Optional[str] = Query(None)
+    exercise: Optional[str] = Query(None),
+    limit: int = Query(MEMO_PAGE_SIZE, ge=1, le=MEMO_PAGE_SIZE_MAX),
+    cursor: Optional[str] = Query(None, description="前ページの next_cursor")
 ):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    conn = get_db()
+    db_cursor = conn.cursor()
     conditions = []
     values = []
     
@@ -230,17 +1026,20 @@ def get_memos(
         conditions.append("m.user_id = ?")
         values.append(user_id)
     if date:
-        conditions.append("m.date LIKE ?")
-        values.append(f"%{date}")
+        normalized = normalize_date(date)
+        if normalized:
+            conditions.append("m.date = ?")
+            values.append(normalized)
+        else:
+            # 'YYYY-MM' などの部分指定は前方一致（保存形式は ISO-8601 なので年→月の順に並ぶ）
+            conditions.append("m.date LIKE ?")
+            values.append(f"{date}%")
     if exercise:
-        conditions.append("m.exercise LIKE ?")
-        values.append(f"%{exercise}%")
+        condition, value = exercise_condition(exercise)
+        conditions.append(condition)
+        values.append(value)
         
-    if conditions:
-        base_query += " WHERE " + " AND ".join(conditions)
-    
-    cursor.execute(base_query, values)
-    rows = cursor.fetchall()
+    rows, next_cursor = paginate_memos(db_cursor, base_query, conditions, values, limit, cursor)
     
     # メモリ上でフィルタリング（SQLだけで完結させるのは複雑なため）
     # current_user_id (閲覧者) がわかればSQLでできるが、GETパラメータに含める必要がある
@@ -266,7 +1065,7 @@ def get_memos(
     conn.close()
     
     # 整形して返す (visibility情報は落とすか、デバッグ用に残す)
-    return [
+    items = [
         {
             "id": row[0],
             "user_id": row[1],
@@ -279,29 +1078,31 @@ def get_memos(
         }
         for row in rows
     ]
+    return {"items": items, "next_cursor": next_cursor}
 
 @app.get("/memo_v2")
 def get_memos_v2(
     viewer_id: str = Query(..., description="閲覧しているユーザーID"),
     target_user: Optional[str] = Query(None, description="特定ユーザーで絞る場合"),
     filter_mode: str = Query("all", description="all:全員(権限あり), friends:フォロー中のみ, mine:自分のみ"),
-    exercise: Optional[str] = Query(None)
+    exercise: Optional[str] = Query(None),
+    date_from: Optional[str] = Query(None, alias="from", description="この日以降 (YYYY-MM-DD)"),
+    date_to: Optional[str] = Query(None, alias="to", description="この日以前 (YYYY-MM-DD)"),
+    limit: int = Query(MEMO_PAGE_SIZE, ge=1, le=MEMO_PAGE_SIZE_MAX),
+    cursor: Optional[str] = Query(None, description="前ページの next_cursor")
 ):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    # フォローしているユーザーリストを取得
-    cursor.execute("SELECT friend_id FROM friends WHERE user_id = ?", (viewer_id,))
-    following = {row[0] for row in cursor.fetchall()}
-    following.add(viewer_id) # 自分も含む
+    range_conditions, range_values = date_range_conditions("m.date", date_from, date_to)
+    conn = get_db()
+    db_cursor = conn.cursor()
     
+    # 公開範囲の判定を1つのSQLで行う（行ごとに friends を引き直さない）
     query = """
-        SELECT m.id, m.user_id, m.date, m.exercise, m.weight, m.reps, m.note, u.visibility 
+        SELECT m.id, m.user_id, m.date, m.exercise, m.weight, m.reps, m.note
         FROM memos m
         JOIN users u ON m.user_id = u.username
     """
-    conditions = []
-    values = []
+    visibility, values = memo_visibility_condition(viewer_id)
+    conditions = [visibility]
     
     # 1. ターゲットユーザー絞り込み
     if target_user:
@@ -313,88 +1114,125 @@ def get_memos_v2(
         conditions.append("m.user_id = ?")
         values.append(viewer_id)
     elif filter_mode == 'friends':
-        # フォローしている人のみ
-        placeholders = ','.join(['?'] * len(following))
-        conditions.append(f"m.user_id IN ({placeholders})")
-        values.extend(following)
+        # フォローしている人のみ（自分も含む）
+        following = social_graph.following(viewer_id)
+        following.add(viewer_id)
+        conditions.append("m.user_id IN (SELECT value FROM json_each(?))")
+        values.append(json.dumps(sorted(following)))
     
     # 3. その他検索
     if exercise:
-        conditions.append("m.exercise LIKE ?")
-        values.append(f"%{exercise}%")
-        
-    if conditions:
-        query += " WHERE " + " AND ".join(conditions)
+        condition, value = exercise_condition(exercise)
+        conditions.append(condition)
+        values.append(value)
+
+    # 4. 期間指定
+    conditions.extend(range_conditions)
+    values.extend(range_values)
         
-    cursor.execute(query, values)
-    rows = cursor.fetchall()
+    rows, next_cursor = paginate_memos(db_cursor, query, conditions, values, limit, cursor)
+    conn.close()
     
-    results = []
-    for row in rows:
-        m_id, m_uid, m_date, m_ex, m_w, m_r, m_n, u_vis = row
-        
-        # 権限チェック
-        # 自分自身の投稿は無条件OK
-        if m_uid == viewer_id:
-            results.append(dict(id=m_id, user_id=m_uid, date=m_date, exercise=m_ex, weight=m_w, reps=m_r, note=m_n))
-            continue
-            
-        # 他人の投稿
-        if u_vis == 'private':
-            continue
-        elif u_vis == 'friends':
-            # 投稿者(m_uid)が「フレンドのみ公開」にしている場合、
-            # 「投稿者にとってのフレンド」＝「閲覧者(viewer_id)が投稿者のフレンドリストにいるか」？
-            # それとも「相互フォロー」？ 
-            # 一般的には「Friend Only」は「My Friends (people I follow or mutual) can see」ではなく
-            # 「People who follow me can see」または「Mutual friends」。
-            # 今回はシンプルに「Follower Only」モデル（Twitterの鍵垢）と仮定すると、
-            # viewer_id が m_uid によって承認されている必要がある。
-            # しかし実装簡易化のため、「相互フォロー」または「自分が一方的にフォローしていればOK」とする？
-            # ユーザーの要望「フレンド機能を追加してフレンドのみ記録を見せることができたり」
-            # -> 「見せる」側が主語なので、「私をフォローしている人だけに見せる」または「相互」。
-            # ここでは「相手が自分をフォローしているか」をチェックすべきだが、
-            # 簡易的に「自分が相手をフォローしていれば見れる（Twitter公開垢）」＋「相手がFriendsOnlyなら相互必須」とするのが妥当。
-            
-            # 今回はもっと単純に:
-            # visibility='friends' -> 閲覧者が、投稿者のfriendsテーブル（follower）に含まれている必要がある。
-            # 逆(following)ではなく逆(follower)を取得してチェック。
-            cursor.execute("SELECT 1 FROM friends WHERE user_id = ? AND friend_id = ?", (viewer_id, m_uid))
-            # ここで user_id=viewer(自分), friend_id=target(相手) なら、自分が相手をフォローしている状態。
-            # 相手が「フレンド限定」の場合、「相手と友達（＝相手も自分を知っている）」必要があるか？
-            # 定義：「Friend Only」= 「相互フォローのみ閲覧可」としましょう。
-            
-            # 自分が相手をフォローしているか
-            is_following = m_uid in following
-            # 相手が自分をフォローしているか
-            cursor.execute("SELECT 1 FROM friends WHERE user_id = ? AND friend_id = ?", (m_uid, viewer_id))
-            is_followed_by = cursor.fetchone() is not None
-            
-            if is_following and is_followed_by:
-                results.append(dict(id=m_id, user_id=m_uid, date=m_date, exercise=m_ex, weight=m_w, reps=m_r, note=m_n))
-        else: # public
-            results.append(dict(id=m_id, user_id=m_uid, date=m_date, exercise=m_ex, weight=m_w, reps=m_r, note=m_n))
-            
+    items = [
+        dict(id=m_id, user_id=m_uid, date=m_date, exercise=m_ex, weight=m_w, reps=m_r, note=m_n)
+        for m_id, m_uid, m_date, m_ex, m_w, m_r, m_n in rows
+    ]
+    return {"items": items, "next_cursor": next_cursor}
+
+# 全文検索（メモは公開範囲でフィルタ、食事は本人の記録のみ）
+@app.get("/search")
+def search(
+    q: str = Query(..., min_length=1),
+    viewer_id: str = Query(..., description="閲覧しているユーザーID"),
+    kind: str = Query("memos", description="memos: トレーニング記録, meals: 食事記録"),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_PAGE_SIZE_MAX),
+    offset: int = Query(0, ge=0)
+):
+    q = q.strip()
+    if kind not in ('memos', 'meals'):
+        raise HTTPException(status_code=400, detail="kind は memos か meals を指定してください")
+    use_fts = len(q) >= FTS_MIN_QUERY_LEN
+
+    conn = get_db()
+    cursor = conn.cursor()
+    if kind == 'memos':
+        visibility, values = memo_visibility_condition(viewer_id)
+        if use_fts:
+            # bm25 は値が小さいほど関連度が高い
+            query = f"""
+                SELECT m.id, m.user_id, m.date, m.exercise, m.weight, m.reps, m.note, bm25(memos_fts) AS score
+                FROM memos_fts
+                JOIN memos m ON m.id = memos_fts.rowid
+                JOIN users u ON m.user_id = u.username
+                WHERE memos_fts MATCH ? AND {visibility}
+                ORDER BY score, m.id DESC
+                LIMIT ? OFFSET ?
+            """
+            values = [fts_phrase(q)] + values
+        else:
+            query = f"""
+                SELECT m.id, m.user_id, m.date, m.exercise, m.weight, m.reps, m.note, NULL AS score
+                FROM memos m
+                JOIN users u ON m.user_id = u.username
+                WHERE (m.exercise LIKE ? OR m.note LIKE ?) AND {visibility}
+                ORDER BY m.date DESC, m.id DESC
+                LIMIT ? OFFSET ?
+            """
+            values = [f"%{q}%", f"%{q}%"] + values
+        cursor.execute(query, values + [limit + 1, offset])
+        rows = cursor.fetchall()
+        items = [
+            dict(id=r[0], user_id=r[1], date=r[2], exercise=r[3], weight=r[4], reps=r[5], note=r[6], score=r[7])
+            for r in rows[:limit]
+        ]
+    else:
+        if use_fts:
+            query = """
+                SELECT me.id, me.date, me.meal_type, me.food_name, me.calories, me.protein, me.fat, me.carbs, bm25(meals_fts) AS score
+                FROM meals_fts
+                JOIN meals me ON me.id = meals_fts.rowid
+                WHERE meals_fts MATCH ? AND me.user_id = ?
+                ORDER BY score, me.id DESC
+                LIMIT ? OFFSET ?
+            """
+            values = [fts_phrase(q), viewer_id]
+        else:
+            query = """
+                SELECT id, date, meal_type, food_name, calories, protein, fat, carbs, NULL AS score
+                FROM meals
+                WHERE user_id = ? AND food_name LIKE ?
+                ORDER BY date DESC, id DESC
+                LIMIT ? OFFSET ?
+            """
+            values = [viewer_id, f"%{q}%"]
+        cursor.execute(query, values + [limit + 1, offset])
+        rows = cursor.fetchall()
+        items = [
+            {
+                "id": r[0], "date": r[1], "meal_type": r[2], "food_name": r[3],
+                "calories": r[4], "protein": r[5], "fat": r[6], "carbs": r[7], "score": r[8]
+            }
+            for r in rows[:limit]
+        ]
     conn.close()
-    return results
+
+    next_offset = offset + limit if len(rows) > limit else None
+    return {"items": items, "next_offset": next_offset}
 
 # --- Friend API ---
 
 @app.post("/friends")
 def add_friend(req: FriendRequest, current_user: str = Query(...)):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
     # 自分自身は追加できない
     if req.friend_username == current_user:
-         conn.close()
          raise HTTPException(status_code=400, detail="自分自身はフォローできません")
          
     # 相手が存在するかチェック
-    cursor.execute("SELECT 1 FROM users WHERE username = ?", (req.friend_username,))
-    if not cursor.fetchone():
-        conn.close()
+    if not social_graph.user_exists(req.friend_username):
         raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
 
+    conn = get_db()
+    cursor = conn.cursor()
     try:
         cursor.execute("INSERT INTO friends (user_id, friend_id) VALUES (?, ?)", (current_user, req.friend_username))
         # 通知を作成
@@ -405,36 +1243,33 @@ def add_friend(req: FriendRequest, current_user: str = Query(...)):
         pass # 既に登録済み
     finally:
         conn.close()
+    social_graph.follow(current_user, req.friend_username)
     return {"message": f"{req.friend_username} をフォローしました"}
 
 @app.delete("/friends/{friend_name}")
 def remove_friend(friend_name: str, current_user: str = Query(...)):
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM friends WHERE user_id = ? AND friend_id = ?", (current_user, friend_name))
     conn.commit()
     conn.close()
+    social_graph.unfollow(current_user, friend_name)
     return {"message": f"{friend_name} のフォローを解除しました"}
 
 @app.get("/friends")
 def get_friends(current_user: str = Query(...)):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
     # 自分がフォローしている人
-    cursor.execute("SELECT friend_id FROM friends WHERE user_id = ?", (current_user,))
-    following = [row[0] for row in cursor.fetchall()]
+    following = sorted(social_graph.following(current_user))
     
     # 自分をフォローしている人（フォロワー）
-    cursor.execute("SELECT user_id FROM friends WHERE friend_id = ?", (current_user,))
-    followers = [row[0] for row in cursor.fetchall()]
+    followers = sorted(social_graph.followers(current_user))
     
-    conn.close()
     return {"following": following, "followers": followers}
 
 # --- Notification API ---
 @app.get("/notifications")
 def get_notifications(current_user: str = Query(...)):
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         SELECT id, from_user, type, is_read, created_at 
@@ -457,7 +1292,7 @@ def get_notifications(current_user: str = Query(...)):
 
 @app.post("/notifications/read")
 def mark_notifications_read(current_user: str = Query(...)):
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("UPDATE notifications SET is_read = 1 WHERE user_id = ?", (current_user,))
     conn.commit()
@@ -470,7 +1305,7 @@ def update_visibility(settings: UserSettings, current_user: str = Query(...)):
     if settings.visibility not in ['public', 'friends', 'private']:
         raise HTTPException(status_code=400, detail="不正な設定値です")
         
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("UPDATE users SET visibility = ? WHERE username = ?", (settings.visibility, current_user))
     conn.commit()
@@ -479,7 +1314,7 @@ def update_visibility(settings: UserSettings, current_user: str = Query(...)):
 
 @app.get("/users/me")
 def get_my_info(current_user: str = Query(...)):
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("SELECT username, visibility, target_calories, target_protein, target_fat, target_carbs FROM users WHERE username = ?", (current_user,))
     row = cursor.fetchone()
@@ -497,7 +1332,7 @@ def get_my_info(current_user: str = Query(...)):
 
 @app.put("/settings/targets")
 def update_targets(targets: UserTargets, current_user: str = Query(...)):
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         UPDATE users 
@@ -510,7 +1345,7 @@ def update_targets(targets: UserTargets, current_user: str = Query(...)):
 
 @app.get("/users/search")
 def search_users(q: str = Query("")):
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     if q:
         cursor.execute("SELECT username FROM users WHERE username LIKE ? LIMIT 10", (f"%{q}%",))
@@ -522,29 +1357,63 @@ def search_users(q: str = Query("")):
 
 # --- Meal Management API ---
 
+# 日別集計 (daily_nutrition) の更新
+# 1日分の食事は (user_id, date) インデックスで数件しか読まないため、差分加算ではなくその日を再集計する
+# （浮動小数の誤差が積み重ならない）。meals を変更したのと同じトランザクション内で呼ぶこと。
+def refresh_daily_nutrition(cursor, user_id, date):
+    cursor.execute('''
+        SELECT COUNT(*), IFNULL(SUM(calories), 0), IFNULL(SUM(protein), 0), IFNULL(SUM(fat), 0), IFNULL(SUM(carbs), 0)
+        FROM meals WHERE user_id = ? AND date = ?
+    ''', (user_id, date))
+    count, calories, protein, fat, carbs = cursor.fetchone()
+    if count == 0:
+        cursor.execute("DELETE FROM daily_nutrition WHERE user_id = ? AND date = ?", (user_id, date))
+    else:
+        cursor.execute('''
+            INSERT OR REPLACE INTO daily_nutrition (user_id, date, calories, protein, fat, carbs, meal_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, date, calories, protein, fat, carbs, count))
+
+# その日の食事が変わったら、キャッシュ済みのアドバイスを捨てる
+def invalidate_daily_advice(cursor, user_id, date):
+    cursor.execute("DELETE FROM advice_cache WHERE user_id = ? AND date = ?", (user_id, date))
+
 @app.post("/meals")
 def add_meal(meal: Meal):
-    conn = sqlite3.connect(DB_FILE)
+    meal.date = require_date(meal.date)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         INSERT INTO meals (user_id, date, meal_type, food_name, calories, protein, fat, carbs)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
     ''', (meal.user_id, meal.date, meal.meal_type, meal.food_name, meal.calories, meal.protein, meal.fat, meal.carbs))
+    refresh_daily_nutrition(cursor, meal.user_id, meal.date)
+    invalidate_daily_advice(cursor, meal.user_id, meal.date)
     conn.commit()
     conn.close()
     return {"message": "食事を記録しました"}
 
 @app.get("/meals")
-def get_meals(user_id: str = Query(...), date: Optional[str] = Query(None)):
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+def get_meals(
+    user_id: str = Query(...),
+    date: Optional[str] = Query(None),
+    date_from: Optional[str] = Query(None, alias="from", description="この日以降 (YYYY-MM-DD)"),
+    date_to: Optional[str] = Query(None, alias="to", description="この日以前 (YYYY-MM-DD)")
+):
     query = "SELECT id, date, meal_type, food_name, calories, protein, fat, carbs FROM meals WHERE user_id = ?"
     params = [user_id]
     
     if date:
         query += " AND date = ?"
-        params.append(date)
+        params.append(require_date(date))
+    range_conditions, range_values = date_range_conditions("date", date_from, date_to)
+    for condition in range_conditions:
+        query += " AND " + condition
+    params.extend(range_values)
+    query += " ORDER BY date, id"
         
+    conn = get_db()
+    cursor = conn.cursor()
     cursor.execute(query, params)
     rows = cursor.fetchall()
     conn.close()
@@ -557,85 +1426,1134 @@ def get_meals(user_id: str = Query(...), date: Optional[str] = Query(None)):
         for r in rows
     ]
 
+# 日別の栄養合計と目標に対する達成率（週・月のグラフ用）
+@app.get("/meals/daily")
+def get_daily_nutrition(
+    user_id: str = Query(...),
+    date_from: Optional[str] = Query(None, alias="from", description="この日以降 (YYYY-MM-DD)"),
+    date_to: Optional[str] = Query(None, alias="to", description="この日以前 (YYYY-MM-DD)")
+):
+    query = "SELECT date, calories, protein, fat, carbs, meal_count FROM daily_nutrition WHERE user_id = ?"
+    params = [user_id]
+    range_conditions, range_values = date_range_conditions("date", date_from, date_to)
+    for condition in range_conditions:
+        query += " AND " + condition
+    params.extend(range_values)
+    query += " ORDER BY date"
+
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT target_calories, target_protein, target_fat, target_carbs FROM users WHERE username = ?", (user_id,))
+    target_row = cursor.fetchone() or (None, None, None, None)
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    conn.close()
+
+    targets = dict(zip(("calories", "protein", "fat", "carbs"), target_row))
+
+    def percent(value, target):
+        return round(value / target * 100, 1) if target else None
+
+    days = []
+    for d, calories, protein, fat, carbs, meal_count in rows:
+        totals = {"calories": calories, "protein": protein, "fat": fat, "carbs": carbs}
+        days.append({
+            "date": d,
+            **totals,
+            "meal_count": meal_count,
+            "percent": {k: percent(v, targets[k]) for k, v in totals.items()},
+        })
+    return {"targets": targets, "days": days}
+
 @app.delete("/meals/{meal_id}")
 def delete_meal(meal_id: int):
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
+    cursor.execute("SELECT user_id, date FROM meals WHERE id = ?", (meal_id,))
+    row = cursor.fetchone()
     cursor.execute("DELETE FROM meals WHERE id = ?", (meal_id,))
+    if row:
+        refresh_daily_nutrition(cursor, row[0], row[1])
+        invalidate_daily_advice(cursor, row[0], row[1])
     conn.commit()
     conn.close()
     return {"message": "削除しました"}
 
+# --- LLM クライアント ---
+# Gemini 呼び出しは非同期で行い、スレッドプールを占有しないようにする。
+# モデル（と内部のトランスポート）は1つを使い回し、1回ごとの期限と全体の同時実行数の上限を設ける。
+# 同じプロンプトが処理中であれば上流への呼び出しは1回にまとめる (single-flight)。
+# 上流は LLM_BACKEND で切り替える: gemini（既定）/ fake（キー・ネットワーク不要の負荷試験用スタブ）
+GEMINI_MODEL_NAME = 'gemini-1.5-flash'
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "gemini")
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "20"))              # 1回の呼び出しの期限（秒）
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "8"))  # 上流への同時呼び出し数
+
+# サーキットブレーカー: 直近の呼び出しの失敗率（遅すぎる呼び出しも失敗と数える）が閾値を超えたら開き、
+# しばらくは上流を呼ばずに即座に CircuitOpenError を返す。冷却後は半開にして少数の試行で回復を確かめる。
+LLM_BREAKER_WINDOW = 20           # 失敗率を見る直近の呼び出し数
+LLM_BREAKER_MIN_CALLS = 5         # これ未満の呼び出し数では開かない
+LLM_BREAKER_ERROR_RATE = 0.5
+LLM_BREAKER_SLOW_CALL = LLM_TIMEOUT / 2
+LLM_BREAKER_COOLDOWN = 30.0       # 開いてから半開にするまでの秒数
+LLM_BREAKER_PROBES = 1            # 半開状態で同時に通す呼び出し数
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, window=LLM_BREAKER_WINDOW, min_calls=LLM_BREAKER_MIN_CALLS, error_rate=LLM_BREAKER_ERROR_RATE,
+                 slow_call=LLM_BREAKER_SLOW_CALL, cooldown=LLM_BREAKER_COOLDOWN, probes=LLM_BREAKER_PROBES):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.cooldown = cooldown
+        self.probes = probes
+        self.state = "closed"
+        self._outcomes = deque(maxlen=window)  # (成功したか, 所要秒数)
+        self._opened_at = 0.0
+        self._probing = 0
+        self._round = 0  # 半開にした回数。試行トークンとして使い、前の回の試行が今の状態を動かさないようにする
+        self.rejected = 0
+        self.opened = 0
+
+    def before_call(self):
+        """呼び出してよければ試行トークンを返す（半開状態での試行ならその回の番号、閉じていれば None）。
+        開いている間は CircuitOpenError。トークンは呼び出しが終わるまで持ち、record() か abandon() に渡す"""
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.cooldown:
+                self.rejected += 1
+                raise CircuitOpenError("LLM circuit is open")
+            self.state = "half_open"
+            self._round += 1
+            self._probing = 0
+        if self.state == "half_open":
+            if self._probing >= self.probes:
+                self.rejected += 1
+                raise CircuitOpenError("LLM circuit is half-open")
+            self._probing += 1
+            return self._round
+        return None
+
+    def _is_current_probe(self, probe):
+        return probe is not None and self.state == "half_open" and probe == self._round
+
+    def record(self, ok, latency, probe=None):
+        failed = not ok or latency > self.slow_call
+        if probe is not None:
+            # 半開状態を閉じる・開き直すのは、その回の試行トークンを持つ呼び出しだけ
+            if self._is_current_probe(probe):
+                self._probing -= 1
+                if failed:
+                    self._open()
+                else:
+                    self.state = "closed"
+                    self._outcomes.clear()
+            return
+        if self.state != "closed":
+            return  # 閉じている間に始まり、開いた後に終わった呼び出しは判定に使わない
+        self._outcomes.append((not failed, latency))
+        if len(self._outcomes) >= self.min_calls and self._failure_rate() >= self.error_rate:
+            self._open()
+
+    def abandon(self, probe=None):
+        """結果を見ずに終わった呼び出し（クライアントの切断、セマフォ待ち中のキャンセルなど）"""
+        if self._is_current_probe(probe):
+            self._probing -= 1
+
+    def _open(self):
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self.opened += 1
+
+    def _failure_rate(self):
+        return sum(1 for ok, _ in self._outcomes if not ok) / len(self._outcomes)
+
+    def stats(self):
+        latencies = sorted(latency for _, latency in self._outcomes)
+        return {
+            "state": self.state,
+            "error_rate": round(self._failure_rate(), 3) if self._outcomes else None,
+            "latency_p50": round(latencies[len(latencies) // 2], 3) if latencies else None,
+            "latency_p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3) if latencies else None,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
+
+class GeminiBackend:
+    name = "gemini"
+    label = "Gemini AI (1.5-flash)"
+
+    def __init__(self, model_name=GEMINI_MODEL_NAME):
+        self.model_name = model_name
+        self._model = None
+
+    @property
+    def available(self):
+        return bool(GEMINI_API_KEY)
+
+    def _get_model(self):
+        if self._model is None:
+            self._model = genai.GenerativeModel(self.model_name)
+        return self._model
+
+    async def generate(self, prompt, timeout):
+        response = await self._get_model().generate_content_async(prompt, request_options={"timeout": timeout})
+        return response.text
+
+    async def stream(self, prompt, timeout):
+        response = await self._get_model().generate_content_async(prompt, stream=True, request_options={"timeout": timeout})
+        async for chunk in response:
+            yield chunk.text
+
+class FakeLLMBackend:
+    """Gemini の代わりに決まった応答を返すスタブ。遅延・エラー率は環境変数で調整する
+    LLM_FAKE_LATENCY_MS（平均遅延）, LLM_FAKE_JITTER_MS（±の揺らぎ）, LLM_FAKE_ERROR_RATE（0-1）,
+    LLM_FAKE_RESPONSES（{"nutrition": {...}, "advice": "..."} 形式のJSONファイル、省略時は既定の応答）"""
+    name = "fake"
+    label = "Fake LLM"
+    available = True
+
+    DEFAULT_RESPONSES = {
+        "nutrition": {
+            "food_name": "テスト料理 (1人前)",
+            "calories": 500,
+            "protein": 25.0,
+            "fat": 15.0,
+            "carbs": 60.0,
+            "breakdown": "スタブの固定値です",
+            "advice": "スタブの固定値です",
+        },
+        "advice": "スタブのアドバイスです。タンパク質をもう少し増やしましょう。",
+    }
+
+    def __init__(self, latency_ms=None, jitter_ms=None, error_rate=None, responses=None):
+        env = os.environ.get
+        self.latency = float(env("LLM_FAKE_LATENCY_MS", "800") if latency_ms is None else latency_ms) / 1000
+        self.jitter = float(env("LLM_FAKE_JITTER_MS", "400") if jitter_ms is None else jitter_ms) / 1000
+        self.error_rate = float(env("LLM_FAKE_ERROR_RATE", "0") if error_rate is None else error_rate)
+        if responses is None and env("LLM_FAKE_RESPONSES"):
+            with open(env("LLM_FAKE_RESPONSES"), encoding="utf-8") as f:
+                responses = json.load(f)
+        self.responses = {**self.DEFAULT_RESPONSES, **(responses or {})}
+        self._random = random.Random()
+
+    FIRST_TOKEN_SHARE = 0.2  # ストリーミング時、遅延のうち最初の断片が届くまでの割合
+    STREAM_CHUNK_CHARS = 8
+
+    def _sample_latency(self):
+        return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def _respond(self, prompt):
+        if self._random.random() < self.error_rate:
+            raise RuntimeError("fake LLM error")
+        batch = re.search(r"件数: (\d+)", prompt)
+        if batch:
+            return json.dumps([self.responses["nutrition"]] * int(batch.group(1)), ensure_ascii=False)
+        if "JSON形式" in prompt:
+            return json.dumps(self.responses["nutrition"], ensure_ascii=False)
+        return self.responses["advice"]
+
+    async def generate(self, prompt, timeout):
+        await asyncio.sleep(self._sample_latency())
+        return self._respond(prompt)
+
+    async def stream(self, prompt, timeout):
+        latency = self._sample_latency()
+        await asyncio.sleep(latency * self.FIRST_TOKEN_SHARE)
+        text = self._respond(prompt)
+        chunks = [text[i:i + self.STREAM_CHUNK_CHARS] for i in range(0, len(text), self.STREAM_CHUNK_CHARS)]
+        for chunk in chunks:
+            yield chunk
+            await asyncio.sleep(latency * (1 - self.FIRST_TOKEN_SHARE) / len(chunks))
+
+LLM_BACKENDS = {"gemini": GeminiBackend, "fake": FakeLLMBackend}
+
+class LLMClient:
+    def __init__(self, backend, timeout=LLM_TIMEOUT, max_concurrency=LLM_MAX_CONCURRENCY):
+        self.backend = backend
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._inflight = {}  # prompt -> asyncio.Task
+        self.calls = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.breaker = CircuitBreaker()
+
+    @property
+    def available(self):
+        return self.backend.available
+
+    async def _acquire(self, deadline):
+        """期限までにセマフォを取る。混雑で取れないまま期限が来たら asyncio.TimeoutError
+        （上流は呼んでいないので、ブレーカーの失敗には数えない）"""
+        try:
+            async with asyncio.timeout_at(deadline):
+                await self._semaphore.acquire()
+        except TimeoutError:
+            self.timeouts += 1
+            raise
+
+    async def _call(self, prompt, timeout):
+        # ブレーカーが開いていればセマフォで待たせずに失敗させる。
+        # 期限はセマフォ待ちを含めた呼び出し全体にかける。
+        # 試行トークンもセマフォ待ちを含めて持ち、どう終わっても finally で返す
+        probe = self.breaker.before_call()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        outcome = None  # (成功したか, 所要秒数)。None のまま終わったら結果を見ていない
+        try:
+            await self._acquire(deadline)
+            try:
+                self.calls += 1
+                start = loop.time()
+                remaining = max(0.0, deadline - start)
+                try:
+                    result = await asyncio.wait_for(self.backend.generate(prompt, remaining), remaining)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    outcome = (False, loop.time() - start)
+                    raise
+                except Exception:
+                    self.errors += 1
+                    outcome = (False, loop.time() - start)
+                    raise
+                outcome = (True, loop.time() - start)
+                return result
+            finally:
+                self._semaphore.release()
+        finally:
+            if outcome is None:
+                self.breaker.abandon(probe)
+            else:
+                self.breaker.record(*outcome, probe=probe)
+
+    async def generate(self, prompt, timeout=None):
+        """プロンプトを送り、応答テキストを返す。期限切れは asyncio.TimeoutError"""
+        task = self._inflight.get(prompt)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self._call(prompt, timeout or self.timeout))
+            self._inflight[prompt] = task
+            task.add_done_callback(lambda _: self._inflight.pop(prompt, None))
+        # 待っている側がキャンセルされても、他の待機者のために上流の呼び出しは続ける
+        return await asyncio.shield(task)
+
+    async def stream(self, prompt, timeout=None):
+        """応答を生成されたそばからテキスト片で返す。期限は最初の断片からではなく、セマフォ待ちを含む呼び出し全体にかける。
+        各接続へ逐次転送するため single-flight の対象にはしない"""
+        timeout = timeout or self.timeout
+        loop = asyncio.get_running_loop()
+        probe = self.breaker.before_call()
+        deadline = loop.time() + timeout
+        outcome = None
+        try:
+            await self._acquire(deadline)
+            try:
+                self.calls += 1
+                start = loop.time()
+                chunks = self.backend.stream(prompt, max(0.0, deadline - start))
+                try:
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), max(0.0, deadline - loop.time()))
+                        except StopAsyncIteration:
+                            break
+                        yield chunk
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    outcome = (False, loop.time() - start)
+                    raise
+                except Exception:
+                    self.errors += 1
+                    outcome = (False, loop.time() - start)
+                    raise
+                else:
+                    outcome = (True, loop.time() - start)
+                finally:
+                    await chunks.aclose()
+            finally:
+                self._semaphore.release()
+        finally:
+            if outcome is None:
+                self.breaker.abandon(probe)
+            else:
+                self.breaker.record(*outcome, probe=probe)
+
+    def stats(self):
+        return {
+            "backend": self.backend.name,
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "in_flight": len(self._inflight),
+            "breaker": self.breaker.stats(),
+        }
+
+if LLM_BACKEND not in LLM_BACKENDS:
+    raise RuntimeError(f"不明な LLM_BACKEND です: {LLM_BACKEND}")
+llm_client = LLMClient(LLM_BACKENDS[LLM_BACKEND]())
+
+# --- 栄養推定キャッシュ ---
+# 同じ食品名（「鶏むね肉 100g」「ご飯 茶碗1杯」など）が繰り返し入力されるため、Geminiの結果をキャッシュする。
+# 1段目: プロセス内の LRU (TTL付き)、2段目: SQLite の nutrition_cache テーブル（再起動後も有効）。
+NUTRITION_CACHE_SIZE = 2048                 # メモリ上の最大件数
+NUTRITION_CACHE_TTL = 30 * 24 * 3600        # 30日
+NUTRITION_CACHE_DB_MAX_ROWS = 100000        # SQLite側の最大件数（超えたら古いものから削除）
+NUTRITION_CACHE_PURGE_INTERVAL = 500        # この回数の書き込みごとに期限切れ・超過分を掃除する
+
+def normalize_food_text(text):
+    """キャッシュキー用の正規化: NFKC（全角英数字・記号を半角に）、空白除去、小文字化"""
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", "", text).lower()
+
+class NutritionCache:
+    def __init__(self, capacity=NUTRITION_CACHE_SIZE, ttl=NUTRITION_CACHE_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._items = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remember(self, key, value, expires_at):
+        with self._lock:
+            self._items[key] = (expires_at, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, key):
+        value = self.get_memory(key)
+        return value if value is not None else self.get_stored(key)
+
+    def get_memory(self, key):
+        """メモリ上のLRUだけを見る（DBに触れないのでイベントループ上でそのまま呼べる）"""
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            if entry[0] > time.time():
+                self._items.move_to_end(key)
+                self.memory_hits += 1
+                return dict(entry[1])
+            del self._items[key]
+            return None
+
+    def get_stored(self, key):
+        """SQLite の永続キャッシュを見て、あればメモリにも載せる"""
+        now = time.time()
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT response, created_at FROM nutrition_cache WHERE key = ? AND created_at > ?", (key, now - self.ttl))
+        row = cursor.fetchone()
+        conn.close()
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        value = json.loads(row[0])
+        self._remember(key, value, row[1] + self.ttl)
+        with self._lock:
+            self.db_hits += 1
+        return dict(value)
+
+    def put(self, key, value):
+        now = time.time()
+        self._remember(key, dict(value), now + self.ttl)
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("INSERT OR REPLACE INTO nutrition_cache (key, response, created_at) VALUES (?, ?, ?)",
+                       (key, json.dumps(value, ensure_ascii=False), now))
+        with self._lock:
+            self._writes += 1
+            purge = self._writes % NUTRITION_CACHE_PURGE_INTERVAL == 0
+        if purge:
+            cursor.execute("DELETE FROM nutrition_cache WHERE created_at <= ?", (now - self.ttl,))
+            cursor.execute('''
+                DELETE FROM nutrition_cache WHERE created_at < (
+                    SELECT created_at FROM nutrition_cache ORDER BY created_at DESC LIMIT 1 OFFSET ?
+                )
+            ''', (NUTRITION_CACHE_DB_MAX_ROWS - 1,))
+        conn.commit()
+        conn.close()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.db_hits + self.misses
+            return {
+                "size": len(self._items),
+                "capacity": self.capacity,
+                "memory_hits": self.memory_hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round((self.memory_hits + self.db_hits) / lookups, 3) if lookups else None,
+            }
+
+nutrition_cache = NutritionCache()
+
+# --- ローカル食品DB ---
+# よく入力される食品は food_db.json（100gあたりの kcal / P / F / C と単位重量）から即座に計算し、
+# 一致度が低いものだけ Gemini に問い合わせる。オフラインでも動作する。
+FOOD_DB_FILE = "food_db.json"
+FOOD_MATCH_CONFIDENT = 0.8   # これ以上ならGeminiを呼ばずにローカルの値を返す
+FOOD_MATCH_FALLBACK = 0.65   # Geminiが使えない場合はこれ以上の一致度で代用する
+
+KANJI_NUMBERS = {"一": 1, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9, "十": 10, "半": 0.5}
+QUANTITY_PATTERN = re.compile(
+    r"(\d+(?:\.\d+)?|[一二三四五六七八九十半])"
+    r"(kg|g|グラム|ml|cc|l|杯|膳|個|枚|本|切れ|切|人前|食|皿|パック|缶|玉|丁|貫|粒|袋|房|斤|スクープ|カップ)"
+)
+PORTION_WORDS = {"特盛": 2.0, "大盛り": 1.5, "大盛": 1.5, "小盛り": 0.7, "小盛": 0.7, "半分": 0.5, "ハーフ": 0.5}
+VESSEL_WORDS = re.compile(r"お?茶碗|どんぶり|丼ぶり|コップ|グラス|マグ|約|くらい|ぐらい|程度")
+SERVING_UNITS = {"人前", "食", "皿"}
+
+def parse_food_quantity(text):
+    """正規化済みの入力から分量を取り出す。(食品名部分, グラム数, 単位, 個数, 倍率) を返す"""
+    grams = None
+    unit = None
+    count = 1.0
+    multiplier = 1.0
+    for word, factor in PORTION_WORDS.items():
+        if word in text:
+            multiplier *= factor
+            text = text.replace(word, "")
+    match = QUANTITY_PATTERN.search(text)
+    if match:
+        raw, unit = match.groups()
+        count = KANJI_NUMBERS[raw] if raw in KANJI_NUMBERS else float(raw)
+        text = text[:match.start()] + text[match.end():]
+        if unit in ("g", "グラム", "ml", "cc"):
+            grams, unit = count, None
+        elif unit == "kg" or unit == "l":
+            grams, unit = count * 1000, None
+    text = VESSEL_WORDS.sub("", text)
+    text = re.sub(r"[()\[\]（）「」、,・/×*]+", "", text)
+    return text, grams, unit, count, multiplier
+
+def char_bigrams(text):
+    """前後に境界記号を付けた文字bigram（1文字の食品名も照合できるように）"""
+    padded = f"^{text}$"
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+class FoodMatcher:
+    def __init__(self, foods):
+        self.foods = foods
+        self._keys = []                   # (照合キー, bigram集合, foods内の添字)
+        self._index = defaultdict(set)    # bigram -> _keys内の添字
+        for food_idx, food in enumerate(foods):
+            for name in [food["name"]] + food.get("aliases", []):
+                key, _, _, _, _ = parse_food_quantity(normalize_food_text(name))
+                if not key:
+                    continue
+                bigrams = char_bigrams(key)
+                for gram in bigrams:
+                    self._index[gram].add(len(self._keys))
+                self._keys.append((key, bigrams, food_idx))
+
+        # 別名を正式名に置き換えるための表（長い別名を優先する）
+        canonical = {}
+        for key, _, food_idx in self._keys:
+            canonical.setdefault(food_idx, key)
+        self._canonical = {key: canonical[food_idx] for key, _, food_idx in self._keys if len(key) >= 2}
+        aliases = sorted((key for key, name in self._canonical.items() if key != name), key=len, reverse=True)
+        self._alias_pattern = re.compile("|".join(map(re.escape, aliases))) if aliases else None
+
+    @classmethod
+    def load(cls, path=FOOD_DB_FILE):
+        if not os.path.exists(path):
+            print(f"Food DB not found: {path}")
+            return cls([])
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def canonicalize(self, name):
+        """食品名に含まれる別名（「鶏胸肉」「ささみ」など）を正式名に置き換える"""
+        if self._alias_pattern is None:
+            return name
+        return self._alias_pattern.sub(lambda m: self._canonical[m.group(0)], name)
+
+    def match(self, name):
+        """最も近い食品と一致度(0-1)を返す。一致度は bigram の Dice 係数と、部分一致なら長さの比率の大きい方"""
+        if not name:
+            return None, 0.0
+        query = char_bigrams(name)
+        candidates = set()
+        for gram in query:
+            candidates |= self._index.get(gram, set())
+        best, best_score = None, 0.0
+        for key_idx in candidates:
+            key, bigrams, food_idx = self._keys[key_idx]
+            if key == name:
+                return self.foods[food_idx], 1.0
+            score = 2 * len(query & bigrams) / (len(query) + len(bigrams))
+            if key in name:
+                score = max(score, len(key) / len(name))
+            if score > best_score:
+                best, best_score = self.foods[food_idx], score
+        return best, best_score
+
+    def estimate(self, text):
+        """入力文から栄養素を計算する。該当する食品がなければ None"""
+        name, grams, unit, count, multiplier = parse_food_quantity(normalize_food_text(text))
+        food, confidence = self.match(name)
+        if food is None:
+            return None
+        if grams is None:
+            unit_grams = food["units"].get(unit) if unit else None
+            if unit_grams is None:
+                # 食品に登録のない単位（「1食」「1皿」など）は1人前として扱う
+                unit_grams = food["serving"]
+                if unit and unit not in SERVING_UNITS:
+                    confidence *= 0.9
+            grams = unit_grams * (count if unit else 1)
+        grams *= multiplier
+        kcal, protein, fat, carbs = food["per100g"]
+        ratio = grams / 100
+        amount = f"{grams:g}g" if grams < 100 else f"{round(grams):d}g"
+        return {
+            "food_name": f"{food['name']} ({amount})",
+            "calories": int(round(kcal * ratio)),
+            "protein": round(protein * ratio, 1),
+            "fat": round(fat * ratio, 1),
+            "carbs": round(carbs * ratio, 1),
+            "breakdown": f"{food['name']} {amount}として計算（100gあたり {kcal}kcal, P:{protein}g, F:{fat}g, C:{carbs}g）",
+            "advice": "",
+            "source": "ローカル食品DB",
+            "confidence": round(confidence, 2),
+        }
+
+food_matcher = FoodMatcher.load()
+
+# --- 類似入力キャッシュ ---
+# 「鶏むね肉のソテー 200g」と「鶏むね肉ソテー 100g」のように表記だけが違う入力を、過去の推定結果から答える。
+# 入力の食品名部分を文字 n-gram の出現回数ベクトル（特徴ハッシュで次元を固定）にし、
+# int8 に量子化して列優先の memmap に保存する。IDF は登録時ではなく検索時の文書頻度でかけるので、
+# キャッシュが育ってもスコアの基準がずれない。クエリのベクトルは疎なので、非ゼロ次元の行だけを読んで候補を絞り、
+# 上位の候補だけ列を読んで TF-IDF のコサイン類似度を正確に計算する。
+# 一致した過去の結果は、分量の比（100g → 200g、1杯 → 2杯 など）で拡大縮小して返す。
+# ファイルは（相対パスなら）DBと同じディレクトリに置く
+SEMANTIC_CACHE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(DB_FILE)), os.environ.get("SEMANTIC_CACHE_FILE", "nutrition_vectors.i8")
+)
+SEMANTIC_CACHE_DIM = 512
+SEMANTIC_CACHE_CAPACITY = 100000    # 超えたら古いものから上書き（リングバッファ）
+SEMANTIC_CACHE_THRESHOLD = 0.8      # コサイン類似度がこれ以上なら同じ食品とみなす
+SEMANTIC_NGRAM_SIZES = (1, 2, 3)
+SEMANTIC_QUANT_SCALE = 127
+SEMANTIC_RERANK = 16                # 正確に採点し直す候補数
+
+def semantic_features(name):
+    """食品名を (ハッシュ次元の配列, 出現回数の配列) にする"""
+    padded = f"^{name}$"
+    counts = defaultdict(int)
+    for n in SEMANTIC_NGRAM_SIZES:
+        for i in range(len(padded) - n + 1):
+            gram = padded[i:i + n]
+            if gram not in ("^", "$"):
+                counts[zlib.crc32(gram.encode("utf-8")) % SEMANTIC_CACHE_DIM] += 1
+    dims = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    tf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+    order = np.argsort(dims)
+    return dims[order], tf[order]
+
+def quantity_ratio(query, source):
+    """同じ食品の分量の比（query / source）。グラムと「杯」のように比べられない組み合わせなら None"""
+    q_grams, q_unit, q_count, q_multiplier = query
+    s_grams, s_unit, s_count, s_multiplier = source
+    if q_grams is not None and s_grams is not None:
+        ratio = q_grams / s_grams
+    elif q_grams is None and s_grams is None and q_unit == s_unit:
+        ratio = q_count / s_count
+    else:
+        return None
+    return ratio * q_multiplier / s_multiplier
+
+class SemanticNutritionCache:
+    def __init__(self, path=SEMANTIC_CACHE_FILE, dim=SEMANTIC_CACHE_DIM, capacity=SEMANTIC_CACHE_CAPACITY):
+        self.path = path
+        self.dim = dim
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._df = None        # 次元ごとの文書頻度（IDF用）
+        self._count = 0        # 登録済みの件数
+        self._next_slot = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM semantic_cache")
+        count = cursor.fetchone()[0]
+        cursor.execute("SELECT slot FROM semantic_cache ORDER BY created_at DESC LIMIT 1")
+        last = cursor.fetchone()
+        size = self.dim * self.capacity
+        if count and os.path.exists(self.path) and os.path.getsize(self.path) == size:
+            self._vectors = np.memmap(self.path, dtype=np.int8, mode="r+", shape=(self.dim, self.capacity))
+        else:
+            # ファイルとテーブルの対応が取れないときは作り直す
+            cursor.execute("DELETE FROM semantic_cache")
+            conn.commit()
+            count, last = 0, None
+            self._vectors = np.memmap(self.path, dtype=np.int8, mode="w+", shape=(self.dim, self.capacity))
+        conn.close()
+        self._count = count
+        self._next_slot = (last[0] + 1) % self.capacity if last else 0
+        self._df = np.count_nonzero(self._vectors, axis=1).astype(np.float32)
+
+    def _ensure_loaded(self):
+        if self._vectors is None:
+            self._load()
+
+    def _idf(self, dims=slice(None)):
+        return np.log((1 + self._count) / (1 + self._df[dims])) + 1
+
+    def _similar_slot(self, name):
+        """最も似ている登録済みエントリの (slot, コサイン類似度)"""
+        dims, tf = semantic_features(name)
+        idf = self._idf(dims)
+        query = tf * idf
+        query /= np.linalg.norm(query)
+        # 保存側の TF にも IDF をかけた内積で候補を選び（保存側のノルムは未補正）、上位だけ正確に採点し直す
+        rough = (query * idf) @ self._vectors[dims].astype(np.float32)
+        top = min(SEMANTIC_RERANK, self._count)
+        candidates = np.argpartition(-rough, top - 1)[:top]
+        candidates = candidates[rough[candidates] > 0]
+        if len(candidates) == 0:
+            return None, 0.0
+        stored = self._vectors[:, candidates].astype(np.float32) * self._idf()[:, None]
+        norms = np.linalg.norm(stored, axis=0)
+        scores = (query @ stored[dims]) / norms
+        best = int(np.argmax(scores))
+        return int(candidates[best]), min(1.0, float(scores[best]))  # 量子化誤差で1をわずかに超えることがある
+
+    @staticmethod
+    def _parse(text):
+        name, grams, unit, count, multiplier = parse_food_quantity(normalize_food_text(text))
+        return food_matcher.canonicalize(name), (grams, unit, count, multiplier)
+
+    def lookup(self, text):
+        """類似した過去の入力があれば、分量を合わせた推定結果を返す。なければ None"""
+        name, quantity = self._parse(text)
+        if not name:
+            return None
+        # スロットの選択と行の読み出しは同じロックの中で行う（間に add() が同じスロットを上書きしないように）
+        with self._lock:
+            self._ensure_loaded()
+            slot, similarity = self._similar_slot(name) if self._count else (None, 0.0)
+            row = None
+            if similarity >= SEMANTIC_CACHE_THRESHOLD:
+                conn = get_db()
+                cursor = conn.cursor()
+                cursor.execute("SELECT input, response, quantity FROM semantic_cache WHERE slot = ?", (slot,))
+                row = cursor.fetchone()
+                conn.close()
+            ratio = quantity_ratio(quantity, tuple(json.loads(row[2]))) if row else None
+            if ratio is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        result = json.loads(row[1])
+        if ratio != 1:
+            result["food_name"] = f"{result['food_name']} ×{ratio:.2g}"
+            result["calories"] = int(round(result["calories"] * ratio))
+            for key in ("protein", "fat", "carbs"):
+                result[key] = round(result[key] * ratio, 1)
+        result["similar_to"] = row[0]
+        result["similarity"] = round(similarity, 3)
+        return result
+
+    def add(self, text, result):
+        name, quantity = self._parse(text)
+        if not name:
+            return
+        dims, tf = semantic_features(name)
+        with self._lock:
+            self._ensure_loaded()
+            slot = self._next_slot
+            column = self._vectors[:, slot]
+            if self._count == self.capacity:
+                # 上書きされるエントリの分を文書頻度から引く
+                self._df -= (column != 0)
+            else:
+                self._count += 1
+            column[:] = 0
+            column[dims] = np.round(tf / np.linalg.norm(tf) * SEMANTIC_QUANT_SCALE).astype(np.int8)
+            self._df[dims] += 1
+            self._next_slot = (slot + 1) % self.capacity
+            conn = get_db()
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO semantic_cache (slot, input, response, quantity, created_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (slot, text, json.dumps(result, ensure_ascii=False), json.dumps(quantity), time.time()))
+            conn.commit()
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {"size": self._count, "capacity": self.capacity, "hits": self.hits, "misses": self.misses}
+
+semantic_cache = SemanticNutritionCache()
+
+def remember_nutrition(text, result):
+    """LLMの推定結果を完全一致キャッシュと類似入力キャッシュの両方に登録する"""
+    nutrition_cache.put(normalize_food_text(text), result)
+    semantic_cache.add(text, result)
+
+@app.get("/api/estimate_nutrition/stats")
+def get_nutrition_cache_stats():
+    return {**nutrition_cache.stats(), "semantic": semantic_cache.stats(), "llm": llm_client.stats()}
+
+# --- SSE ---
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def sse_event(data, event=None):
+    payload = json.dumps(data, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
+
+# --- 栄養推定 ---
+NUTRITION_TEXT_FIELDS = ("food_name", "breakdown", "advice")
+NUTRITION_NUMBER_FIELDS = ("calories", "protein", "fat", "carbs")
+
+def build_nutrition_prompt(text):
+    return f"""
+    栄養士として、以下の食事の栄養素（カロリー、タンパク質、脂質、炭水化物）を精密に推定してください。
+    入力: "{text}"
+
+    指示:
+    1. 日本語で回答してください。
+    2. 一般的な1人前の量を基準にしてください。
+    3. 数値は推定値ですが、栄養士としてできるだけ正確な数値を考えてください。
+    4. 栄養バランスに関する「アドバイス」と、なぜその数値になったかの「内訳（推定根拠）」も含めてください。
+    5. 出力は以下のJSON形式のみとし、Markdown（```jsonなど）は一切含めないでください。
+
+    {{
+        "food_name": "料理名 (分量の目安)",
+        "calories": 数値(kcal),
+        "protein": 数値(g),
+        "fat": 数値(g),
+        "carbs": 数値(g),
+        "breakdown": "推定の根拠（例: ご飯200g、焼き鮭80gとして計算）",
+        "advice": "栄養士からのアドバイス（例: タンパク質は十分ですが、野菜が不足しています。サラダを追加すると良いでしょう）"
+    }}
+    """
+
+def parse_nutrition_response(raw_text, text):
+    # Markdownの除去（もし含まれていれば）
+    json_text = re.sub(r'```json\s*|\s*```|`', '', raw_text).strip()
+    
+    # JSON部分の抽出（余計なテキストが混ざる対策）
+    match = re.search(r'\{.*\}', json_text, re.DOTALL)
+    if match:
+        json_text = match.group(0)
+    
+    return nutrition_result(json.loads(json_text), text)
+
+def nutrition_result(data, text):
+    return {
+        "food_name": data.get("food_name", text),
+        "calories": int(data.get("calories", 0)),
+        "protein": float(data.get("protein", 0)),
+        "fat": float(data.get("fat", 0)),
+        "carbs": float(data.get("carbs", 0)),
+        "breakdown": data.get("breakdown", ""),
+        "advice": data.get("advice", ""),
+        "source": llm_client.backend.label
+    }
+
+def build_batch_nutrition_prompt(texts):
+    items = "\n".join(f'    {i}. "{text}"' for i, text in enumerate(texts, 1))
+    return f"""
+    栄養士として、以下の各食事の栄養素（カロリー、タンパク質、脂質、炭水化物）を精密に推定してください。
+    件数: {len(texts)}
+{items}
+
+    指示:
+    1. 日本語で回答してください。
+    2. 一般的な1人前の量を基準にしてください。
+    3. 数値は推定値ですが、栄養士としてできるだけ正確な数値を考えてください。
+    4. 出力は入力と同じ順番・同じ件数のJSON配列のみとし、Markdown（```jsonなど）は一切含めないでください。
+       各要素は以下の形式です。
+
+    [
+        {{
+            "food_name": "料理名 (分量の目安)",
+            "calories": 数値(kcal),
+            "protein": 数値(g),
+            "fat": 数値(g),
+            "carbs": 数値(g),
+            "breakdown": "推定の根拠（例: ご飯200g、焼き鮭80gとして計算）",
+            "advice": ""
+        }}
+    ]
+    """
+
+def parse_batch_nutrition_response(raw_text, texts):
+    json_text = re.sub(r'```json\s*|\s*```|`', '', raw_text).strip()
+    match = re.search(r'\[.*\]', json_text, re.DOTALL)
+    if match:
+        json_text = match.group(0)
+    data = json.loads(json_text)
+    if not isinstance(data, list) or len(data) != len(texts):
+        raise ValueError(f"件数が一致しません: {len(texts)}件に対して{len(data) if isinstance(data, list) else '不明'}")
+    return [nutrition_result(item, text) for item, text in zip(data, texts)]
+
+def parse_partial_nutrition(raw_text):
+    """生成途中のJSONから、値が確定したフィールドだけを取り出す"""
+    partial = {}
+    for key in NUTRITION_TEXT_FIELDS:
+        match = re.search(rf'"{key}"\s*:\s*"((?:[^"\\]|\\.)*)"', raw_text)
+        if match:
+            partial[key] = json.loads(f'"{match.group(1)}"')
+    for key in NUTRITION_NUMBER_FIELDS:
+        # 数値は後ろに区切りが来てから確定とみなす（"calories": 45 が 450 の途中かもしれない）
+        match = re.search(rf'"{key}"\s*:\s*(-?\d+(?:\.\d+)?)\s*[,}}\n]', raw_text)
+        if match:
+            value = float(match.group(1))
+            partial[key] = int(value) if key == "calories" else value
+    return partial
+
+# LLMが使えないとき（ブレーカーが開いている、失敗した、キーがない）の簡易推定。
+# 料理の種類を表す語から、一般的な1人前の値を返す。上から順に最初に当てはまったものを使う。
+DEGRADED_NUTRITION_RULES = [
+    # (キーワード, 種類, kcal, P, F, C)
+    (("丼",), "丼もの", 700, 25.0, 20.0, 100.0),
+    (("定食",), "定食", 750, 30.0, 25.0, 100.0),
+    (("弁当",), "弁当", 750, 25.0, 25.0, 105.0),
+    (("カレー",), "カレー", 750, 20.0, 25.0, 110.0),
+    (("ラーメン", "麺", "うどん", "そば", "パスタ"), "麺類", 550, 20.0, 15.0, 80.0),
+    (("サラダ",), "サラダ", 120, 4.0, 7.0, 10.0),
+    (("スープ", "汁"), "汁物", 60, 3.0, 2.0, 6.0),
+    (("ケーキ", "アイス", "スイーツ", "菓子"), "菓子類", 300, 4.0, 16.0, 35.0),
+    (("パン", "サンド"), "パン類", 300, 10.0, 12.0, 38.0),
+    (("焼き", "揚げ", "炒め", "煮", "ソテー", "フライ"), "おかず", 300, 18.0, 18.0, 12.0),
+]
+
+def degraded_nutrition_estimate(text):
+    normalized = normalize_food_text(text)
+    for keywords, category, calories, protein, fat, carbs in DEGRADED_NUTRITION_RULES:
+        if any(keyword in normalized for keyword in keywords):
+            return {
+                "food_name": f"{text} ({category}の1人前として概算)",
+                "calories": calories,
+                "protein": protein,
+                "fat": fat,
+                "carbs": carbs,
+                "breakdown": f"AIが一時的に利用できないため、「{category}」の一般的な1人前の値で概算しています",
+                "advice": "",
+                "source": "簡易推定",
+                "degraded": True,
+            }
+    return None
+
+async def lookup_nutrition(text):
+    """キャッシュかローカル食品DBで答えられれば (結果, None)、LLMが必要なら (None, LLMが使えないときの代わりの推定 or None)"""
+    key = normalize_food_text(text)
+    cached = nutrition_cache.get_memory(key)
+    if cached is None:
+        cached = await run_in_threadpool(nutrition_cache.get_stored, key)
+    if cached is not None:
+        return cached, None
+
+    local = food_matcher.estimate(text)
+    if local is not None and local["confidence"] >= FOOD_MATCH_CONFIDENT:
+        return local, None
+
+    similar = await run_in_threadpool(semantic_cache.lookup, text)
+    if similar is not None:
+        return similar, None
+    if local is not None and local["confidence"] >= FOOD_MATCH_FALLBACK:
+        return None, local
+    return None, degraded_nutrition_estimate(text)
+
 @app.post("/api/estimate_nutrition")
-def estimate_nutrition(req: EstimationRequest):
+async def estimate_nutrition(req: EstimationRequest):
     text = req.text
+    result, fallback = await lookup_nutrition(text)
+    if result is not None:
+        return result
     
     # 1. Gemini AI Estimate (High Priority)
-    if GEMINI_API_KEY:
+    if llm_client.available:
         try:
-            # モデル名を修正: gemini-1.5-flash (2.5は存在しない)
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            prompt = f"""
-            栄養士として、以下の食事の栄養素（カロリー、タンパク質、脂質、炭水化物）を精密に推定してください。
-            入力: "{text}"
-
-            指示:
-            1. 日本語で回答してください。
-            2. 一般的な1人前の量を基準にしてください。
-            3. 数値は推定値ですが、栄養士としてできるだけ正確な数値を考えてください。
-            4. 栄養バランスに関する「アドバイス」と、なぜその数値になったかの「内訳（推定根拠）」も含めてください。
-            5. 出力は以下のJSON形式のみとし、Markdown（```jsonなど）は一切含めないでください。
-
-            {{
-                "food_name": "料理名 (分量の目安)",
-                "calories": 数値(kcal),
-                "protein": 数値(g),
-                "fat": 数値(g),
-                "carbs": 数値(g),
-                "breakdown": "推定の根拠（例: ご飯200g、焼き鮭80gとして計算）",
-                "advice": "栄養士からのアドバイス（例: タンパク質は十分ですが、野菜が不足しています。サラダを追加すると良いでしょう）"
-            }}
-            """
-            response = model.generate_content(prompt)
-            raw_text = response.text
-            
-            # Markdownの除去（もし含まれていれば）
-            json_text = re.sub(r'```json\s*|\s*```|`', '', raw_text).strip()
-            
-            # JSON部分の抽出（余計なテキストが混ざる対策）
-            match = re.search(r'\{.*\}', json_text, re.DOTALL)
-            if match:
-                json_text = match.group(0)
-            
-            data = json.loads(json_text)
-            
-            return {
-                "food_name": data.get("food_name", text),
-                "calories": int(data.get("calories", 0)),
-                "protein": float(data.get("protein", 0)),
-                "fat": float(data.get("fat", 0)),
-                "carbs": float(data.get("carbs", 0)),
-                "breakdown": data.get("breakdown", ""),
-                "advice": data.get("advice", ""),
-                "source": "Gemini AI (1.5-flash)"
-            }
+            raw_text = await llm_client.generate(build_nutrition_prompt(text))
+            result = parse_nutrition_response(raw_text, text)
+            await run_in_threadpool(remember_nutrition, text, result)
+            return result
         except Exception as e:
-            print(f"Gemini Error: {e}")
+            print(f"LLM Error: {e!r}")
+            if fallback is not None:
+                return fallback
+            if isinstance(e, CircuitOpenError):
+                raise HTTPException(status_code=503, detail="AIが一時的に利用できません。しばらくしてから再度お試しください。")
             raise HTTPException(status_code=500, detail="AIによる推定に失敗しました。")
     else:
+        if fallback is not None:
+            return fallback
         raise HTTPException(status_code=500, detail="Gemini APIキーが設定されていません。")
 
-@app.post("/api/daily_advice")
-def get_daily_advice(req: AdviceRequest):
-    meals = req.meals
-    targets = req.targets
-    
-    if not GEMINI_API_KEY:
-        raise HTTPException(status_code=500, detail="Gemini APIキーが設定されていません。")
+# 複数品目の一括推定。キャッシュ・ローカル食品DBで答えられない品目だけを1回のプロンプトにまとめて問い合わせ、
+# 入力と同じ順番で返す。推定できなかった品目は "error" を持つ。
+BATCH_ESTIMATION_MAX_ITEMS = 20
+
+@app.post("/api/estimate_nutrition/batch")
+async def estimate_nutrition_batch(req: BatchEstimationRequest):
+    if not req.items:
+        return {"items": []}
+    if len(req.items) > BATCH_ESTIMATION_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"一度に推定できるのは{BATCH_ESTIMATION_MAX_ITEMS}品目までです")
+
+    results = [None] * len(req.items)
+    fallbacks = {}
+    misses = {}  # 正規化した食品名 -> 元の入力（同じ食品は1回だけ問い合わせる）
+    for i, text in enumerate(req.items):
+        results[i], fallback = await lookup_nutrition(text)
+        if results[i] is None:
+            misses.setdefault(normalize_food_text(text), text)
+            fallbacks[i] = fallback
+
+    if misses:
+        estimated = {}
+        if llm_client.available:
+            texts = list(misses.values())
+            try:
+                raw_text = await llm_client.generate(build_batch_nutrition_prompt(texts))
+                for key, result in zip(misses, parse_batch_nutrition_response(raw_text, texts)):
+                    estimated[key] = result
+                    await run_in_threadpool(remember_nutrition, misses[key], result)
+                error = None
+            except CircuitOpenError:
+                error = "AIが一時的に利用できません。"
+            except Exception as e:
+                print(f"LLM Error: {e!r}")
+                error = "AIによる推定に失敗しました。"
+        else:
+            error = "Gemini APIキーが設定されていません。"
+
+        for i, fallback in fallbacks.items():
+            text = req.items[i]
+            results[i] = estimated.get(normalize_food_text(text)) or fallback or {"food_name": text, "error": error}
+
+    return {"items": results}
+
+# 推定のストリーミング版。生成途中でも確定したフィールドから "partial" イベントで送り、最後に "done" で結果全体を送る。
+# 失敗時は "fail" イベント（EventSource 自体の error と区別するため）。
+@app.get("/api/estimate_nutrition/stream")
+async def stream_estimate_nutrition(text: str = Query(...)):
+    result, fallback = await lookup_nutrition(text)
+
+    async def events():
+        if result is not None:
+            yield sse_event(result, "done")
+            return
+        if not llm_client.available:
+            if fallback is not None:
+                yield sse_event(fallback, "done")
+            else:
+                yield sse_event({"detail": "Gemini APIキーが設定されていません。"}, "fail")
+            return
+
+        raw_text = ""
+        sent = {}
+        try:
+            async for chunk in llm_client.stream(build_nutrition_prompt(text)):
+                raw_text += chunk
+                partial = parse_partial_nutrition(raw_text)
+                if partial != sent:
+                    sent = partial
+                    yield sse_event(partial, "partial")
+            final = parse_nutrition_response(raw_text, text)
+        except Exception as e:
+            print(f"LLM Error: {e!r}")
+            if fallback is not None:
+                yield sse_event(fallback, "done")
+            else:
+                yield sse_event({"detail": "AIによる推定に失敗しました。"}, "fail")
+            return
+        await run_in_threadpool(remember_nutrition, text, final)
+        yield sse_event(final, "done")
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+# --- 食事アドバイス ---
+# 食事と目標値はサーバー側で読み、その内容のハッシュが前回と同じならキャッシュ済みのアドバイスを返す。
+ADVICE_MEAL_FIELDS = ("meal_type", "food_name", "calories", "protein", "fat", "carbs")
+ADVICE_TARGET_FIELDS = ("target_calories", "target_protein", "target_fat", "target_carbs")
+NO_MEALS_ADVICE = "まだ食事の記録がありません。今日食べたものを入力してください！"
+
+def template_advice(meals, targets):
+    """LLMが使えないときの定型アドバイス。その日の合計と目標値の比率から作る"""
+    totals = {key: sum(m[key] or 0 for m in meals) for key in ("calories", "protein", "fat", "carbs")}
+
+    def rate(key):
+        target = targets.get(f"target_{key}")
+        return totals[key] / target * 100 if target else None
+
+    cal_rate, p_rate, f_rate, c_rate = rate("calories"), rate("protein"), rate("fat"), rate("carbs")
+    advices = []
+    if p_rate is not None and p_rate < 80:
+        advices.append("タンパク質が不足しています。鶏肉や卵、納豆などを足しましょう。")
+    if p_rate is not None and p_rate > 150:
+        advices.append("タンパク質を摂りすぎています。腎臓に気をつけて。")
+    if f_rate is not None and f_rate > 120:
+        advices.append("脂質が高めです。揚げ物は控えましょう。")
+    if c_rate is not None and c_rate < 50:
+        advices.append("エネルギー不足かも。炭水化物もしっかり摂りましょう。")
+    if cal_rate is not None and cal_rate > 110:
+        advices.append("カロリーオーバー気味です。明日は少し運動量を増やしましょう。")
+    if not advices:
+        advices.append("バランス良く食べられています。この調子で続けましょう！")
+    summary = f"今日の合計は {round(totals['calories'])}kcal（P:{round(totals['protein'], 1)}g, F:{round(totals['fat'], 1)}g, C:{round(totals['carbs'], 1)}g）です。"
+    return summary + "".join(advices)
+
+def load_daily_advice_context(user_id, date):
+    """その日の食事・目標値と、その内容ハッシュ、ハッシュが一致するキャッシュ済みアドバイス（なければ None）を返す"""
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {', '.join(ADVICE_MEAL_FIELDS)} FROM meals WHERE user_id = ? AND date = ? ORDER BY id", (user_id, date))
+    meals = [dict(zip(ADVICE_MEAL_FIELDS, row)) for row in cursor.fetchall()]
+    cursor.execute(f"SELECT {', '.join(ADVICE_TARGET_FIELDS)} FROM users WHERE username = ?", (user_id,))
+    targets = dict(zip(ADVICE_TARGET_FIELDS, cursor.fetchone() or (None,) * len(ADVICE_TARGET_FIELDS)))
+
+    # 登録順や表記ゆれ、浮動小数の端数ではハッシュが変わらないように正規化する
+    normalized = sorted(
+        (m["meal_type"] or "", normalize_food_text(m["food_name"] or ""),
+         *(round(float(m[k] or 0), 1) for k in ("calories", "protein", "fat", "carbs")))
+        for m in meals
+    )
+    content = json.dumps({"meals": normalized, "targets": targets}, ensure_ascii=False, sort_keys=True)
+    content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    cursor.execute("SELECT advice FROM advice_cache WHERE user_id = ? AND date = ? AND content_hash = ?", (user_id, date, content_hash))
+    row = cursor.fetchone()
+    conn.close()
+    return meals, targets, content_hash, row[0] if row else None
 
-    if not meals:
-        return {"advice": "まだ食事の記録がありません。今日食べたものを入力してください！"}
+def save_daily_advice(user_id, date, content_hash, advice):
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT OR REPLACE INTO advice_cache (user_id, date, content_hash, advice, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (user_id, date, content_hash, advice, time.time()))
+    conn.commit()
+    conn.close()
 
+def build_advice_prompt(meals, targets):
     meal_summary = "\n".join([f"- {m['meal_type']}: {m['food_name']} ({m['calories']}kcal, P:{m['protein']}g, F:{m['fat']}g, C:{m['carbs']}g)" for m in meals])
     
     total_cal = sum(m['calories'] for m in meals)
@@ -643,7 +2561,7 @@ def get_daily_advice(req: AdviceRequest):
     total_f = sum(m['fat'] for m in meals)
     total_c = sum(m['carbs'] for m in meals)
 
-    prompt = f"""
+    return f"""
     プロのトレーナー兼栄養士として、今日の食事内容に基づいたアドバイスを150文字程度で提供してください。
     
     【目標値】
@@ -666,25 +2584,331 @@ def get_daily_advice(req: AdviceRequest):
     2. あすけんの「うさぎの先生」やパーソナルトレーナーのような、励ましと具体的な改善案を含めてください。
     3. Markdownは使わず、プレーンテキストで回答してください。
     """
-    
+
+@app.post("/api/daily_advice")
+async def get_daily_advice(req: AdviceRequest):
+    date = require_date(req.date)
+    meals, targets, content_hash, cached = await run_in_threadpool(load_daily_advice_context, req.user_id, date)
+    if cached is not None:
+        return {"advice": cached, "cached": True}
+
+    if not meals:
+        return {"advice": NO_MEALS_ADVICE}
+    if not llm_client.available:
+        return {"advice": template_advice(meals, targets), "cached": False, "degraded": True}
+
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        response = model.generate_content(prompt)
-        return {"advice": response.text.strip()}
+        advice = (await llm_client.generate(build_advice_prompt(meals, targets))).strip()
     except Exception as e:
-        print(f"Advice Gemini Error: {e}")
-        raise HTTPException(status_code=500, detail="アドバイスの生成に失敗しました。")
+        # 定型アドバイスはキャッシュしない（回復後にAIのアドバイスを返すため）
+        print(f"Advice LLM Error: {e!r}")
+        return {"advice": template_advice(meals, targets), "cached": False, "degraded": True}
+    await run_in_threadpool(save_daily_advice, req.user_id, date, content_hash, advice)
+    return {"advice": advice, "cached": False}
+
+# アドバイスのストリーミング版。生成された断片を {"delta": ...} で順に送り、最後に "done" で全文を送る
+@app.get("/api/daily_advice/stream")
+async def stream_daily_advice(user_id: str = Query(...), date: str = Query(...)):
+    date = require_date(date)
+    meals, targets, content_hash, cached = await run_in_threadpool(load_daily_advice_context, user_id, date)
+
+    async def events():
+        if cached is not None:
+            yield sse_event({"advice": cached, "cached": True}, "done")
+            return
+        if not meals:
+            yield sse_event({"advice": NO_MEALS_ADVICE}, "done")
+            return
+        if not llm_client.available:
+            yield sse_event({"advice": template_advice(meals, targets), "cached": False, "degraded": True}, "done")
+            return
+
+        parts = []
+        try:
+            async for chunk in llm_client.stream(build_advice_prompt(meals, targets)):
+                parts.append(chunk)
+                yield sse_event({"delta": chunk})
+        except Exception as e:
+            print(f"Advice LLM Error: {e!r}")
+            if parts:
+                yield sse_event({"detail": "アドバイスの生成に失敗しました。"}, "fail")
+            else:
+                yield sse_event({"advice": template_advice(meals, targets), "cached": False, "degraded": True}, "done")
+            return
+        advice = "".join(parts).strip()
+        await run_in_threadpool(save_daily_advice, user_id, date, content_hash, advice)
+        yield sse_event({"advice": advice, "cached": False}, "done")
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+# --- LLM ジョブキュー ---
+# 栄養推定・アドバイスをジョブとして llm_jobs に保存し、バックグラウンドのワーカーで処理する。
+# リクエストは投入してすぐ返り、結果は GET /api/jobs/{id} でポーリングする。
+# 失敗したジョブは指数バックオフで再試行し、同じ内容のジョブが待機中・実行中なら新たに作らずそれを返す。
+# 実行中のジョブは run_after をリース期限として、処理中は定期的に延長する。プロセスが落ちて延長が止まった
+# ジョブだけが期限後にどのプロセスからも取り直される（--workers N でも他のプロセスの実行中ジョブは奪わない）。
+# 結果の書き込みは attempts が取り出したときのままの場合に限るので、取り直された古い実行の結果は捨てられる。
+JOB_WORKERS = int(os.environ.get("LLM_JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = 4
+JOB_BACKOFF_BASE = 2.0      # 秒。n回目の失敗後は base * 2^(n-1)（±25%の揺らぎ付き）待つ
+JOB_BACKOFF_MAX = 60.0
+JOB_POLL_INTERVAL = 1.0     # 投入の通知がなくても、この間隔で再試行待ちのジョブを確認する
+JOB_LEASE = 60.0            # 秒。実行中のジョブは run_after をリース期限として延長し続ける
+JOB_RETENTION = 7 * 24 * 3600
+
+class JobRequest(BaseModel):
+    kind: str
+    payload: dict
+
+async def run_nutrition_job(payload):
+    text = payload["text"]
+    result, _ = await lookup_nutrition(text)
+    if result is not None:
+        return result
+    raw_text = await llm_client.generate(build_nutrition_prompt(text))
+    result = parse_nutrition_response(raw_text, text)
+    await run_in_threadpool(remember_nutrition, text, result)
+    return result
+
+async def run_advice_job(payload):
+    user_id, date = payload["user_id"], payload["date"]
+    meals, targets, content_hash, cached = await run_in_threadpool(load_daily_advice_context, user_id, date)
+    if cached is not None:
+        return {"advice": cached, "cached": True}
+    if not meals:
+        return {"advice": NO_MEALS_ADVICE}
+    advice = (await llm_client.generate(build_advice_prompt(meals, targets))).strip()
+    await run_in_threadpool(save_daily_advice, user_id, date, content_hash, advice)
+    return {"advice": advice, "cached": False}
+
+# kind -> (ペイロードの型, 処理関数)
+JOB_KINDS = {
+    "estimate_nutrition": (EstimationRequest, run_nutrition_job),
+    "daily_advice": (AdviceRequest, run_advice_job),
+}
+
+class JobQueue:
+    def __init__(self, workers=JOB_WORKERS):
+        self.workers = workers
+        self._tasks = []
+        self._wakeup = None
+        self.running = 0
+
+    def submit(self, kind, payload):
+        """ジョブを登録して (job_id, 既存ジョブを返したか) を返す"""
+        payload_json = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+        dedup_key = hashlib.sha256(f"{kind}\n{payload_json}".encode("utf-8")).hexdigest()
+        now = time.time()
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("SELECT id FROM llm_jobs WHERE dedup_key = ? AND status IN ('queued', 'running')", (dedup_key,))
+        row = cursor.fetchone()
+        if row:
+            conn.rollback()
+            conn.close()
+            return row[0], True
+        cursor.execute('''
+            INSERT INTO llm_jobs (kind, payload, dedup_key, status, attempts, created_at, updated_at, run_after)
+            VALUES (?, ?, ?, 'queued', 0, ?, ?, ?)
+        ''', (kind, payload_json, dedup_key, now, now, now))
+        job_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        return job_id, False
+
+    def notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _claim(self):
+        """実行可能なジョブを1件取り出して running にする。なければ None"""
+        now = time.time()
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute('''
+            SELECT id, kind, payload, attempts FROM llm_jobs
+            WHERE status IN ('queued', 'running') AND run_after <= ?
+            ORDER BY run_after, id LIMIT 1
+        ''', (now,))
+        row = cursor.fetchone()
+        if row:
+            cursor.execute('''
+                UPDATE llm_jobs SET status = 'running', attempts = attempts + 1, updated_at = ?, run_after = ?
+                WHERE id = ?
+            ''', (now, now + JOB_LEASE, row[0]))
+        conn.commit()
+        conn.close()
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2]), row[3] + 1
+
+    def _finish(self, job_id, attempts, status, result=None, error=None, run_after=None):
+        """実行結果を書き込む。リースが切れて取り直されていたら何もせず False を返す"""
+        now = time.time()
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE llm_jobs SET status = ?, result = ?, error = ?, run_after = IFNULL(?, run_after), updated_at = ?
+            WHERE id = ? AND status = 'running' AND attempts = ?
+        ''', (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, run_after, now,
+              job_id, attempts))
+        finished = cursor.rowcount > 0
+        conn.commit()
+        conn.close()
+        if not finished:
+            print(f"LLM Job {job_id} lease lost (attempt {attempts}); result discarded")
+        return finished
+
+    def _extend_lease(self, job_id, attempts):
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE llm_jobs SET run_after = ? WHERE id = ? AND status = 'running' AND attempts = ?",
+            (time.time() + JOB_LEASE, job_id, attempts)
+        )
+        conn.commit()
+        conn.close()
+
+    async def _hold_lease(self, job_id, attempts):
+        while True:
+            await asyncio.sleep(JOB_LEASE / 3)
+            await run_in_threadpool(self._extend_lease, job_id, attempts)
+
+    def _prune(self):
+        """古い完了済みジョブを消す（中断されたジョブはリース切れで _claim が取り直す）"""
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM llm_jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (time.time() - JOB_RETENTION,))
+        conn.commit()
+        conn.close()
+
+    async def _run(self, job_id, kind, payload, attempts):
+        _, handler = JOB_KINDS[kind]
+        self.running += 1
+        lease = asyncio.create_task(self._hold_lease(job_id, attempts))
+        try:
+            result = await handler(payload)
+        except Exception as e:
+            print(f"LLM Job {job_id} Error (attempt {attempts}): {e!r}")
+            if attempts >= JOB_MAX_ATTEMPTS:
+                await run_in_threadpool(self._finish, job_id, attempts, "failed", error=repr(e))
+            else:
+                delay = min(JOB_BACKOFF_MAX, JOB_BACKOFF_BASE * 2 ** (attempts - 1)) * random.uniform(0.75, 1.25)
+                await run_in_threadpool(self._finish, job_id, attempts, "queued", error=repr(e), run_after=time.time() + delay)
+        else:
+            await run_in_threadpool(self._finish, job_id, attempts, "done", result=result)
+        finally:
+            lease.cancel()
+            self.running -= 1
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await run_in_threadpool(self._claim)
+                if job is None:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), JOB_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    self._wakeup.clear()
+                    continue
+                await self._run(*job)
+            except Exception as e:
+                # DBのロックなどでワーカーが止まると誰もキューを消化しなくなるので、記録して続ける
+                print(f"LLM Job Worker Error: {e!r}")
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    async def start(self):
+        await run_in_threadpool(self._prune)
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute("SELECT status, COUNT(*) FROM llm_jobs GROUP BY status")
+        counts = dict(cursor.fetchall())
+        cursor.execute("SELECT MIN(created_at) FROM llm_jobs WHERE status = 'queued'")
+        oldest = cursor.fetchone()[0]
+        conn.close()
+        return {
+            "workers": len(self._tasks),
+            "running": self.running,
+            "queued": counts.get("queued", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "oldest_queued_age": round(time.time() - oldest, 1) if oldest else None,
+        }
+
+job_queue = JobQueue()
+
+@app.post("/api/jobs")
+async def submit_job(req: JobRequest):
+    if req.kind not in JOB_KINDS:
+        raise HTTPException(status_code=400, detail=f"不明なジョブの種類です: {req.kind}")
+    if not llm_client.available:
+        raise HTTPException(status_code=500, detail="Gemini APIキーが設定されていません。")
+    model, _ = JOB_KINDS[req.kind]
+    try:
+        payload = model(**req.payload).model_dump()
+    except ValidationError as e:
+        raise HTTPException(status_code=400, detail=f"ジョブの内容が不正です: {e.errors()}")
+    if "date" in payload:
+        payload["date"] = require_date(payload["date"])
+
+    job_id, deduplicated = await run_in_threadpool(job_queue.submit, req.kind, payload)
+    job_queue.notify()
+    return {"id": job_id, "status": "queued", "deduplicated": deduplicated}
+
+@app.get("/api/jobs/stats")
+def get_job_stats():
+    return {**job_queue.stats(), "llm": llm_client.stats()}
+
+@app.get("/api/jobs/{job_id}")
+def get_job(job_id: int):
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, kind, status, attempts, result, error, created_at, updated_at FROM llm_jobs WHERE id = ?", (job_id,))
+    row = cursor.fetchone()
+    conn.close()
+    if row is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+    return {
+        "id": row[0],
+        "kind": row[1],
+        "status": row[2],
+        "attempts": row[3],
+        "result": json.loads(row[4]) if row[4] else None,
+        "error": row[5],
+        "created_at": row[6],
+        "updated_at": row[7],
+    }
 
 # メモ更新
 @app.put("/memo/{memo_id}")
 def update_memo(memo_id: int, memo: Memo):
-    conn = sqlite3.connect(DB_FILE)
+    memo.date = require_date(memo.date)
+    conn = get_db()
     cursor = conn.cursor()
+    cursor.execute("SELECT user_id, exercise, date FROM memos WHERE id = ?", (memo_id,))
+    old = cursor.fetchone()
     cursor.execute('''
         UPDATE memos
         SET user_id = ?, date = ?, exercise = ?, weight = ?, reps = ?, note = ?
         WHERE id = ?
     ''', (memo.user_id, memo.date, memo.exercise, memo.weight, memo.reps, memo.note, memo_id))
+    if old:
+        refresh_training_analytics(cursor, *old)
+        if old != (memo.user_id, memo.exercise, memo.date):
+            refresh_training_analytics(cursor, memo.user_id, memo.exercise, memo.date)
     conn.commit()
     conn.close()
     return {"message": "メモを更新しました", "memo": memo}
@@ -692,7 +2916,7 @@ def update_memo(memo_id: int, memo: Memo):
 # ログイン
 @app.post("/login")
 def login(user: UserCreate):
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("SELECT password FROM users WHERE username = ?", (user.username,))
     row = cursor.fetchone()
@@ -710,6 +2934,13 @@ def login(user: UserCreate):
 # メモ削除
 @app.delete("/memo/{memo_id}")
 def delete_memo(memo_id: int):
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, exercise, date FROM memos WHERE id = ?", (memo_id,))
+    old = cursor.fetchone()
+    cursor.execute("DELETE FROM memos WHERE id = ?", (memo_id,))
+    if old:
+        refresh_training_analytics(cursor, *old)
     conn.commit()
     conn.close()
     return {"message": f"メモ（ID: {memo_id}）を削除しました"}
@@ -718,7 +2949,7 @@ def delete_memo(memo_id: int):
 
 # 種目テーブル作成と初期データ
 def init_exercises():
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS exercises (
@@ -743,7 +2974,7 @@ class Exercise(BaseModel):
 
 @app.get("/exercises")
 def get_exercises():
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("SELECT id, name FROM exercises ORDER BY id")
     rows = cursor.fetchall()
@@ -752,7 +2983,7 @@ def get_exercises():
 
 @app.post("/exercises")
 def add_exercise(ex: Exercise):
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     try:
         cursor.execute("INSERT INTO exercises (name) VALUES (?)", (ex.name,))
@@ -766,7 +2997,7 @@ def add_exercise(ex: Exercise):
 
 @app.delete("/exercises/{ex_id}")
 def delete_exercise(ex_id: int):
-    conn = sqlite3.connect(DB_FILE)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM exercises WHERE id = ?", (ex_id,))
     conn.commit()
@@ -777,7 +3008,8 @@ def delete_exercise(ex_id: int):
 
 @app.post("/weights")
 def add_weight(log: WeightLog):
-    conn = sqlite3.connect(DB_FILE)
+    log.date = require_date(log.date)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         INSERT INTO weights (user_id, date, weight)
@@ -788,20 +3020,644 @@ def add_weight(log: WeightLog):
     return {"message": "体重を記録しました"}
 
 @app.get("/weights")
-def get_weights(user_id: str = Query(...)):
-    conn = sqlite3.connect(DB_FILE)
+def get_weights(
+    user_id: str = Query(...),
+    date_from: Optional[str] = Query(None, alias="from", description="この日以降 (YYYY-MM-DD)"),
+    date_to: Optional[str] = Query(None, alias="to", description="この日以前 (YYYY-MM-DD)")
+):
+    query = "SELECT id, date, weight FROM weights WHERE user_id = ?"
+    params = [user_id]
+    range_conditions, range_values = date_range_conditions("date", date_from, date_to)
+    for condition in range_conditions:
+        query += " AND " + condition
+    params.extend(range_values)
+    query += " ORDER BY date ASC"
+
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, date, weight FROM weights
-        WHERE user_id = ?
-        ORDER BY date ASC
-    ''', (user_id,))
+    cursor.execute(query, params)
     rows = cursor.fetchall()
     conn.close()
     return [{"id": r[0], "date": r[1], "weight": r[2]} for r in rows]
 
+# --- 体重トレンド ---
+WEIGHT_TREND_POINTS = 300
+WEIGHT_TREND_POINTS_MAX = 2000
+EMA_BLOCK_SPAN_DAYS = 365  # 指数平滑をブロック単位でベクトル化する際の1ブロックの期間（上限）
+EMA_MAX_EXPONENT = 600.0   # ブロック内の d^{-t} = e^{t log(1/d)} の指数の上限（float64 は e^709 付近で桁あふれ）
+
+def moving_average(days, values, window):
+    """暦日ベースの移動平均（直近 window 日間に含まれる記録の平均）"""
+    csum = np.concatenate(([0.0], np.cumsum(values)))
+    end = np.arange(1, len(values) + 1)
+    start = np.searchsorted(days, days - (window - 1), side="left")
+    return (csum[end] - csum[start]) / (end - start)
+
+def exponential_smoothing(days, values, alpha):
+    """記録間隔（日数）を考慮した指数平滑
+
+    e_k = e_{k-1} * d^{gap} + (1 - d^{gap}) * x_k  (d = 1 - alpha) を、
+    E_k = e_k * d^{-t_k} と置いて累積和で計算する。d^{-t} が桁あふれしないよう、
+    span * log(1/d) が EMA_MAX_EXPONENT に収まる期間（最短1日）ごとのブロックに分ける。
+    """
+    decay = 1.0 - alpha
+    span = max(1, min(EMA_BLOCK_SPAN_DAYS, int(EMA_MAX_EXPONENT / -np.log(decay))))
+    out = np.empty_like(values)
+    prev_value, prev_day = values[0], days[0]
+    start = 0
+    while start < len(values):
+        end = max(int(np.searchsorted(days, days[start] + span, side="left")), start + 1)
+        carry = decay ** float(days[start] - prev_day)
+        first = prev_value * carry + (1.0 - carry) * values[start]
+        scale = decay ** -(days[start:end] - days[start]).astype(float)
+        increments = np.diff(scale) * values[start + 1:end]
+        out[start:end] = (first + np.concatenate(([0.0], np.cumsum(increments)))) / scale
+        prev_value, prev_day = out[end - 1], days[end - 1]
+        start = end
+    return out
+
+def lttb_indices(x, y, threshold):
+    """Largest-Triangle-Three-Buckets で形状を保ったまま threshold 点に間引き、残す点のインデックスを返す"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = x.astype(float)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)  # 先頭・末尾を除いた threshold-2 個のバケット境界
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_lo, next_hi = hi, (edges[i + 2] if i + 2 < len(edges) else n)
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+        areas = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(areas))
+        selected.append(a)
+    selected.append(n - 1)
+    return np.array(selected)
+
+@app.get("/weights/trend")
+def get_weight_trend(
+    user_id: str = Query(...),
+    date_from: Optional[str] = Query(None, alias="from", description="この日以降 (YYYY-MM-DD)"),
+    date_to: Optional[str] = Query(None, alias="to", description="この日以前 (YYYY-MM-DD)"),
+    points: int = Query(WEIGHT_TREND_POINTS, ge=3, le=WEIGHT_TREND_POINTS_MAX, description="返す最大点数"),
+    alpha: float = Query(0.1, gt=0, lt=1, description="指数平滑の係数 (1日あたり)")
+):
+    # 同じ日の複数記録は平均して1点にまとめる
+    query = "SELECT date, AVG(weight) FROM weights WHERE user_id = ?"
+    params = [user_id]
+    range_conditions, range_values = date_range_conditions("date", date_from, date_to)
+    for condition in range_conditions:
+        query += " AND " + condition
+    params.extend(range_values)
+    query += " GROUP BY date ORDER BY date"
+
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    rows = [(d, w) for d, w in cursor.fetchall() if w is not None and normalize_date(d) == d]
+    conn.close()
+
+    if not rows:
+        return {"points": [], "latest": None, "previous": None, "day_count": 0}
+
+    dates = np.array([r[0] for r in rows], dtype="datetime64[D]")
+    days = dates.astype(np.int64)
+    weights = np.array([r[1] for r in rows], dtype=float)
+
+    ema = exponential_smoothing(days, weights, alpha)
+    ma7 = moving_average(days, weights, 7)
+    ma30 = moving_average(days, weights, 30)
+    keep = lttb_indices(days, weights, points)
+
+    def point(i):
+        return {
+            "date": rows[i][0],
+            "weight": round(float(weights[i]), 2),
+            "ema": round(float(ema[i]), 2),
+            "ma7": round(float(ma7[i]), 2),
+            "ma30": round(float(ma30[i]), 2),
+        }
+
+    return {
+        "points": [point(int(i)) for i in keep],
+        "latest": point(len(rows) - 1),
+        "previous": point(len(rows) - 2) if len(rows) >= 2 else None,
+        "day_count": len(rows),
+    }
+
+# --- トレーニング分析 API ---
+def pr_to_dict(reps, weight, date, memo_id):
+    return {
+        "reps": reps,
+        "weight": weight,
+        "date": date,
+        "memo_id": memo_id,
+        "e1rm_epley": round(weight if reps == 1 else weight * (1 + reps / 30.0), 1),
+    }
+
+@app.get("/analytics/exercise/{name}")
+def get_exercise_analytics(
+    name: str,
+    user_id: str = Query(...),
+    date_from: Optional[str] = Query(None, alias="from", description="この日以降 (YYYY-MM-DD)"),
+    date_to: Optional[str] = Query(None, alias="to", description="この日以前 (YYYY-MM-DD)")
+):
+    where = "user_id = ? AND exercise = ?"
+    params = [user_id, name]
+    range_conditions, range_values = date_range_conditions("date", date_from, date_to)
+    for condition in range_conditions:
+        where += " AND " + condition
+    params.extend(range_values)
+
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT date, sets, reps, tonnage, top_weight, e1rm_epley, e1rm_brzycki FROM exercise_sessions WHERE {where} ORDER BY date", params)
+    sessions = [
+        {
+            "date": r[0], "sets": r[1], "reps": r[2], "tonnage": r[3], "top_weight": r[4],
+            "e1rm_epley": round(r[5], 1), "e1rm_brzycki": None if r[6] is None else round(r[6], 1)
+        }
+        for r in cursor.fetchall()
+    ]
+    # 週（月曜始まり）ごとのトン数
+    cursor.execute(f"""
+        SELECT date(date, 'weekday 0', '-6 days') AS week_start, SUM(tonnage), COUNT(*)
+        FROM exercise_sessions WHERE {where}
+        GROUP BY week_start ORDER BY week_start
+    """, params)
+    weekly = [{"week_start": r[0], "tonnage": r[1], "sessions": r[2]} for r in cursor.fetchall()]
+    cursor.execute("SELECT reps, weight, date, memo_id FROM exercise_prs WHERE user_id = ? AND exercise = ? ORDER BY reps", (user_id, name))
+    prs = [pr_to_dict(*r) for r in cursor.fetchall()]
+    conn.close()
+    return {"exercise": name, "sessions": sessions, "weekly": weekly, "prs": prs}
+
+@app.get("/analytics/prs")
+def get_personal_records(user_id: str = Query(...)):
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT exercise, reps, weight, date, memo_id FROM exercise_prs WHERE user_id = ? ORDER BY exercise, reps", (user_id,))
+    rows = cursor.fetchall()
+    conn.close()
+    result = {}
+    for exercise, reps, weight, date, memo_id in rows:
+        result.setdefault(exercise, []).append(pr_to_dict(reps, weight, date, memo_id))
+    return result
+
+# --- エクスポート ---
+# メモ・食事・体重を NDJSON か CSV で書き出す。行はカーソルから少しずつ読み、一定量ごとにまとめて送るので、
+# 記録の件数にかかわらずメモリ使用量は一定。gzip=true なら送りながら圧縮する。
+EXPORT_FORMATS = ("ndjson", "csv")
+EXPORT_TABLES = [
+    # (種類, テーブル, 列)
+    ("memo", "memos", ("id", "date", "exercise", "weight", "reps", "note")),
+    ("meal", "meals", ("id", "date", "meal_type", "food_name", "calories", "protein", "fat", "carbs")),
+    ("weight", "weights", ("id", "date", "weight")),
+]
+EXPORT_COLUMNS = ["type", "id", "date", "exercise", "weight", "reps", "note", "meal_type", "food_name", "calories", "protein", "fat", "carbs"]
+EXPORT_FETCH_ROWS = 500
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+def export_records(user_id):
+    """ユーザーの全記録を1件ずつ dict で返す"""
+    # StreamingResponse は同期ジェネレータをスレッドプール上で1チャンクずつ進めるため、途中でスレッドが変わりうる。
+    # 長く借りたままになるのでプールの接続ではなく専用の接続を使い、1つの読み取りトランザクションで一貫したスナップショットを読む。
+    conn = open_db()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        for kind, table, columns in EXPORT_TABLES:
+            cursor.execute(f"SELECT {', '.join(columns)} FROM {table} WHERE user_id = ? ORDER BY date, id", (user_id,))
+            while True:
+                rows = cursor.fetchmany(EXPORT_FETCH_ROWS)
+                if not rows:
+                    break
+                for row in rows:
+                    yield {"type": kind, **dict(zip(columns, row))}
+    finally:
+        conn.dispose()
+
+def export_lines(records, fmt):
+    if fmt == "ndjson":
+        for record in records:
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+        return
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS, lineterminator="\n")
+    writer.writeheader()
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def export_stream(user_id, fmt, compress):
+    encoder = zlib.compressobj(wbits=31) if compress else None  # wbits=31: gzip 形式
+    pending = []
+    size = 0
+    for line in export_lines(export_records(user_id), fmt):
+        pending.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            data = "".join(pending).encode("utf-8")
+            pending = []
+            size = 0
+            if encoder:
+                data = encoder.compress(data)
+            if data:
+                yield data
+    data = "".join(pending).encode("utf-8")
+    if encoder:
+        data = encoder.compress(data) + encoder.flush()
+    if data:
+        yield data
+
+@app.get("/export")
+def export_user_data(
+    user: str = Query(...),
+    fmt: str = Query("ndjson", alias="format", description="ndjson または csv"),
+    compress: bool = Query(False, alias="gzip"),
+):
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format は ndjson か csv を指定してください")
+    if not social_graph.user_exists(user):
+        raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
+
+    filename = f"kinapp-{user}.{fmt}" + (".gz" if compress else "")
+    if compress:
+        media_type = "application/gzip"
+    elif fmt == "ndjson":
+        media_type = "application/x-ndjson"
+    else:
+        media_type = "text/csv; charset=utf-8"
+    headers = {"Content-Disposition": f"attachment; filename*=UTF-8''{urllib.parse.quote(filename)}"}
+    return StreamingResponse(export_stream(user, fmt, compress), media_type=media_type, headers=headers)
+
+# --- インポート ---
+# 他のアプリからの移行用。/export と同じ形式の NDJSON / CSV（gzip 圧縮も可）を1行ずつ読み、
+# 検証済みの行が IMPORT_CHUNK_ROWS 行たまるごとに executemany で挿入して1トランザクションでコミットする。
+# 集計テーブル（日別栄養・トレーニング分析）は最後に、影響のあった日・種目だけを1回ずつ更新する。
+# 進捗はチャンクごとに NDJSON の1行として返す。
+IMPORT_CHUNK_ROWS = 2000
+IMPORT_MAX_ERRORS = 100  # 返すエラーの最大件数（スキップ件数はすべて数える）
+IMPORT_KINDS = {
+    # 種類: (モデル, テーブル, 列)
+    "memo": (Memo, "memos", ("user_id", "date", "exercise", "weight", "reps", "note")),
+    "meal": (Meal, "meals", ("user_id", "date", "meal_type", "food_name", "calories", "protein", "fat", "carbs")),
+    "weight": (WeightLog, "weights", ("user_id", "date", "weight")),
+}
+
+def read_import_rows(file, fmt):
+    """アップロードされたファイルを (行番号, 行) で1件ずつ返す。行は CSV なら dict、NDJSON なら未解析の文字列"""
+    head = file.read(2)
+    file.seek(0)
+    if head == b"\x1f\x8b":
+        file = gzip.GzipFile(fileobj=file, mode="rb")
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_no, line in enumerate(text, 1):
+        if line.strip():
+            yield line_no, line
+
+def validate_import_row(user_id, row):
+    """1行を検証して (種類, INSERT用のタプル) を返す。不正なら ValueError"""
+    if isinstance(row, str):
+        try:
+            row = json.loads(row)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"JSONとして読めません: {e.msg}")
+        if not isinstance(row, dict):
+            raise ValueError("JSONオブジェクトではありません")
+    elif None in row:
+        # DictReader はヘッダーより多い列を None キーにまとめる（引用されていないカンマなど）
+        raise ValueError("列がヘッダーより多くあります")
+    kind = row.get("type")
+    if not isinstance(kind, str) or kind not in IMPORT_KINDS:
+        raise ValueError(f"不明な種類です: {kind}")
+    model, _, columns = IMPORT_KINDS[kind]
+    fields = {**row, "user_id": user_id}
+    if kind == "memo" and fields.get("note") is None:
+        fields["note"] = ""
+    try:
+        record = model(**fields)
+    except ValidationError as e:
+        raise ValueError("; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()))
+    record.date = normalize_date(record.date)
+    if record.date is None:
+        raise ValueError(f"日付の形式が不正です: {fields.get('date')}")
+    return kind, tuple(getattr(record, column) for column in columns)
+
+def import_stream(user_id, file, fmt):
+    # エクスポートと同じく、ジェネレータはスレッドをまたいで進むので専用の接続を使う
+    conn = open_db()
+    cursor = conn.cursor()
+    start = time.monotonic()
+    pending = defaultdict(list)
+    imported = {kind: 0 for kind in IMPORT_KINDS}
+    rows_read = 0
+    skipped = 0
+    errors = []
+    meal_dates = set()
+    exercises = set()
+
+    def flush():
+        cursor.execute("BEGIN IMMEDIATE")
+        for kind, rows in pending.items():
+            _, table, columns = IMPORT_KINDS[kind]
+            cursor.executemany(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", rows
+            )
+        conn.commit()
+        for kind, rows in pending.items():
+            imported[kind] += len(rows)
+        pending.clear()
+
+    def progress(event, **extra):
+        return json.dumps({
+            "event": event,
+            "rows": rows_read,
+            "imported": dict(imported),
+            "skipped": skipped,
+            "elapsed": round(time.monotonic() - start, 2),
+            **extra,
+        }, ensure_ascii=False) + "\n"
+
+    try:
+        for line_no, row in read_import_rows(file, fmt):
+            rows_read += 1
+            try:
+                kind, values = validate_import_row(user_id, row)
+            except (ValueError, TypeError) as e:
+                # 1行の不正でインポート全体を止めない
+                skipped += 1
+                if len(errors) < IMPORT_MAX_ERRORS:
+                    errors.append({"line": line_no, "error": str(e)})
+                continue
+            pending[kind].append(values)
+            if kind == "meal":
+                meal_dates.add(values[1])
+            elif kind == "memo":
+                exercises.add(values[2])
+            if sum(map(len, pending.values())) >= IMPORT_CHUNK_ROWS:
+                flush()
+                yield progress("progress")
+        flush()
+
+        # 集計テーブルの更新はまとめて1回
+        cursor.execute("BEGIN IMMEDIATE")
+        for date in sorted(meal_dates):
+            refresh_daily_nutrition(cursor, user_id, date)
+            invalidate_daily_advice(cursor, user_id, date)
+        for exercise in sorted(exercises):
+            rebuild_exercise_analytics(cursor, user_id, exercise)
+        conn.commit()
+        yield progress("done", errors=errors)
+    except Exception as e:
+        # コミット済みのチャンクは残る。どこまで入ったかは imported で分かる
+        conn.rollback()
+        print(f"Import Error: {e!r}")
+        yield progress("error", errors=errors, detail=str(e))
+    finally:
+        conn.dispose()
+
+@app.post("/import")
+def import_user_data(
+    user: str = Query(...),
+    fmt: Optional[str] = Query(None, alias="format", description="ndjson または csv（省略時はファイル名から判断）"),
+    file: UploadFile = File(...),
+):
+    if fmt is None:
+        fmt = "csv" if (file.filename or "").lower().endswith((".csv", ".csv.gz")) else "ndjson"
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="format は ndjson か csv を指定してください")
+    if not social_graph.user_exists(user):
+        raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
+    return StreamingResponse(import_stream(user, file.file, fmt), media_type="application/x-ndjson")
+
+# --- 差分同期 ---
+# PWA は前回の cursor を送り、それ以降に変わった行と削除された行のIDだけを受け取る。
+# 行バージョンと削除記録はトリガーで付くので、書き込み側のエンドポイントは何もしなくてよい。
+SYNC_PAGE_ROWS = 1000
+SYNC_TOMBSTONE_DAYS = 90  # これより古い削除記録は消す。消した範囲より前の cursor には reset を返す
+SYNC_COLUMNS = {
+    "memos": ("id", "date", "exercise", "weight", "reps", "note"),
+    "meals": ("id", "date", "meal_type", "food_name", "calories", "protein", "fat", "carbs"),
+    "weights": ("id", "date", "weight"),
+}
+
+def prune_sync_tombstones():
+    cutoff = int(time.time()) - SYNC_TOMBSTONE_DAYS * 86400
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT MAX(row_version) FROM sync_tombstones WHERE deleted_at < ?", (cutoff,))
+    pruned = cursor.fetchone()[0]
+    if pruned is not None:
+        cursor.execute("DELETE FROM sync_tombstones WHERE row_version <= ?", (pruned,))
+        cursor.execute("UPDATE sync_state SET pruned_version = MAX(pruned_version, ?) WHERE id = 1", (pruned,))
+        conn.commit()
+    conn.close()
+
+@app.get("/sync")
+def sync_changes(
+    user_id: str = Query(...),
+    since: int = Query(0, ge=0, description="前回のレスポンスの cursor（初回は 0 で全件）"),
+    limit: int = Query(SYNC_PAGE_ROWS, ge=1, le=10000, description="テーブルごとの最大件数"),
+    tables: Optional[str] = Query(None, description="同期するテーブル（カンマ区切り。省略時はすべて）")
+):
+    # 画面が複製を使うテーブルだけを同期できる。cursor は全テーブル共通の行バージョンなので、
+    # 同じ tables で呼び続ける限り差分の取りこぼしはない
+    selected = list(SYNC_COLUMNS) if tables is None else list(dict.fromkeys(tables.split(",")))
+    if any(table not in SYNC_COLUMNS for table in selected):
+        raise HTTPException(status_code=400, detail=f"tables は {', '.join(SYNC_COLUMNS)} から指定してください")
+    conn = get_db()
+    cursor = conn.cursor()
+    # 全テーブルを同じスナップショットで読む（読んでいる間の書き込みで cursor が行を追い越さないように）
+    cursor.execute("BEGIN")
+    cursor.execute("SELECT version, pruned_version FROM sync_state WHERE id = 1")
+    version, pruned_version = cursor.fetchone()
+    # 削除記録を消した範囲より前の cursor や、DBを作り直す前の cursor からは差分を出せないので全件を返す
+    reset = since > version or 0 < since < pruned_version
+    if reset:
+        since = 0
+
+    # どれかのテーブルが limit 件で切れたら、その最後の行バージョンまでを今回の範囲にする
+    upper = version
+    changed = {}
+    for table in selected:
+        columns = SYNC_COLUMNS[table]
+        cursor.execute(f'''
+            SELECT row_version, {', '.join(columns)} FROM {table}
+            WHERE user_id = ? AND row_version > ? ORDER BY row_version LIMIT ?
+        ''', (user_id, since, limit))
+        changed[table] = cursor.fetchall()
+        if len(changed[table]) == limit:
+            upper = min(upper, changed[table][-1][0])
+    tombstones = []
+    if since > 0:  # 全件同期ではクライアントに消す行がない
+        cursor.execute(f'''
+            SELECT row_version, table_name, row_id FROM sync_tombstones
+            WHERE user_id = ? AND row_version > ? AND table_name IN ({', '.join('?' * len(selected))})
+            ORDER BY row_version LIMIT ?
+        ''', (user_id, since, *selected, limit))
+        tombstones = cursor.fetchall()
+        if len(tombstones) == limit:
+            upper = min(upper, tombstones[-1][0])
+    conn.rollback()
+    conn.close()
+
+    result = {"cursor": upper, "has_more": upper < version, "reset": reset}
+    for table in selected:
+        result[table] = [dict(zip(SYNC_COLUMNS[table], r[1:])) for r in changed[table] if r[0] <= upper]
+    # 持ち主が移ってから戻ってきた行は、削除記録より新しい行として返すので削除には含めない
+    result["deleted"] = {table: [] for table in selected}
+    returned = {table: {row["id"] for row in result[table]} for table in selected}
+    for row_version, table, row_id in tombstones:
+        if row_version <= upper and row_id not in returned[table]:
+            result["deleted"][table].append(row_id)
+    return result
+
+# --- 冪等キー (Idempotency-Key) ---
+# 不安定な回線での再送やオフラインキューからの再生で同じ書き込みが二重に入らないよう、
+# Idempotency-Key 付きの JSON の書き込みリクエストは最初のレスポンスを保存し、同じキーの再送にはそれを返す。
+# キーは利用者・メソッド・パスと合わせてハッシュにし、リクエスト内容もハッシュ、レスポンス本文は圧縮して保存する。
+# ファイルのアップロードやストリーミングのレスポンス（/import など）は保存せずにそのまま通す。
+IDEMPOTENCY_TTL = 24 * 3600
+IDEMPOTENCY_LOCK_TTL = 60  # 処理中のキーを押さえておく時間。処理中は延長し続け、プロセスが落ちたらこの後に再試行できる
+IDEMPOTENCY_PRUNE_INTERVAL = 3600
+IDEMPOTENT_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+_idempotency_pruned_at = 0.0
+
+def claim_idempotency_key(key_hash, request_hash):
+    """キーを処理中として確保する。有効なキーが既にあれば (request_hash, status, headers, body) を返す"""
+    global _idempotency_pruned_at
+    now = time.time()
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    if now - _idempotency_pruned_at > IDEMPOTENCY_PRUNE_INTERVAL:
+        _idempotency_pruned_at = now
+        cursor.execute("DELETE FROM idempotency_keys WHERE expires_at <= ?", (now,))
+    cursor.execute('''
+        SELECT request_hash, status, headers, body FROM idempotency_keys
+        WHERE key_hash = ? AND expires_at > ?
+    ''', (key_hash, now))
+    row = cursor.fetchone()
+    if row is None:
+        cursor.execute('''
+            INSERT OR REPLACE INTO idempotency_keys (key_hash, request_hash, status, headers, body, expires_at)
+            VALUES (?, ?, NULL, NULL, NULL, ?)
+        ''', (key_hash, request_hash, now + IDEMPOTENCY_LOCK_TTL))
+    conn.commit()
+    conn.close()
+    return row
+
+def extend_idempotency_lock(key_hash):
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE idempotency_keys SET expires_at = ? WHERE key_hash = ? AND status IS NULL",
+        (time.time() + IDEMPOTENCY_LOCK_TTL, key_hash)
+    )
+    conn.commit()
+    conn.close()
+
+def save_idempotent_response(key_hash, status, headers, body):
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        UPDATE idempotency_keys SET status = ?, headers = ?, body = ?, expires_at = ? WHERE key_hash = ?
+    ''', (status, json.dumps(headers), zlib.compress(body), time.time() + IDEMPOTENCY_TTL, key_hash))
+    conn.commit()
+    conn.close()
+
+def release_idempotency_key(key_hash):
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM idempotency_keys WHERE key_hash = ? AND status IS NULL", (key_hash,))
+    conn.commit()
+    conn.close()
+
+async def hold_idempotency_lock(key_hash):
+    """ハンドラが動いている間、処理中のキーの期限を延ばし続ける（長い処理の途中で再送がキーを取れないように）"""
+    while True:
+        await asyncio.sleep(IDEMPOTENCY_LOCK_TTL / 3)
+        await run_in_threadpool(extend_idempotency_lock, key_hash)
+
+def idempotency_user(request, body):
+    """キーの持ち主。認証がないので current_user / user / user_id のクエリ、なければ JSON 本文の user_id"""
+    for name in ("current_user", "user", "user_id"):
+        if request.query_params.get(name):
+            return request.query_params[name]
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        return ""
+    if isinstance(data, list) and data:
+        data = data[0]
+    return str(data.get("user_id", "")) if isinstance(data, dict) else ""
+
+@app.middleware("http")
+async def idempotency_middleware(request: Request, call_next):
+    key = request.headers.get("Idempotency-Key")
+    content_type = request.headers.get("content-type", "")
+    if request.method not in IDEMPOTENT_METHODS or not key:
+        return await call_next(request)
+    if content_type and not content_type.startswith("application/json"):
+        return await call_next(request)  # アップロードは本文を読み込まずに通す
+    if len(key) > 255:
+        return JSONResponse({"detail": "Idempotency-Key が長すぎます"}, status_code=400)
+
+    body = await request.body()
+    scope = f"{idempotency_user(request, body)}\n{request.method} {request.url.path}\n{key}"
+    key_hash = hashlib.sha256(scope.encode()).digest()[:16]
+    request_hash = hashlib.sha256(request.url.query.encode() + b"\n" + body).digest()[:16]
+    saved = await run_in_threadpool(claim_idempotency_key, key_hash, request_hash)
+    if saved is not None:
+        saved_request_hash, status, headers, saved_body = saved
+        if saved_request_hash != request_hash:
+            return JSONResponse({"detail": "この Idempotency-Key は別の内容のリクエストに使われています"}, status_code=422)
+        if status is None:
+            return JSONResponse(
+                {"detail": "同じ Idempotency-Key のリクエストを処理中です"}, status_code=409, headers={"Retry-After": "1"}
+            )
+        response = Response(zlib.decompress(saved_body), status_code=status, headers=json.loads(headers))
+        response.headers["Idempotent-Replayed"] = "true"
+        return response
+
+    heartbeat = asyncio.create_task(hold_idempotency_lock(key_hash))
+    try:
+        response = await call_next(request)
+        # サーバーエラーは再試行できるようにキーを解放する。JSON 以外（ストリーミングなど）は保存しない
+        if response.status_code >= 500 or not response.headers.get("content-type", "").startswith("application/json"):
+            await run_in_threadpool(release_idempotency_key, key_hash)
+            return response
+        content = b"".join([chunk async for chunk in response.body_iterator])
+        headers = dict(response.headers)
+        await run_in_threadpool(save_idempotent_response, key_hash, response.status_code, headers, content)
+        return Response(content, status_code=response.status_code, headers=headers)
+    except BaseException:
+        await run_in_threadpool(release_idempotency_key, key_hash)
+        raise
+    finally:
+        heartbeat.cancel()
+
 if __name__ == "__main__":
     import uvicorn
     import os
+    import sys
+    if "--check-plans" in sys.argv:
+        conn = get_db()
+        failed = False
+        for name, ok, details in check_query_plans(conn):
+            print(f"[{'OK' if ok else 'NG'}] {name}: {' / '.join(details)}")
+            failed = failed or not ok
+        conn.close()
+        sys.exit(1 if failed else 0)
     port = int(os.environ.get("PORT", 8000))
     uvicorn.run(app, host="0.0.0.0", port=port)
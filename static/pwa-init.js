@@ -36,4 +36,10 @@ if ('serviceWorker' in navigator) {
       .then(reg => console.log(`SW registered (${swFile}):`, reg.scope))
       .catch(err => console.log('SW failed:', err));
   });
+
+  // Replay writes queued while offline (fallback for browsers without Background Sync)
+  const flushOutbox = () => navigator.serviceWorker.ready
+    .then(reg => reg.active && reg.active.postMessage({ type: 'flush-outbox' }));
+  window.addEventListener('online', flushOutbox);
+  window.addEventListener('load', flushOutbox);
 }
@@ -1,4 +1,4 @@
-const CACHE_NAME = 'kinapp-v1';
+const CACHE_NAME = 'kinapp-v6';
 const urlsToCache = [
     '/',
     '/static/index.html',
@@ -22,11 +22,216 @@ self.addEventListener('install', event => {
     self.skipWaiting();
 });
 
+// Offline write queue: writes that cannot reach the server are kept in IndexedDB and replayed
+// in order when the device reconnects (Background Sync, or a message from the page where that API
+// is missing). Every write carries an Idempotency-Key that is reused for its replays, so retries
+// never create duplicate rows on the server. Runs of queued memo creations are replayed as a
+// single POST /memo/batch instead of one round trip each.
+const OUTBOX_DB = 'kinapp-outbox';
+const OUTBOX_STORE = 'requests';
+const OUTBOX_SYNC_TAG = 'kinapp-outbox';
+const QUEUEABLE_PATHS = ['/memo', '/meals', '/weights', '/exercises', '/friends', '/settings'];
+const MEMO_BATCH_MAX = 50;
+
+function openOutbox() {
+    return new Promise((resolve, reject) => {
+        const req = indexedDB.open(OUTBOX_DB, 1);
+        req.onupgradeneeded = () => req.result.createObjectStore(OUTBOX_STORE, { keyPath: 'id', autoIncrement: true });
+        req.onsuccess = () => resolve(req.result);
+        req.onerror = () => reject(req.error);
+    });
+}
+
+async function outbox(mode, operation) {
+    const db = await openOutbox();
+    return new Promise((resolve, reject) => {
+        const tx = db.transaction(OUTBOX_STORE, mode);
+        const req = operation(tx.objectStore(OUTBOX_STORE));
+        tx.oncomplete = () => { db.close(); resolve(req.result); };
+        tx.onerror = () => { db.close(); reject(tx.error); };
+    });
+}
+
+const outboxAdd = entry => outbox('readwrite', store => store.add(entry));
+const outboxDelete = id => outbox('readwrite', store => store.delete(id));
+const outboxCount = () => outbox('readonly', store => store.count());
+const outboxHead = limit => outbox('readonly', store => store.getAll(undefined, limit));
+const outboxPutAll = entries => outbox('readwrite', store => entries.map(entry => store.put(entry)).pop());
+const outboxDeleteAll = entries => outbox('readwrite', store => entries.map(entry => store.delete(entry.id)).pop());
+
+function isQueueableWrite(request, url) {
+    if (request.method === 'GET' || request.method === 'HEAD') return false;
+    if (url.origin !== self.location.origin) return false;
+    if (!QUEUEABLE_PATHS.some(path => url.pathname.startsWith(path))) return false;
+    // Only JSON (or empty) bodies; uploads such as /import are left alone
+    const type = request.headers.get('Content-Type') || '';
+    return type === '' || type.startsWith('application/json');
+}
+
+function sendEntry(entry) {
+    const headers = { 'Idempotency-Key': entry.key };
+    if (entry.contentType) headers['Content-Type'] = entry.contentType;
+    return fetch(entry.url, { method: entry.method, headers, body: entry.body || undefined });
+}
+
+async function handleWrite(request) {
+    const entry = {
+        url: request.url,
+        method: request.method,
+        contentType: request.headers.get('Content-Type'),
+        key: request.headers.get('Idempotency-Key') || self.crypto.randomUUID(),
+        body: await request.text(),
+        createdAt: Date.now()
+    };
+    // Writes must stay in order: while older ones are queued, new ones wait behind them
+    if (await outboxCount() === 0) {
+        try {
+            return await sendEntry(entry);
+        } catch (e) {
+            // Network error: queue it below
+        }
+    }
+    await outboxAdd(entry);
+    requestFlush();
+    return new Response(
+        JSON.stringify({ queued: true, message: 'オフラインのため保存しました。接続が戻ると送信されます' }),
+        { status: 202, headers: { 'Content-Type': 'application/json' } }
+    );
+}
+
+function requestFlush() {
+    const flushNow = () => flushOutbox().catch(() => {});
+    if (self.registration.sync) {
+        self.registration.sync.register(OUTBOX_SYNC_TAG).catch(flushNow);
+    } else {
+        // No Background Sync: try once now; the page also asks again when it comes back online
+        flushNow();
+    }
+}
+
+function isMemoCreate(entry) {
+    const url = new URL(entry.url);
+    return entry.method === 'POST' && url.pathname === '/memo' && url.search === '';
+}
+
+// The next entries to send: a run of memo creations, or a single other write. A new run gets its
+// batch key written back to the outbox before it is sent, so a retry resends exactly the same
+// batch under the same key even if more memos were queued in the meantime
+async function nextGroup() {
+    const entries = await outboxHead(MEMO_BATCH_MAX);
+    if (entries.length === 0) return [];
+    const [first] = entries;
+    if (first.batchKey) {
+        const end = entries.findIndex(entry => entry.batchKey !== first.batchKey);
+        return end === -1 ? entries : entries.slice(0, end);
+    }
+    let count = 0;
+    while (count < entries.length && isMemoCreate(entries[count]) && !entries[count].batchKey) count++;
+    if (count < 2) return [first];
+    const group = entries.slice(0, count);
+    const batchKey = self.crypto.randomUUID();
+    group.forEach(entry => { entry.batchKey = batchKey; });
+    await outboxPutAll(group);
+    return group;
+}
+
+function sendBatch(group) {
+    return fetch(new URL('/memo/batch', group[0].url).href, {
+        method: 'POST',
+        headers: { 'Idempotency-Key': group[0].batchKey, 'Content-Type': 'application/json' },
+        body: `[${group.map(entry => entry.body).join(',')}]`
+    });
+}
+
+// A network error throws in the callers and leaves the entries queued. Background Sync then
+// retries with its own backoff, so a dead connection never turns into a retry storm
+function checkBusy(response) {
+    if (response.status >= 500 || response.status === 409 || response.status === 429) {
+        throw new Error(`outbox: server busy (${response.status})`);
+    }
+}
+
+async function sendQueued(entry) {
+    const response = await sendEntry(entry);
+    checkBusy(response);
+    if (!response.ok) {
+        // Rejected for good (validation error etc.): retrying would never succeed
+        console.warn('outbox: dropping rejected write', entry.method, entry.url, response.status);
+    }
+    await outboxDelete(entry.id);
+}
+
+async function drainOutbox() {
+    let sent = 0;
+    try {
+        for (let group = await nextGroup(); group.length > 0; group = await nextGroup()) {
+            if (group.length === 1) {
+                await sendQueued(group[0]);
+                sent++;
+                continue;
+            }
+            const response = await sendBatch(group);
+            checkBusy(response);
+            if (response.ok) {
+                await outboxDeleteAll(group);
+                sent += group.length;
+                continue;
+            }
+            // One invalid memo rejects the whole batch: send them one by one so the rest still get in
+            for (const entry of group) {
+                await sendQueued(entry);
+                sent++;
+            }
+        }
+    } finally {
+        if (sent > 0) {
+            const clients = await self.clients.matchAll({ type: 'window' });
+            clients.forEach(client => client.postMessage({ type: 'outbox-flushed', sent }));
+        }
+    }
+}
+
+let flushing = null;
+function flushOutbox() {
+    if (!flushing) {
+        flushing = drainOutbox().finally(() => { flushing = null; });
+    }
+    return flushing;
+}
+
+self.addEventListener('sync', event => {
+    if (event.tag === OUTBOX_SYNC_TAG) {
+        event.waitUntil(flushOutbox());
+    }
+});
+
+self.addEventListener('message', event => {
+    if (event.data && event.data.type === 'flush-outbox') {
+        event.waitUntil(flushOutbox().catch(() => {}));
+    }
+});
+
 // Fetch event - serve from cache, fallback to network
 self.addEventListener('fetch', event => {
     const { request } = event;
     const url = new URL(request.url);
 
+    // Server-sent events: let the stream pass through untouched (never cache)
+    if (request.headers.get('Accept') === 'text/event-stream') {
+        return;
+    }
+
+    // Writes: sent with an Idempotency-Key, queued for background sync when offline
+    if (isQueueableWrite(request, url)) {
+        event.respondWith(handleWrite(request));
+        return;
+    }
+
+    // Delta sync: the page keeps its own replica, so never cache these responses
+    if (url.pathname === '/sync') {
+        return;
+    }
+
     // API requests: Network-first strategy
     if (url.pathname.startsWith('/api/') ||
         url.pathname.startsWith('/memo') ||
@@ -40,7 +245,7 @@ self.addEventListener('fetch', event => {
             fetch(request)
                 .then(response => {
                     // Clone and cache successful responses
-                    if (response.ok) {
+                    if (response.ok && request.method === 'GET') {
                         const responseClone = response.clone();
                         caches.open(CACHE_NAME).then(cache => {
                             cache.put(request, responseClone);
@@ -0,0 +1,46 @@
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main はインポート時にDBを作るので、その前に一時ディレクトリと偽のLLMを指定する
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP_DIR = tempfile.mkdtemp(prefix="kinapp-test-")
+os.environ["DB_FILE"] = os.path.join(TMP_DIR, "memo.db")
+os.environ["SEMANTIC_CACHE_FILE"] = os.path.join(TMP_DIR, "nutrition_vectors.i8")
+os.environ["LLM_BACKEND"] = "fake"
+os.environ["LLM_FAKE_LATENCY_MS"] = "0"
+os.environ["LLM_FAKE_JITTER_MS"] = "0"
+os.chdir(ROOT)  # static/ を相対パスでマウントしている
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+_user_ids = itertools.count(1)
+
+@pytest.fixture(scope="session")
+def client():
+    with TestClient(main.app) as c:
+        yield c
+
+@pytest.fixture
+def paused_jobs(client):
+    """アプリのジョブワーカーを止める（別プロセスのジョブキューの模擬や、DBを差し替えるテスト用）"""
+    client.portal.call(main.job_queue.stop)
+    yield
+    client.portal.call(main.job_queue.start)
+
+@pytest.fixture
+def make_user(client):
+    """テストごとに重ならないユーザーを登録して名前を返す"""
+    def make(prefix="user"):
+        name = f"{prefix}{next(_user_ids)}"
+        assert client.post("/register", json={"username": name, "password": "pw"}).status_code == 200
+        return name
+    return make
+
+def memo(user, date="2024-01-01", exercise="ベンチプレス", weight=60.0, reps=5, note=""):
+    return {"user_id": user, "date": date, "exercise": exercise, "weight": weight, "reps": reps, "note": note}
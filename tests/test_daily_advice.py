@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+import main
+
+@pytest.fixture
+def no_llm(monkeypatch):
+    monkeypatch.setattr(main.LLMClient, "available", property(lambda self: False))
+
+def add_meal(client, user, date="2024-01-01"):
+    client.post("/meals", json={"user_id": user, "date": date, "meal_type": "昼食", "food_name": "唐揚げ定食",
+                                "calories": 900, "protein": 35.0, "fat": 45.0, "carbs": 90.0})
+
+def streamed_done(client, user, date="2024-01-01"):
+    text = client.get("/api/daily_advice/stream", params={"user_id": user, "date": date}).text
+    events = [block.split("\n") for block in text.strip().split("\n\n")]
+    done = [lines for lines in events if "event: done" in lines]
+    assert len(done) == 1
+    return json.loads(next(line for line in done[0] if line.startswith("data: "))[len("data: "):])
+
+def test_advice_without_llm_falls_back_to_template(client, make_user, no_llm):
+    user = make_user()
+    add_meal(client, user)
+    expected = "今日の合計は 900kcal"
+
+    response = client.post("/api/daily_advice", json={"user_id": user, "date": "2024-01-01"})
+    assert response.status_code == 200
+    assert response.json()["degraded"] is True
+    assert response.json()["advice"].startswith(expected)
+
+    done = streamed_done(client, user)
+    assert done["degraded"] is True
+    assert done["advice"].startswith(expected)
+
+def test_advice_without_llm_or_meals(client, make_user, no_llm):
+    user = make_user()
+    response = client.post("/api/daily_advice", json={"user_id": user, "date": "2024-01-01"})
+    assert response.json() == {"advice": main.NO_MEALS_ADVICE}
+    assert streamed_done(client, user) == {"advice": main.NO_MEALS_ADVICE}
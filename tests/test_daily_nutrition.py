@@ -0,0 +1,26 @@
+import pytest
+
+def meal(user, date="2024-01-01", calories=500, protein=20.0, fat=15.0, carbs=60.0):
+    return {"user_id": user, "date": date, "meal_type": "昼食", "food_name": "定食",
+            "calories": calories, "protein": protein, "fat": fat, "carbs": carbs}
+
+def day(client, user, date="2024-01-01"):
+    days = client.get("/meals/daily", params={"user_id": user, "from": date, "to": date}).json()["days"]
+    return days[0] if days else None
+
+def test_daily_totals_follow_meal_writes(client, make_user):
+    user = make_user()
+    client.post("/meals", json=meal(user))
+    client.post("/meals", json=meal(user, calories=300, protein=10.0, fat=5.0, carbs=40.0))
+    client.post("/meals", json=meal(user, date="2024-01-02"))
+
+    totals = day(client, user)
+    assert totals["meal_count"] == 2
+    assert (totals["calories"], totals["protein"], totals["fat"], totals["carbs"]) == (800, 30.0, 20.0, 100.0)
+
+    meals = client.get("/meals", params={"user_id": user, "date": "2024-01-01"}).json()
+    client.delete(f"/meals/{meals[0]['id']}")
+    assert day(client, user)["calories"] == pytest.approx(300)
+    client.delete(f"/meals/{meals[1]['id']}")
+    assert day(client, user) is None
+    assert day(client, user, "2024-01-02")["calories"] == pytest.approx(500)
@@ -0,0 +1,37 @@
+import threading
+
+import main
+
+def test_connection_is_returned_and_reused(paused_jobs):
+    conn = main.get_db()
+    conn.execute("BEGIN IMMEDIATE")
+    conn.close()
+    conn.close()  # 二重に返しても1回だけプールに入る
+    again = main.get_db()
+    assert again is conn
+    assert not again.in_transaction
+    assert main.get_db() is not again
+    again.close()
+
+def test_exited_threads_do_not_leak_connections(monkeypatch, paused_jobs):
+    def burst():
+        barrier = threading.Barrier(30)
+        def request():
+            conn = main.get_db()
+            barrier.wait()  # 30本同時に借りる
+            conn.execute("SELECT 1").fetchall()
+            conn.close()
+        threads = [threading.Thread(target=request) for _ in range(30)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    burst()
+    opened = []
+    open_db = main.open_db
+    monkeypatch.setattr(main, "open_db", lambda: opened.append(1) or open_db())
+    burst()  # 前回のスレッドはすべて終了しているが、その接続をそのまま使う
+    burst()
+    assert opened == []
+    assert main._db_pool.qsize() <= main.DB_POOL_SIZE
@@ -0,0 +1,86 @@
+import gzip
+import json
+
+import pytest
+
+import main
+from conftest import memo
+
+def fill(client, user):
+    client.post("/memo/batch", json=[memo(user, date=f"2024-01-{d:02d}", reps=d, note="メモ,\"引用\"") for d in range(1, 6)])
+    client.post("/meals", json={"user_id": user, "date": "2024-01-02", "meal_type": "昼食", "food_name": "おにぎり",
+                                "calories": 180, "protein": 3.0, "fat": 1.0, "carbs": 39.0})
+    client.post("/weights", json={"user_id": user, "date": "2024-01-03", "weight": 70.5})
+
+def exported_rows(client, user):
+    """id を除いたエクスポート内容（種類ごとに並べ替え）"""
+    lines = client.get("/export", params={"user": user}).text.splitlines()
+    rows = [{k: v for k, v in json.loads(line).items() if k != "id"} for line in lines]
+    return sorted(rows, key=lambda row: json.dumps(row, sort_keys=True, ensure_ascii=False))
+
+@pytest.mark.parametrize("fmt,compress", [("ndjson", False), ("csv", False), ("ndjson", True), ("csv", True)])
+def test_export_then_import_round_trips(client, make_user, fmt, compress):
+    source, target = make_user(), make_user()
+    fill(client, source)
+    exported = client.get("/export", params={"user": source, "format": fmt, "gzip": compress}).content
+    if compress:
+        assert gzip.decompress(exported)
+
+    name = f"data.{fmt}" + (".gz" if compress else "")
+    response = client.post("/import", params={"user": target, "format": fmt}, files={"file": (name, exported)})
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert events[-1]["event"] == "done"
+    assert events[-1]["imported"] == {"memo": 5, "meal": 1, "weight": 1}
+    assert exported_rows(client, target) == exported_rows(client, source)
+
+def test_import_skips_invalid_rows_and_keeps_the_rest(client, make_user):
+    user = make_user()
+    lines = [
+        json.dumps({"type": "memo", "date": "2024-01-01", "exercise": "デッドリフト", "weight": 120, "reps": 3}),
+        "{壊れた行",
+        json.dumps({"type": "memo", "date": "いつか", "exercise": "デッドリフト", "weight": 120, "reps": 3}),
+        json.dumps({"type": "unknown"}),
+    ]
+    response = client.post("/import", params={"user": user, "format": "ndjson"},
+                           files={"file": ("data.ndjson", "\n".join(lines).encode())})
+    done = [json.loads(line) for line in response.text.splitlines()][-1]
+    assert done["imported"]["memo"] == 1
+    assert done["skipped"] == 3
+    assert [error["line"] for error in done["errors"]] == [2, 3, 4]
+
+def import_events(client, user, fmt, text):
+    response = client.post("/import", params={"user": user, "format": fmt},
+                           files={"file": (f"data.{fmt}", text.encode())})
+    return [json.loads(line) for line in response.text.splitlines()]
+
+def test_malformed_rows_do_not_abort_the_import(client, make_user):
+    user = make_user()
+    csv_text = "\n".join([
+        "type,id,date,exercise,weight,reps,note",
+        "memo,1,2024-01-01,ベンチプレス,60,5,ok",
+        "memo,2,2024-01-02,ベンチプレス,60,5,引用なし,カンマ",
+        "memo,3,2024-01-03,ベンチプレス,60,5,ok",
+    ])
+    done = import_events(client, user, "csv", csv_text)[-1]
+    assert done["event"] == "done"
+    assert done["imported"]["memo"] == 2
+    assert [error["line"] for error in done["errors"]] == [3]
+
+    ndjson_text = "\n".join([
+        json.dumps({"type": ["memo"]}),
+        json.dumps({"type": {"k": 1}}),
+        json.dumps({"type": "memo", "date": "2024-01-04", "exercise": "ベンチプレス", "weight": 60, "reps": 5}),
+    ])
+    done = import_events(client, user, "ndjson", ndjson_text)[-1]
+    assert done["event"] == "done"
+    assert done["imported"]["memo"] == 1
+    assert done["skipped"] == 2
+
+def test_chunks_flush_on_valid_row_count(client, make_user, monkeypatch):
+    monkeypatch.setattr(main, "IMPORT_CHUNK_ROWS", 2)
+    user = make_user()
+    valid = json.dumps({"type": "weight", "date": "2024-01-01", "weight": 70})
+    # 2行目（チャンクの境目）が不正でも、有効な行が2行たまるたびにコミットされる
+    events = import_events(client, user, "ndjson", "\n".join([valid, "{", valid, valid, "{", valid]))
+    assert [e["imported"]["weight"] for e in events if e["event"] == "progress"] == [2, 4]
+    assert events[-1]["imported"]["weight"] == 4
@@ -0,0 +1,67 @@
+import asyncio
+import json
+
+import main
+from conftest import memo
+
+def memo_count(client, user):
+    response = client.get("/sync", params={"user_id": user, "since": 0})
+    return len(response.json()["memos"])
+
+def test_retry_with_same_key_replays_first_response(client, make_user):
+    user = make_user()
+    headers = {"Idempotency-Key": "retry-1"}
+    first = client.post("/memo", json=memo(user), headers=headers)
+    second = client.post("/memo", json=memo(user), headers=headers)
+    assert first.status_code == second.status_code == 200
+    assert second.json() == first.json()
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert memo_count(client, user) == 1
+
+def test_same_key_with_different_body_is_rejected(client, make_user):
+    user = make_user()
+    headers = {"Idempotency-Key": "reused"}
+    assert client.post("/memo", json=memo(user, reps=5), headers=headers).status_code == 200
+    assert client.post("/memo", json=memo(user, reps=6), headers=headers).status_code == 422
+    assert memo_count(client, user) == 1
+
+def test_keys_are_scoped_per_user(client, make_user):
+    alice, bob = make_user(), make_user()
+    headers = {"Idempotency-Key": "shared-key"}
+    a = client.post("/memo", json=memo(alice), headers=headers)
+    b = client.post("/memo", json=memo(bob), headers=headers)
+    assert a.status_code == b.status_code == 200
+    assert "Idempotent-Replayed" not in b.headers
+    assert a.json()["id"] != b.json()["id"]
+    assert memo_count(client, alice) == memo_count(client, bob) == 1
+
+def test_streaming_import_is_not_buffered_or_stored(client, make_user):
+    user = make_user()
+    line = json.dumps({"type": "memo", "date": "2024-01-01", "exercise": "スクワット", "weight": 80, "reps": 5})
+    for _ in range(2):
+        response = client.post(
+            "/import", params={"user": user, "format": "ndjson"},
+            files={"file": ("data.ndjson", (line + "\n").encode())},
+            headers={"Idempotency-Key": "import-1"},
+        )
+        assert response.status_code == 200
+        assert "Idempotent-Replayed" not in response.headers
+    assert memo_count(client, user) == 2
+
+def test_lock_is_renewed_while_handler_runs(monkeypatch):
+    monkeypatch.setattr(main, "IDEMPOTENCY_LOCK_TTL", 0.3)
+    key_hash, request_hash = b"lock-renew-test1", b"request-hash-001"
+
+    async def slow_handler():
+        assert main.claim_idempotency_key(key_hash, request_hash) is None
+        heartbeat = asyncio.create_task(main.hold_idempotency_lock(key_hash))
+        try:
+            await asyncio.sleep(1.0)
+        finally:
+            heartbeat.cancel()
+
+    asyncio.run(slow_handler())
+    # ロック期間の3倍以上たっても、処理中として押さえられたまま
+    row = main.claim_idempotency_key(key_hash, request_hash)
+    assert row is not None and row[1] is None
+    main.release_idempotency_key(key_hash)
@@ -0,0 +1,93 @@
+import asyncio
+import sqlite3
+import time
+
+import main
+
+def test_worker_survives_errors_while_finishing_a_job(monkeypatch):
+    handled = []
+
+    async def handler(payload):
+        handled.append(payload["n"])
+        return {"n": payload["n"]}
+
+    monkeypatch.setitem(main.JOB_KINDS, "test", (None, handler))
+    monkeypatch.setattr(main, "JOB_POLL_INTERVAL", 0.01)
+    jobs = [(1, "test", {"n": 1}, 1), (2, "test", {"n": 2}, 1)]
+    finished = []
+    queue = main.JobQueue(workers=1)
+
+    def claim():
+        return jobs.pop(0) if jobs else None
+
+    def finish(job_id, attempts, status, **kwargs):
+        if job_id == 1:
+            raise sqlite3.OperationalError("database is locked")
+        finished.append((job_id, status))
+
+    monkeypatch.setattr(queue, "_claim", claim)
+    monkeypatch.setattr(queue, "_finish", finish)
+
+    async def scenario():
+        queue._wakeup = asyncio.Event()
+        worker = asyncio.create_task(queue._worker())
+        for _ in range(200):
+            if finished:
+                break
+            await asyncio.sleep(0.01)
+        assert not worker.done()
+        worker.cancel()
+
+    asyncio.run(scenario())
+    assert handled == [1, 2]
+    assert finished == [(2, "done")]
+
+def insert_job(status, attempts, run_after):
+    conn = main.get_db()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO llm_jobs (kind, payload, dedup_key, status, attempts, created_at, updated_at, run_after)
+        VALUES ('estimate_nutrition', '{"text": "x"}', ?, ?, ?, ?, ?, ?)
+    ''', (f"lease-test-{time.time()}", status, attempts, time.time(), time.time(), run_after))
+    job_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return job_id
+
+def job_status(job_id):
+    conn = main.get_db()
+    row = conn.execute("SELECT status, attempts FROM llm_jobs WHERE id = ?", (job_id,)).fetchone()
+    conn.close()
+    return row
+
+def test_startup_does_not_steal_jobs_running_in_another_process(paused_jobs):
+    job_id = insert_job("running", 1, time.time() + main.JOB_LEASE)
+    other = main.JobQueue(workers=1)
+    other._prune()
+    assert other._claim() is None
+    assert job_status(job_id) == ("running", 1)
+    main.JobQueue()._finish(job_id, 1, "done", result={})
+    assert job_status(job_id) == ("done", 1)
+
+def test_expired_lease_is_reclaimed_and_stale_result_discarded(paused_jobs):
+    job_id = insert_job("running", 1, time.time() - 1)
+    other = main.JobQueue(workers=1)
+    claimed = other._claim()
+    assert claimed[0] == job_id and claimed[3] == 2
+    assert other._finish(job_id, 1, "done", result={"stale": True}) is False
+    assert other._finish(job_id, 2, "done", result={}) is True
+    assert job_status(job_id) == ("done", 2)
+
+def test_lease_is_extended_while_the_job_runs(paused_jobs, monkeypatch):
+    monkeypatch.setattr(main, "JOB_LEASE", 0.3)
+    job_id = insert_job("running", 1, time.time() + main.JOB_LEASE)
+    queue = main.JobQueue(workers=1)
+
+    async def slow_job():
+        lease = asyncio.create_task(queue._hold_lease(job_id, 1))
+        await asyncio.sleep(1.0)
+        lease.cancel()
+
+    asyncio.run(slow_job())
+    assert main.JobQueue()._claim() is None
+    queue._finish(job_id, 1, "done", result={})
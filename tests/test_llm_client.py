@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+import main
+
+class ControlledBackend:
+    """generate() が release() されるまで返らない上流"""
+    name = "controlled"
+    available = True
+
+    def __init__(self):
+        self.gates = []
+        self.fail = False
+
+    async def generate(self, prompt, timeout):
+        gate = asyncio.Event()
+        self.gates.append(gate)
+        await gate.wait()
+        if self.fail:
+            raise RuntimeError("upstream error")
+        return f"answer: {prompt}"
+
+    def release(self):
+        for gate in self.gates:
+            gate.set()
+        self.gates.clear()
+
+def force_half_open_on_next_call(breaker):
+    breaker.state = "open"
+    breaker._opened_at = -breaker.cooldown
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_probe_cancelled_while_queued_on_semaphore_is_returned():
+    async def scenario():
+        backend = ControlledBackend()
+        client = main.LLMClient(backend, timeout=5, max_concurrency=1)
+        # 閉じている間に始まった呼び出しがセマフォを埋める
+        busy = asyncio.ensure_future(client._call("busy", 5))
+        await settle()
+        force_half_open_on_next_call(client.breaker)
+
+        probe = asyncio.ensure_future(client._call("probe", 5))
+        await settle()
+        assert client.breaker.state == "half_open"
+        assert client.breaker._probing == 1
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert client.breaker._probing == 0
+
+        # 閉じている間に始まった呼び出しの結果では半開状態は変わらない
+        backend.fail = True
+        backend.release()
+        with pytest.raises(RuntimeError):
+            await busy
+        assert client.breaker.state == "half_open"
+
+        # 次の試行が通り、成功すれば閉じる
+        backend.fail = False
+        retry = asyncio.ensure_future(client._call("retry", 5))
+        await settle()
+        backend.release()
+        assert await retry == "answer: retry"
+        assert client.breaker.state == "closed"
+
+    asyncio.run(scenario())
+
+def test_only_current_probe_decides_half_open_outcome():
+    breaker = main.CircuitBreaker(probes=1)
+    assert breaker.before_call() is None
+    force_half_open_on_next_call(breaker)
+    probe = breaker.before_call()
+    assert probe is not None
+    with pytest.raises(main.CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record(True, 0.1)  # 試行トークンを持たない呼び出し
+    assert breaker.state == "half_open"
+    breaker.record(False, 0.1, probe=probe)
+    assert breaker.state == "open"
+
+    # 前の回の試行トークンは新しい半開状態に影響しない
+    force_half_open_on_next_call(breaker)
+    new_probe = breaker.before_call()
+    breaker.abandon(probe)
+    assert breaker._probing == 1
+    breaker.record(True, 0.1, probe=new_probe)
+    assert breaker.state == "closed"
+
+def test_deadline_covers_waiting_for_the_semaphore():
+    async def scenario():
+        backend = ControlledBackend()
+        client = main.LLMClient(backend, timeout=5, max_concurrency=1)
+        busy = asyncio.ensure_future(client._call("busy", 5))
+        await settle()
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        with pytest.raises(asyncio.TimeoutError):
+            await client.generate("queued", timeout=0.05)
+        assert loop.time() - start < 1
+        assert client.timeouts == 1
+        with pytest.raises(asyncio.TimeoutError):
+            async for _ in client.stream("queued stream", timeout=0.05):
+                pass
+        assert client.timeouts == 2
+        # 待っていただけの呼び出しは上流の失敗として数えない
+        assert client.breaker.stats()["error_rate"] is None
+
+        backend.release()
+        assert await busy == "answer: busy"
+        # セマフォは返っている
+        second = asyncio.ensure_future(client._call("after", 5))
+        await settle()
+        backend.release()
+        assert await second == "answer: after"
+
+    asyncio.run(scenario())
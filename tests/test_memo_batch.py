@@ -0,0 +1,77 @@
+import main
+from conftest import memo
+
+def training_summary(user):
+    conn = main.open_db()
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM exercise_sessions WHERE user_id = ? ORDER BY exercise, date", (user,))
+    sessions = cursor.fetchall()
+    cursor.execute("SELECT * FROM exercise_prs WHERE user_id = ? ORDER BY exercise, reps", (user,))
+    prs = cursor.fetchall()
+    conn.dispose()
+    return sessions, prs
+
+def rebuilt_summary(user):
+    """全履歴から作り直した集計（コミットせずに読んで戻す）"""
+    conn = main.open_db()
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    main.rebuild_training_analytics(cursor)
+    cursor.execute("SELECT * FROM exercise_sessions WHERE user_id = ? ORDER BY exercise, date", (user,))
+    sessions = cursor.fetchall()
+    cursor.execute("SELECT * FROM exercise_prs WHERE user_id = ? ORDER BY exercise, reps", (user,))
+    prs = cursor.fetchall()
+    conn.rollback()
+    conn.dispose()
+    return sessions, prs
+
+def test_batch_writes_keep_analytics_in_sync(client, make_user):
+    user = make_user()
+    sets = [
+        memo(user, date="2024-01-01", weight=60, reps=5),
+        memo(user, date="2024-01-01", weight=70, reps=3),
+        memo(user, date="2024-01-03", weight=65, reps=5),
+        memo(user, date="2024-01-03", exercise="スクワット", weight=100, reps=5),
+    ]
+    response = client.post("/memo/batch", json=sets)
+    assert response.status_code == 200
+    ids = response.json()["ids"]
+    assert len(ids) == 4
+    assert training_summary(user) == rebuilt_summary(user)
+
+    # 日付・種目をまたいで動かし、PRだったセットを消す
+    moved = {**memo(user, date="2024-01-05", exercise="スクワット", weight=110, reps=3), "id": ids[0]}
+    response = client.put("/memo/batch", json=[moved, {**sets[2], "id": ids[2], "reps": 8}])
+    assert response.json()["ids"] == [ids[0], ids[2]]
+    assert training_summary(user) == rebuilt_summary(user)
+
+    response = client.request("DELETE", "/memo/batch", json=[ids[1], ids[3]])
+    assert sorted(response.json()["ids"]) == sorted([ids[1], ids[3]])
+    assert training_summary(user) == rebuilt_summary(user)
+
+def test_batch_reports_missing_ids(client, make_user):
+    user = make_user()
+    memo_id = client.post("/memo", json=memo(user)).json()["id"]
+    missing = memo_id + 10_000
+
+    response = client.put("/memo/batch", json=[{**memo(user, reps=9), "id": memo_id}, {**memo(user), "id": missing}])
+    assert response.json()["ids"] == [memo_id]
+    assert response.json()["not_found"] == [missing]
+
+    response = client.request("DELETE", "/memo/batch", json=[memo_id, missing])
+    assert response.json()["ids"] == [memo_id]
+    assert response.json()["not_found"] == [missing]
+
+def test_empty_or_oversized_batch_is_rejected(client, make_user):
+    user = make_user()
+    assert client.post("/memo/batch", json=[]).status_code == 400
+    too_many = [memo(user)] * (main.MEMO_BATCH_MAX + 1)
+    assert client.post("/memo/batch", json=too_many).status_code == 400
+    assert client.request("DELETE", "/memo/batch", json=[]).status_code == 400
+
+def test_batch_route_is_not_taken_as_a_memo_id(client, make_user):
+    user = make_user()
+    memo_id = client.post("/memo", json=memo(user)).json()["id"]
+    response = client.put("/memo/batch", json=[{**memo(user, reps=7), "id": memo_id}])
+    assert response.status_code == 200
+    assert client.get("/memo", params={"id": memo_id}).json()["items"][0]["reps"] == 7
@@ -0,0 +1,35 @@
+from conftest import memo
+
+def all_pages(client, path, params, limit):
+    seen, cursor, pages = [], None, 0
+    while True:
+        page = client.get(path, params={**params, "limit": limit, **({"cursor": cursor} if cursor else {})}).json()
+        seen.extend((item["date"], item["id"]) for item in page["items"])
+        cursor, pages = page["next_cursor"], pages + 1
+        if cursor is None:
+            return seen, pages
+
+def test_pages_cover_every_memo_once_in_order(client, make_user):
+    user = make_user()
+    # 同じ日付のメモが多く、ページの境目が日付の途中に来る
+    dates = ["2024-01-01", "2024-01-02", "2024-01-02", "2024-01-02", "2024-01-03"] * 3
+    ids = client.post("/memo/batch", json=[memo(user, date=d) for d in dates]).json()["ids"]
+    expected = sorted(zip(dates, ids), reverse=True)
+
+    assert all_pages(client, "/memo", {"user_id": user}, 4) == (expected, 4)
+    assert all_pages(client, "/memo_v2", {"viewer_id": user, "filter_mode": "mine"}, 5) == (expected, 3)
+
+def test_new_memos_do_not_shift_later_pages(client, make_user):
+    user = make_user()
+    ids = client.post("/memo/batch", json=[memo(user, date=f"2024-02-{d:02d}") for d in range(1, 11)]).json()["ids"]
+    first = client.get("/memo", params={"user_id": user, "limit": 4}).json()
+    client.post("/memo", json=memo(user, date="2024-03-01"))
+
+    rest = client.get("/memo", params={"user_id": user, "limit": 100, "cursor": first["next_cursor"]}).json()
+    seen = [item["id"] for item in first["items"] + rest["items"]]
+    assert seen == ids[::-1]
+
+def test_malformed_cursor_is_rejected(client, make_user):
+    user = make_user()
+    for cursor in ("not-a-cursor", "W10", "WyJhIl0"):
+        assert client.get("/memo", params={"user_id": user, "cursor": cursor}).status_code == 400
@@ -0,0 +1,13 @@
+from conftest import memo
+
+def memo_dates(client, **params):
+    return sorted(item["date"] for item in client.get("/memo", params=params).json()["items"])
+
+def test_partial_date_is_a_prefix_match(client, make_user):
+    user = make_user()
+    for date in ("2024-04-30", "2024-05-01", "2024-05-31", "2025-05-01"):
+        client.post("/memo", json=memo(user, date=date))
+
+    assert memo_dates(client, user_id=user, date="2024-05") == ["2024-05-01", "2024-05-31"]
+    assert memo_dates(client, user_id=user, date="2024") == ["2024-04-30", "2024-05-01", "2024-05-31"]
+    assert memo_dates(client, user_id=user, date="2024/5/1") == ["2024-05-01"]
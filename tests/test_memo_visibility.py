@@ -0,0 +1,112 @@
+import random
+import sqlite3
+
+import main
+from conftest import memo
+
+def visible_memos_python_loop(viewer_id, target_user, filter_mode, exercise):
+    """/memo_v2 の以前の実装（行ごとに friends を引いて公開範囲を判定する）"""
+    conn = sqlite3.connect(main.DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute("SELECT friend_id FROM friends WHERE user_id = ?", (viewer_id,))
+    following = {row[0] for row in cursor.fetchall()}
+    following.add(viewer_id)
+
+    query = """
+        SELECT m.id, m.user_id, m.date, m.exercise, m.weight, m.reps, m.note, u.visibility
+        FROM memos m
+        JOIN users u ON m.user_id = u.username
+    """
+    conditions = []
+    values = []
+    if target_user:
+        conditions.append("m.user_id = ?")
+        values.append(target_user)
+    if filter_mode == 'mine':
+        conditions.append("m.user_id = ?")
+        values.append(viewer_id)
+    elif filter_mode == 'friends':
+        conditions.append(f"m.user_id IN ({','.join(['?'] * len(following))})")
+        values.extend(following)
+    if exercise:
+        conditions.append("m.exercise LIKE ?")
+        values.append(f"%{exercise}%")
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    cursor.execute(query, values)
+
+    results = set()
+    for m_id, m_uid, _, _, _, _, _, u_vis in cursor.fetchall():
+        if m_uid == viewer_id:
+            results.add(m_id)
+        elif u_vis == 'private':
+            continue
+        elif u_vis == 'friends':
+            cursor.execute("SELECT 1 FROM friends WHERE user_id = ? AND friend_id = ?", (m_uid, viewer_id))
+            if m_uid in following and cursor.fetchone() is not None:
+                results.add(m_id)
+        else:
+            results.add(m_id)
+    conn.close()
+    return results
+
+def visible_memos_api(client, viewer_id, target_user, filter_mode, exercise):
+    params = {"viewer_id": viewer_id, "filter_mode": filter_mode, "limit": main.MEMO_PAGE_SIZE_MAX}
+    if target_user:
+        params["target_user"] = target_user
+    if exercise:
+        params["exercise"] = exercise
+    ids = []
+    while True:
+        page = client.get("/memo_v2", params=params).json()
+        ids.extend(item["id"] for item in page["items"])
+        if not page["next_cursor"]:
+            break
+        params["cursor"] = page["next_cursor"]
+    assert len(ids) == len(set(ids))
+    return set(ids)
+
+def test_memo_v2_matches_python_loop_on_random_graph(client, make_user):
+    rng = random.Random(20240101)
+    users = [make_user("vis") for _ in range(12)]
+    for user in users:
+        visibility = rng.choice(["public", "friends", "private"])
+        client.put(f"/settings/visibility?current_user={user}", json={"visibility": visibility})
+        for other in rng.sample(users, 5):
+            if other != user:
+                client.post(f"/friends?current_user={user}", json={"friend_username": other})
+        sets = [
+            memo(user, date=f"2024-01-{rng.randint(1, 28):02d}", exercise=rng.choice(["ベンチプレス", "スクワット", "懸垂"]))
+            for _ in range(rng.randint(5, 30))
+        ]
+        assert client.post("/memo/batch", json=sets).status_code == 200
+
+    for viewer in users:
+        for filter_mode in ("all", "friends", "mine"):
+            for target_user in (None, rng.choice(users)):
+                for exercise in (None, "スクワット"):
+                    expected = visible_memos_python_loop(viewer, target_user, filter_mode, exercise)
+                    actual = visible_memos_api(client, viewer, target_user, filter_mode, exercise)
+                    assert actual == expected, (viewer, target_user, filter_mode, exercise)
+
+def test_visibility_sql_is_constant_and_handles_large_graphs(client, make_user):
+    viewer, friend = make_user("big"), make_user("big")
+    client.put(f"/settings/visibility?current_user={friend}", json={"visibility": "friends"})
+    client.post(f"/friends?current_user={viewer}", json={"friend_username": friend})
+    client.post(f"/friends?current_user={friend}", json={"friend_username": viewer})
+    friend_memo = client.post("/memo", json=memo(friend)).json()["id"]
+
+    # SQLite のパラメータ数の上限を超える相互フォロー（グラフ上だけ）
+    for i in range(40000):
+        main.social_graph.follow(viewer, f"ghost{i}")
+        main.social_graph.follow(f"ghost{i}", viewer)
+
+    sql_small, _ = main.memo_visibility_condition(friend)
+    sql_large, values = main.memo_visibility_condition(viewer)
+    assert sql_small == sql_large
+    assert len(values) == 2
+
+    for filter_mode in ("all", "friends"):
+        page = client.get("/memo_v2", params={"viewer_id": viewer, "target_user": friend, "filter_mode": filter_mode})
+        assert page.status_code == 200
+        assert [item["id"] for item in page.json()["items"]] == [friend_memo]
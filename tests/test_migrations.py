@@ -0,0 +1,35 @@
+import queue
+
+import main
+
+def applied_versions(conn):
+    return [row[0] for row in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+
+def test_migration_versions_are_unique_and_ordered():
+    versions = [version for version, _, _ in main.MIGRATIONS]
+    assert versions == sorted(set(versions))
+
+def test_fresh_database_gets_every_migration_once(tmp_path, monkeypatch, capsys, paused_jobs):
+    monkeypatch.setattr(main, "DB_FILE", str(tmp_path / "fresh.db"))
+    monkeypatch.setattr(main, "_db_pool", queue.LifoQueue(maxsize=main.DB_POOL_SIZE))
+    main.init_db()
+    conn = main.get_db()
+    assert applied_versions(conn) == [version for version, _, _ in main.MIGRATIONS]
+    assert capsys.readouterr().out.count("Migration ") == len(main.MIGRATIONS)
+
+    # 再起動（もう一度流す）では何も適用しない
+    main.run_migrations(conn)
+    assert "Migration " not in capsys.readouterr().out
+    assert applied_versions(conn) == [version for version, _, _ in main.MIGRATIONS]
+
+    # マイグレーションで足したトリガーが動いている
+    conn.execute("INSERT INTO memos (user_id, date, exercise, weight, reps, note) VALUES ('u', '2024-01-01', 'x', 1, 1, '')")
+    conn.commit()
+    assert conn.execute("SELECT row_version FROM memos").fetchone()[0] > 0
+    conn.dispose()
+
+def test_hot_queries_use_indexes():
+    conn = main.open_db()
+    failing = [(name, details) for name, ok, details in main.check_query_plans(conn) if not ok]
+    conn.dispose()
+    assert failing == []
@@ -0,0 +1,31 @@
+import asyncio
+
+import main
+
+RESULT = {"food_name": "テスト定食", "calories": 700, "protein": 30.0, "fat": 20.0, "carbs": 90.0}
+
+def test_memory_hit_does_not_leave_the_event_loop(monkeypatch):
+    text = "キャッシュ確認用の定食A"
+    main.remember_nutrition(text, RESULT)
+    offloaded = []
+
+    async def run_in_threadpool(func, *args):
+        offloaded.append(func)
+        return func(*args)
+
+    monkeypatch.setattr(main, "run_in_threadpool", run_in_threadpool)
+    result, _ = asyncio.run(main.lookup_nutrition(text))
+    assert result["calories"] == 700
+    assert offloaded == []
+
+def test_stored_hit_is_loaded_back_into_memory(monkeypatch):
+    text = "キャッシュ確認用の定食B"
+    key = main.normalize_food_text(text)
+    main.remember_nutrition(text, RESULT)
+    with main.nutrition_cache._lock:
+        del main.nutrition_cache._items[key]
+
+    assert main.nutrition_cache.get_memory(key) is None
+    result, _ = asyncio.run(main.lookup_nutrition(text))
+    assert result["calories"] == 700
+    assert main.nutrition_cache.get_memory(key)["calories"] == 700
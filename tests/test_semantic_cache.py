@@ -0,0 +1,35 @@
+import os
+
+import main
+
+def nutrition(name):
+    return {"food_name": name, "calories": 300, "protein": 20.0, "fat": 10.0, "carbs": 30.0}
+
+def test_near_duplicates_hit_and_different_foods_miss():
+    cache = main.semantic_cache
+    cache.add("鶏むね肉のソテー 200g", nutrition("鶏むね肉のソテー"))
+    cache.add("豚の生姜焼き", nutrition("豚の生姜焼き"))
+
+    hit = cache.lookup("鶏むね肉ソテー 100g")
+    assert hit is not None
+    assert hit["similar_to"] == "鶏むね肉のソテー 200g"
+    assert hit["calories"] == 150
+
+    assert cache.lookup("鶏もも肉のソテー 200g") is None
+    assert cache.lookup("鶏むね肉のから揚げ 200g") is None
+
+def test_scores_use_current_idf_as_the_cache_grows():
+    cache = main.semantic_cache
+    cache.add("サバの味噌煮定食", nutrition("サバの味噌煮定食"))
+    name, _ = cache._parse("サバの味噌煮定食")
+    with cache._lock:
+        slot, before = cache._similar_slot(name)
+    for i in range(300):
+        cache.add(f"味噌汁{i}", nutrition("味噌汁"))
+    with cache._lock:
+        same_slot, after = cache._similar_slot(name)
+    assert same_slot == slot
+    assert before > 0.99 and after > 0.99
+
+def test_vector_file_is_stored_next_to_the_database():
+    assert os.path.dirname(main.SEMANTIC_CACHE_FILE) == os.path.dirname(os.path.abspath(main.DB_FILE))
@@ -0,0 +1,79 @@
+from conftest import memo
+
+def sync(client, user, since=0, limit=1000):
+    response = client.get("/sync", params={"user_id": user, "since": since, "limit": limit})
+    assert response.status_code == 200
+    return response.json()
+
+def test_sync_returns_changes_and_tombstones_since_cursor(client, make_user):
+    user = make_user()
+    ids = client.post("/memo/batch", json=[memo(user, reps=r) for r in (1, 2, 3)]).json()["ids"]
+    meal = {"user_id": user, "date": "2024-01-01", "meal_type": "昼食", "food_name": "おにぎり",
+            "calories": 180, "protein": 3.0, "fat": 1.0, "carbs": 39.0}
+    client.post("/meals", json=meal)
+
+    first = sync(client, user)
+    assert sorted(m["id"] for m in first["memos"]) == sorted(ids)
+    assert len(first["meals"]) == 1
+    assert first["has_more"] is False
+
+    meal_id = first["meals"][0]["id"]
+    client.delete(f"/meals/{meal_id}")
+    client.put(f"/memo/{ids[0]}", json=memo(user, reps=10))
+
+    delta = sync(client, user, since=first["cursor"])
+    assert [m["id"] for m in delta["memos"]] == [ids[0]]
+    assert delta["memos"][0]["reps"] == 10
+    assert delta["deleted"]["meals"] == [meal_id]
+    assert delta["deleted"]["memos"] == []
+
+    assert sync(client, user, since=delta["cursor"])["memos"] == []
+
+def test_sync_pages_through_full_history(client, make_user):
+    user = make_user()
+    ids = client.post("/memo/batch", json=[memo(user, reps=r) for r in range(1, 26)]).json()["ids"]
+    seen, cursor, pages = [], 0, 0
+    while True:
+        page = sync(client, user, since=cursor, limit=7)
+        seen.extend(m["id"] for m in page["memos"])
+        cursor, pages = page["cursor"], pages + 1
+        if not page["has_more"]:
+            break
+    assert sorted(seen) == sorted(ids)
+    assert pages == 4
+
+def test_changing_owner_leaves_a_tombstone_for_the_previous_owner(client, make_user):
+    alice, bob = make_user(), make_user()
+    memo_id = client.post("/memo", json=memo(alice)).json()["id"]
+    alice_cursor = sync(client, alice)["cursor"]
+    bob_cursor = sync(client, bob)["cursor"]
+
+    client.put(f"/memo/{memo_id}", json=memo(bob))
+    alice_delta = sync(client, alice, since=alice_cursor)
+    assert alice_delta["deleted"]["memos"] == [memo_id]
+    assert [m["id"] for m in sync(client, bob, since=bob_cursor)["memos"]] == [memo_id]
+
+    # 戻ってきた行は削除記録より新しいので、削除ではなく変更として返る
+    client.put(f"/memo/{memo_id}", json=memo(alice, reps=8))
+    back = sync(client, alice, since=alice_cursor)
+    assert [m["id"] for m in back["memos"]] == [memo_id]
+    assert back["deleted"]["memos"] == []
+
+def test_sync_can_be_limited_to_some_tables(client, make_user):
+    user = make_user()
+    client.post("/memo", json=memo(user))
+    meal = {"user_id": user, "date": "2024-01-01", "meal_type": "昼食", "food_name": "おにぎり",
+            "calories": 180, "protein": 3.0, "fat": 1.0, "carbs": 39.0}
+    client.post("/meals", json=meal)
+    first = client.get("/sync", params={"user_id": user, "tables": "meals"}).json()
+    assert set(first) == {"cursor", "has_more", "reset", "meals", "deleted"}
+    assert first["deleted"] == {"meals": []}
+    assert len(first["meals"]) == 1
+
+    client.delete(f"/memo/{sync(client, user)['memos'][0]['id']}")
+    client.delete(f"/meals/{first['meals'][0]['id']}")
+    delta = client.get("/sync", params={"user_id": user, "since": first["cursor"], "tables": "meals"}).json()
+    assert delta["deleted"] == {"meals": [first["meals"][0]["id"]]}
+
+    assert client.get("/sync", params={"user_id": user, "tables": "meals,passwords"}).status_code == 400
+    assert client.get("/sync", params={"user_id": user, "tables": ""}).status_code == 400
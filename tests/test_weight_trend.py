@@ -0,0 +1,36 @@
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+import main
+
+def exponential_smoothing_loop(days, values, alpha):
+    out = [values[0]]
+    for k in range(1, len(values)):
+        carry = (1.0 - alpha) ** float(days[k] - days[k - 1])
+        out.append(out[-1] * carry + (1.0 - carry) * values[k])
+    return np.array(out)
+
+@pytest.mark.parametrize("alpha", [0.05, 0.5, 0.9, 0.99, 0.999999])
+def test_exponential_smoothing_matches_recurrence(alpha):
+    rng = np.random.default_rng(9)
+    days = np.cumsum(rng.integers(1, 4, size=400)).astype(np.int64)
+    values = 70 + rng.normal(0, 1, size=400)
+    result = main.exponential_smoothing(days, values, alpha)
+    assert np.all(np.isfinite(result))
+    np.testing.assert_allclose(result, exponential_smoothing_loop(days, values, alpha), rtol=1e-9)
+
+@pytest.mark.parametrize("alpha", [0.9, 0.99])
+def test_weight_trend_with_large_alpha_over_long_history(client, make_user, alpha):
+    user = make_user()
+    start = date(2023, 1, 1)
+    for i in range(400):
+        day = (start + timedelta(days=i)).isoformat()
+        client.post("/weights", json={"user_id": user, "date": day, "weight": 70 + (i % 7) * 0.1})
+
+    response = client.get("/weights/trend", params={"user_id": user, "alpha": alpha})
+    assert response.status_code == 200
+    latest = response.json()["latest"]
+    assert latest["date"] == (start + timedelta(days=399)).isoformat()
+    assert abs(latest["ema"] - latest["weight"]) < 0.1